@@ -6,10 +6,19 @@ from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import DICOMLib.DICOMUtils as dutils
 import DICOMScalarVolumePlugin
+from SlicerBatchAnonymizeLib import SeriesWorker, DicomHeaders
+from SlicerBatchAnonymizeLib.BatchRunner import BatchRunner
+from SlicerBatchAnonymizeLib.BatchTimings import BatchTimings
+from SlicerBatchAnonymizeLib.Crosswalk import Crosswalk
+from SlicerBatchAnonymizeLib.DedupCache import DedupCache
+from SlicerBatchAnonymizeLib.DirectoryScanner import DirectoryIndex, DirectoryScanner
+from SlicerBatchAnonymizeLib.FolderWatcher import FolderWatcher
+from SlicerBatchAnonymizeLib.JobController import JobController
+from SlicerBatchAnonymizeLib.ImageWriter import WriterOptions, compressWrittenFile, uncompressedPath
+from SlicerBatchAnonymizeLib.ProgressChannel import ProgressChannel
 from pathlib import Path
-import csv
-import uuid
-from datetime import datetime, timedelta
+import shutil
+import tempfile
 
 #
 # SlicerBatchAnonymize
@@ -43,6 +52,117 @@ This file was originally developed by Jean-Christophe Fillion-Robin, Kitware Inc
 and Steve Pieper, Isomics, Inc. and was partially funded by NIH grant 3P41RR013218-12S1.
 """
 
+#
+# CrosswalkTableModel
+#
+
+class CrosswalkTableModel(qt.QAbstractTableModel):
+  """
+  Crosswalk preview: output name and input directory of each series.
+  The view only asks for the visible rows, so output names are computed on demand instead of
+  filling a table item per series, and a naming change does not touch the rows themselves.
+  UUIDs are generated once per entry by the Crosswalk, so they stay the same between repaints
+  and match the names used for the export (see assignOutputNames()).
+  """
+
+  def __init__(self, parent=None):
+    qt.QAbstractTableModel.__init__(self, parent)
+    self.input_image_list = Crosswalk()
+    self.input_root = ""
+    self.prefix = ""
+    self.use_uuid = False
+    self.secret = None
+    self._num_rows = 0
+
+  def setImageList(self, input_image_list, input_root):
+    """
+    Show input_image_list, a Crosswalk the model reads and renames entries of.
+    """
+    self.beginResetModel()
+    self.input_image_list = input_image_list
+    self.input_root = str(input_root or "")
+    self._num_rows = len(input_image_list)
+    self.endResetModel()
+
+  def appendRows(self):
+    """
+    Show the directories added to the end of input_image_list since the last call.
+    """
+    if len(self.input_image_list) == self._num_rows:
+      return
+    self.beginInsertRows(qt.QModelIndex(), self._num_rows, len(self.input_image_list) - 1)
+    self._num_rows = len(self.input_image_list)
+    self.endInsertRows()
+
+  def setNaming(self, prefix, use_uuid, secret=None):
+    """
+    See Crosswalk.outputName() for the naming options.
+    """
+    if prefix == self.prefix and use_uuid == self.use_uuid and secret == self.secret:
+      return
+    self.prefix = prefix
+    self.use_uuid = use_uuid
+    self.secret = secret
+    if self._num_rows > 0:
+      # Only the visible rows are repainted
+      self.dataChanged(self.index(0, 0), self.index(self._num_rows - 1, 0))
+
+  def outputName(self, row):
+    return self.input_image_list.outputName(row, self.prefix, self.use_uuid, self.secret)
+
+  def assignOutputNames(self):
+    """
+    Store the output name of every series in input_image_list, before processing.
+    """
+    self.input_image_list.assignNames(self.prefix, self.use_uuid, self.secret)
+
+  def rowCount(self, parent=None):
+    if parent is not None and parent.isValid():
+      return 0
+    return self._num_rows
+
+  def columnCount(self, parent=None):
+    if parent is not None and parent.isValid():
+      return 0
+    return 2
+
+  def headerData(self, section, orientation, role=qt.Qt.DisplayRole):
+    if orientation == qt.Qt.Horizontal and role == qt.Qt.DisplayRole:
+      return ["Output file name", "Target for input"][section]
+    return None
+
+  def flags(self, index):
+    if not index.isValid():
+      return qt.Qt.NoItemFlags
+    flags = qt.Qt.ItemIsEnabled | qt.Qt.ItemIsSelectable
+    if index.column() == 0:
+      flags |= qt.Qt.ItemIsEditable
+    return flags
+
+  def data(self, index, role=qt.Qt.DisplayRole):
+    if not index.isValid() or role not in (qt.Qt.DisplayRole, qt.Qt.EditRole, qt.Qt.ToolTipRole):
+      return None
+    row = index.row()
+    if index.column() == 0:
+      return self.outputName(row)
+    path = self.input_image_list.entry(row).path
+    if role == qt.Qt.ToolTipRole:
+      return str(path)
+    try:
+      return str(path.relative_to(self.input_root))
+    except ValueError:
+      return str(path)
+
+  def setData(self, index, value, role=qt.Qt.EditRole):
+    if not index.isValid() or index.column() != 0 or role != qt.Qt.EditRole:
+      return False
+    name = str(value).strip()
+    if name == "" or name == self.outputName(index.row()):
+      return False
+    self.input_image_list.rename(index.row(), name)
+    self.dataChanged(index, index)
+    return True
+
 #
 # SlicerBatchAnonymizeWidget
 #
@@ -60,9 +180,20 @@ class SlicerBatchAnonymizeWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.logic = None
     self._parameterNode = None
     self._updatingGUIFromParameterNode = False
-    self.input_image_list = {}
+    self.input_image_list = Crosswalk()
     self.output_dir = None
     self.input_path = None
+    self.scanner = None
+    # Directory listings of the previous scans, a new scan only lists the directories that changed
+    self.directoryIndex = DirectoryIndex()
+    # Entries of the crosswalk being rescanned, they keep their manual names and UUIDs
+    self._previousEntries = {}
+    self.watcher = None
+    self._watchBusy = False
+    # A batch is being processed, see setRunning()
+    self._running = False
+    # The watch stopped while a batch was running, its session is ended once the batch returns
+    self._endSessionPending = False
     self.isSingleModuleShown = False
     self.setParameterNode(None)
 
@@ -97,19 +228,55 @@ class SlicerBatchAnonymizeWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     # (in the selected parameter node).
     self.ui.inputFormatComboBox.connect("currentIndexChanged(int)", self.onInputFormatChanged)
     self.ui.useUUIDCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.hashedUUIDCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.directReadCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.tempDatabaseCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     self.ui.inDirButton.connect('directoryChanged(QString)', self.onInputDirChanged)
+    self.ui.cancelScanButton.connect('clicked(bool)', self.onCancelScan)
     self.ui.outDirButton.connect('directoryChanged(QString)', self.onOutputDirChanged)
     self.ui.outputFormatComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
-    self.ui.prefixLineEdit.connect("textChanged(QString)",  self.updateParameterNodeFromGUI)
-    self.ui.crosswalkTableWidget.currentItemChanged.connect(self.onCrossWalkRowChanged)
-    #self.ui.crosswalkTableWidget.itemChanged.connect(self.testSignal)
-    self.ui.crosswalkTableWidget.itemPressed.connect(self.setManualEditOn)
-    self.ui.crosswalkTableWidget.itemChanged.connect(self.testSignal)
+    # Prefix edits are applied once typing pauses
+    self.prefixTimer = qt.QTimer()
+    self.prefixTimer.setSingleShot(True)
+    self.prefixTimer.setInterval(300)
+    self.prefixTimer.connect('timeout()', self.updateParameterNodeFromGUI)
+    self.ui.prefixLineEdit.connect("textChanged(QString)", lambda text: self.prefixTimer.start())
+    # The secret is not stored in the parameter node, so it is not saved with the scene
+    self.ui.secretLineEdit.connect("textChanged(QString)", lambda text: self.prefixTimer.start())
+    self.ui.workersSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.headerOnlyCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.resumeCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.showTimingsCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    # Manual renames are stored by the model, see CrosswalkTableModel.setData()
+    self.crosswalkModel = CrosswalkTableModel()
+    self.ui.crosswalkTableView.setModel(self.crosswalkModel)
+    self.ui.crosswalkTableView.horizontalHeader().setStretchLastSection(True)
+    self.ui.crosswalkTableView.horizontalHeader().resizeSection(0, 200)
+    # Fixed row heights, so the view does not measure every row
+    self.ui.crosswalkTableView.verticalHeader().setSectionResizeMode(qt.QHeaderView.Fixed)
     self.ui.progressBar.value = 0
     self.ui.progressLabel.text = "Nothing to do"
-    self.manualEditOn = False
+    # The input directory is walked in small steps from this timer so the GUI stays responsive
+    self.scanTimer = qt.QTimer()
+    self.scanTimer.setInterval(0)
+    self.scanTimer.connect('timeout()', self.onScanTimeout)
+    # The input directory is polled from this timer while watching it
+    self.watchTimer = qt.QTimer()
+    self.watchTimer.setInterval(5000)
+    self.watchTimer.connect('timeout()', self.onWatchTimeout)
+    self.ui.watchCheckBox.connect("toggled(bool)", self.onWatchToggled)
+    self.ui.quietSecondsSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.memoryLimitSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.compressionLevelSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.compressionThreadsSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.skipDuplicatesCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.keepPseudonymsCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.archiveComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.clearDedupCacheButton.connect('clicked(bool)', self.onClearDedupCache)
     # Buttons
     self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.ui.pauseButton.connect('toggled(bool)', self.onPauseToggled)
+    self.ui.cancelButton.connect('clicked(bool)', self.onCancelButton)
 
     # Make sure parameter node is initialized (needed for module reload)
     self.initializeParameterNode()
@@ -125,63 +292,73 @@ class SlicerBatchAnonymizeWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     shortcut.connect('activated()', lambda: self.showSingleModule(toggle=True))
     self.showSingleModule(self.isSingleModuleShown)
 
-  def setManualEditOn(self, item):
-    self.manualEditOn = True
-
-  def testSignal(self, item):
-    if self.manualEditOn:
-      row = item.row()
-      col = item.column()
-      for d in self.input_image_list:
-        if self.input_image_list[d][0] == row:
-          row_text = self.ui.crosswalkTableWidget.item(row, 0).text()
-          if row_text != self.input_image_list[d][1]:
-            self.input_image_list[d][1] = row_text
-            self.input_image_list[d][2] = True
-            self.updateParameterNodeFromGUI()
-      self.manualEditOn = False
-
-  def onCrossWalkRowChanged(self, current, previous):
-    if previous==None:
-      return
-    prev_row = previous.row()
-    for d in self.input_image_list:
-      if self.input_image_list[d][0] == prev_row:
-        # Get the new file name in column 0 for the previous row, compare and set
-        prev_row_text = self.ui.crosswalkTableWidget.item(prev_row, 0).text()
-        if prev_row_text != self.input_image_list[d][1]:
-          self.input_image_list[d][1] = prev_row_text
-          self.input_image_list[d][2] = True
-          self.updateParameterNodeFromGUI()
-
   def onInputFormatChanged(self):
-    dir_name = self.ui.inDirButton.directory
-    print(dir_name)
-    self.onInputDirChanged(dir_name)
+    # Only the patterns changed, the listings of the previous scan are used as they are
+    self.startScan(self.ui.inDirButton.directory, revalidate=False)
 
   def onInputDirChanged(self, dir_name):
+    self.startScan(dir_name, revalidate=True)
+
+  def startScan(self, dir_name, revalidate=True):
+    """
+    Rebuild the crosswalk from the directories of dir_name holding files matching the input format.
+    :param revalidate: check the directories already indexed for changes, see DirectoryScanner
+    """
+    self.stopScan()
     self.input_path = Path(str(dir_name))
     if not self.input_path.exists():
       logging.error('The directory {} does not exist'.format(self.input_path))
       return
-    # Get the list of images:
-    input_image_list = []
+    # Get the list of directories (i.e. one full scan image in one directory).
+    # They are added to the list as the scanner finds them, in sorted order.
     input_pattern = self.ui.inputFormatComboBox.currentText.split(',')
-    for pattern in input_pattern:
-      logging.info("Finding: " + pattern)
-      input_image_list.extend( list(self.input_path.glob("**/" + pattern)))
-    dir_set = set()
-    if len(input_image_list) > 0:
-      for im in input_image_list:
-        dir_set.add(im.parent)
-    self.input_image_list = {}
-    if len(dir_set) > 0:
-      # This would be the list of directories (i.e. one full scan image in one directory)
-      for idx, d in enumerate(sorted(dir_set)):
-        # third element keeps track of manual edits. False: auto, True is manual
-        self.input_image_list[d] = [idx,"", False]
+    logging.info("Finding: " + ",".join(input_pattern))
+    # Entries of an interrupted scan are still in _previousEntries
+    self._previousEntries.update((entry.path, entry) for entry in self.input_image_list.entries())
+    self.input_image_list = Crosswalk()
+    self.crosswalkModel.setImageList(self.input_image_list, self.input_path)
+    self.scanner = DirectoryScanner(self.input_path, input_pattern, self.directoryIndex, revalidate)
+    self.ui.cancelScanButton.setEnabled(True)
+    self.scanTimer.start()
+    self.updateParameterNodeFromGUI()
+
+  def onScanTimeout(self):
+    if self.scanner is None:
+      self.scanTimer.stop()
+      return
+    found = self.scanner.step(0.1)
+    for result in found:
+      previous = self._previousEntries.get(Path(result.path))
+      if previous is not None:
+        if previous.first_file != result.first_file:
+          previous.first_file = result.first_file
+          previous.series_uid = None
+        self.input_image_list.addEntry(previous)
+      else:
+        self.input_image_list.add(result.path, first_file=result.first_file)
+    self.crosswalkModel.appendRows()
+    if self.scanner.done:
+      logging.info("Found {} directories with {} files, {} directories listed".format(
+        len(self.input_image_list), self.scanner.num_files, self.scanner.num_listed))
+      self._previousEntries = {}
+      self.stopScan()
+      self.updateParameterNodeFromGUI()
+    elif len(found) > 0:
+      self.updateParameterNodeFromGUI()
+
+  def onCancelScan(self):
+    if self.scanner is not None:
+      logging.info("Directory scan canceled, {} directories found so far".format(len(self.input_image_list)))
+    self.stopScan()
     self.updateParameterNodeFromGUI()
 
+  def stopScan(self):
+    self.scanTimer.stop()
+    if self.scanner is not None:
+      self.scanner.cancel()
+    self.scanner = None
+    self.ui.cancelScanButton.setEnabled(False)
+
   def onOutputDirChanged(self, dir_name):
     output_dir = Path(str(dir_name))
     if not output_dir.exists():
@@ -220,6 +397,8 @@ class SlicerBatchAnonymizeWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     """
     Called when the application closes and the module widget is destroyed.
     """
+    self.stopScan()
+    self.stopWatch()
     self.removeObservers()
 
   def enter(self):
@@ -241,7 +420,13 @@ class SlicerBatchAnonymizeWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     Called just before the scene is closed.
     """
     # Parameter node will be reset, do not use it anymore
-    self.input_image_list={}
+    self.stopScan()
+    self.stopWatch()
+    wasBlocked = self.ui.watchCheckBox.blockSignals(True)
+    self.ui.watchCheckBox.checked = False
+    self.ui.watchCheckBox.blockSignals(wasBlocked)
+    self.input_image_list = Crosswalk()
+    self.crosswalkModel.setImageList(self.input_image_list, None)
     self.setParameterNode(None)
 
   def onSceneEndClose(self, caller, event):
@@ -293,55 +478,56 @@ class SlicerBatchAnonymizeWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     #print(self._parameterNode.GetParameter("InListDetailsString"))
     self.ui.inDetailsLabel.setText(self._parameterNode.GetParameter("InListDetailsString"))
     self.ui.useUUIDCheckBox.checked = (self._parameterNode.GetParameter("UseUUID") == "true")
+    self.ui.directReadCheckBox.checked = (self._parameterNode.GetParameter("DirectRead") == "true")
+    self.ui.tempDatabaseCheckBox.checked = (self._parameterNode.GetParameter("TempDatabase") == "true")
+    self.ui.tempDatabaseCheckBox.setEnabled(not self.ui.directReadCheckBox.checked)
     self.ui.prefixLineEdit.setText(self._parameterNode.GetParameter("OutputPrefix"))
     self.ui.prefixLineEdit.setEnabled(not self.ui.useUUIDCheckBox.checked)
+    self.ui.hashedUUIDCheckBox.checked = (self._parameterNode.GetParameter("HashedUUID") == "true")
+    self.ui.hashedUUIDCheckBox.setEnabled(self.ui.useUUIDCheckBox.checked)
+    self.ui.secretLineEdit.setEnabled(self.ui.useUUIDCheckBox.checked and self.ui.hashedUUIDCheckBox.checked)
     # self.ui.progressLabel.setText(self._parameterNode.GetParameter("ProgressText"))
     # self.ui.progressBar.setValue(int(self._parameterNode.GetParameter("ProgressValue")))
     
     formatText = self._parameterNode.GetParameter("OutputFormat")
     outIndex = max(0, self.ui.outputFormatComboBox.findText(formatText))
     self.ui.outputFormatComboBox.setCurrentIndex(outIndex)
+    self.ui.workersSpinBox.value = int(self._parameterNode.GetParameter("NumberOfWorkers"))
+    self.ui.headerOnlyCheckBox.checked = (self._parameterNode.GetParameter("HeaderOnly") == "true")
+    self.ui.headerOnlyCheckBox.setEnabled(formatText == ".dcm")
+    self.ui.resumeCheckBox.checked = (self._parameterNode.GetParameter("Resume") == "true")
+    self.ui.showTimingsCheckBox.checked = (self._parameterNode.GetParameter("ShowTimings") == "true")
+    self.ui.skipDuplicatesCheckBox.checked = (self._parameterNode.GetParameter("SkipDuplicates") == "true")
+    self.ui.keepPseudonymsCheckBox.checked = (self._parameterNode.GetParameter("KeepPseudonyms") == "true")
+    self.ui.archiveComboBox.setCurrentIndex(max(0, self.ui.archiveComboBox.findText(self._parameterNode.GetParameter("ArchiveFormat"))))
+    # DICOM export through the scene cannot use worker processes
+    self.ui.workersSpinBox.setEnabled(formatText != ".dcm" or self.ui.headerOnlyCheckBox.checked)
+    self.ui.compressionLevelSpinBox.value = int(self._parameterNode.GetParameter("CompressionLevel"))
+    self.ui.compressionThreadsSpinBox.value = int(self._parameterNode.GetParameter("CompressionThreads"))
+    self.ui.compressionLevelSpinBox.setEnabled(formatText != ".dcm")
+    self.ui.compressionThreadsSpinBox.setEnabled(formatText != ".dcm")
 
     formatText = self._parameterNode.GetParameter("InputFormat")
     outIndex = max(0, self.ui.inputFormatComboBox.findText(formatText))
     self.ui.inputFormatComboBox.setCurrentIndex(outIndex)
 
-    prefix_condition = (not self.ui.useUUIDCheckBox.checked and len(self.ui.prefixLineEdit.text) > 0) or self.ui.useUUIDCheckBox.checked
+    secret = None
+    if self.ui.useUUIDCheckBox.checked and self.ui.hashedUUIDCheckBox.checked:
+      secret = self.ui.secretLineEdit.text
+    prefix_condition = (not self.ui.useUUIDCheckBox.checked and len(self.ui.prefixLineEdit.text) > 0) or \
+                       (self.ui.useUUIDCheckBox.checked and secret != "")
+    self.ui.quietSecondsSpinBox.value = int(self._parameterNode.GetParameter("QuietSeconds"))
+    self.ui.memoryLimitSpinBox.value = int(self._parameterNode.GetParameter("MemoryLimit"))
     self.ui.applyButton.setEnabled(len(self.input_image_list) > 0 and \
+                                  self.scanner is None and \
+                                  self.watcher is None and \
+                                  not self._running and \
                                   self.output_dir is not None and \
                                   self.output_dir.exists() and \
                                   prefix_condition)
-    #Update the crosswalk dict and text here
-    self.ui.crosswalkTableWidget.setRowCount(len(self.input_image_list))
-    self.ui.crosswalkTableWidget.setHorizontalHeaderLabels(["Output file name", "Target for input"])
-    self.ui.crosswalkTableWidget.horizontalHeader().setVisible(True)
-    if len(self.input_image_list) > 0:
-      for k in self.input_image_list:
-        entry =  self.input_image_list[k]
-        index = entry[0]
-        if entry[2]:
-          # Filename was edited manually.
-          filename = entry[1]
-        elif (self._parameterNode.GetParameter("UseUUID") == "true"):
-          filename = str(uuid.uuid4())
-        else:
-          filename = (self._parameterNode.GetParameter("OutputPrefix")+ "_%04d"%(index+1))
-        self.input_image_list[k][1]=filename
-        newItem = qt.QTableWidgetItem(filename)
-        newItem.setToolTip(filename)
-        self.ui.crosswalkTableWidget.setItem(index, 0, newItem)
-
-        try:
-          rel_path = Path(k).relative_to(self._parameterNode.GetParameter("InputDirectory"))
-          # print(k)
-          # print(self._parameterNode.GetParameter("InputDirectory"))
-          newItem1 = qt.QTableWidgetItem(rel_path)
-        except ValueError as e:
-          newItem1 = qt.QTableWidgetItem(k)
-        newItem1.setToolTip(str(k))
-        newItem1.setFlags(newItem1.flags() & ~qt.Qt.ItemIsEditable)
-        self.ui.crosswalkTableWidget.setItem(index, 1, newItem1)
-    self.ui.crosswalkTableWidget.resizeColumnToContents(1)
+    # The crosswalk rows compute their names when shown, only the naming is updated here
+    self.crosswalkModel.setNaming(self._parameterNode.GetParameter("OutputPrefix"),
+                                  self._parameterNode.GetParameter("UseUUID") == "true", secret or None)
 
     # All the GUI updates are done
     self._updatingGUIFromParameterNode = False
@@ -355,13 +541,30 @@ class SlicerBatchAnonymizeWidget(ScriptedLoadableModuleWidget, VTKObservationMix
       return
 
     wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
-    self._parameterNode.SetParameter("InListDetailsString", "Will anonymize: " + str(len(self.input_image_list)) + " images")
+    details = "Will anonymize: " + str(len(self.input_image_list)) + " images"
+    if self.scanner is not None:
+      details = "Scanning... found " + str(len(self.input_image_list)) + " images"
+    self._parameterNode.SetParameter("InListDetailsString", details)
     self._parameterNode.SetParameter("UseUUID", "true" if self.ui.useUUIDCheckBox.checked else "false")
+    self._parameterNode.SetParameter("HashedUUID", "true" if self.ui.hashedUUIDCheckBox.checked else "false")
+    self._parameterNode.SetParameter("DirectRead", "true" if self.ui.directReadCheckBox.checked else "false")
+    self._parameterNode.SetParameter("TempDatabase", "true" if self.ui.tempDatabaseCheckBox.checked else "false")
     self._parameterNode.SetParameter("OutputPrefix", self.ui.prefixLineEdit.text)
     self._parameterNode.SetParameter("InputDirectory", self.ui.inDirButton.directory)
     self._parameterNode.SetParameter("OutputDirectory", self.ui.outDirButton.text)
     self._parameterNode.SetParameter("InputFormat", self.ui.inputFormatComboBox.currentText)
     self._parameterNode.SetParameter("OutputFormat", self.ui.outputFormatComboBox.currentText)
+    self._parameterNode.SetParameter("NumberOfWorkers", str(self.ui.workersSpinBox.value))
+    self._parameterNode.SetParameter("HeaderOnly", "true" if self.ui.headerOnlyCheckBox.checked else "false")
+    self._parameterNode.SetParameter("Resume", "true" if self.ui.resumeCheckBox.checked else "false")
+    self._parameterNode.SetParameter("ShowTimings", "true" if self.ui.showTimingsCheckBox.checked else "false")
+    self._parameterNode.SetParameter("SkipDuplicates", "true" if self.ui.skipDuplicatesCheckBox.checked else "false")
+    self._parameterNode.SetParameter("KeepPseudonyms", "true" if self.ui.keepPseudonymsCheckBox.checked else "false")
+    self._parameterNode.SetParameter("ArchiveFormat", self.ui.archiveComboBox.currentText)
+    self._parameterNode.SetParameter("QuietSeconds", str(self.ui.quietSecondsSpinBox.value))
+    self._parameterNode.SetParameter("MemoryLimit", str(self.ui.memoryLimitSpinBox.value))
+    self._parameterNode.SetParameter("CompressionLevel", str(self.ui.compressionLevelSpinBox.value))
+    self._parameterNode.SetParameter("CompressionThreads", str(self.ui.compressionThreadsSpinBox.value))
     # self._parameterNode.SetParameter("ProgressText", self.ui.progressLabel.text)
     # self._parameterNode.SetParameter("ProgressValue", str(self.ui.progressBar.value))
     self._parameterNode.EndModify(wasModified)
@@ -371,14 +574,125 @@ class SlicerBatchAnonymizeWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     """
     Run processing when user clicks "Apply" button.
     """
+    # Pending prefix edit
+    if self.prefixTimer.isActive():
+      self.prefixTimer.stop()
+      self.updateParameterNodeFromGUI()
     try:
-      # Compute output
-      self.logic.process(self.input_image_list, self.output_dir, self.ui.outputFormatComboBox.currentText, self.ui.keepGenderCheckBox.checked,  self.ui.keepAgeCheckBox.checked, self.ui.progressBar, self.ui.progressLabel)
+      self.crosswalkModel.assignOutputNames()
+      self.processImageList(self.input_image_list, self.ui.resumeCheckBox.checked)
     except Exception as e:
       slicer.util.errorDisplay("Failed to compute results: "+str(e))
       import traceback
       traceback.print_exc()
 
+  def onPauseToggled(self, paused):
+    if paused:
+      self.logic.controller.pause()
+      self.ui.pauseButton.text = "Resume"
+      self.ui.progressLabel.text = "Paused"
+    else:
+      self.logic.controller.resume()
+      self.ui.pauseButton.text = "Pause"
+
+  def onCancelButton(self):
+    self.logic.controller.cancel()
+    self.ui.progressLabel.text = "Canceling..."
+
+  def setRunning(self, running):
+    """
+    Enable the pause and cancel buttons while a batch runs, and keep it from being started again.
+    The watch cannot be stopped from the GUI while a batch runs, as that would close its outputs.
+    """
+    self.ui.pauseButton.blockSignals(True)
+    self.ui.pauseButton.checked = False
+    self.ui.pauseButton.text = "Pause"
+    self.ui.pauseButton.blockSignals(False)
+    self.ui.pauseButton.setEnabled(running)
+    self.ui.cancelButton.setEnabled(running)
+    self.ui.watchCheckBox.setEnabled(not running)
+    self._running = running
+    self.updateGUIFromParameterNode()
+
+  def onClearDedupCache(self):
+    cache = DedupCache(self.logic.dedupCachePath(), None)
+    cache.clear()
+    cache.close()
+    self.ui.progressLabel.text = "Duplicate cache cleared"
+
+  def processImageList(self, input_image_list, resume, session=False):
+    # Compute output
+    self.setRunning(True)
+    try:
+      self.logic.process(input_image_list, self.output_dir, self.ui.outputFormatComboBox.currentText, self.ui.keepGenderCheckBox.checked,  self.ui.keepAgeCheckBox.checked, self.ui.progressBar, self.ui.progressLabel,
+                         num_workers=self.ui.workersSpinBox.value, direct=self.ui.directReadCheckBox.checked,
+                         temp_database=self.ui.tempDatabaseCheckBox.checked, header_only=self.ui.headerOnlyCheckBox.checked,
+                         resume=resume, show_timings=self.ui.showTimingsCheckBox.checked,
+                         memory_limit_mb=self.ui.memoryLimitSpinBox.value,
+                         writer_options=WriterOptions(self.ui.compressionLevelSpinBox.value, self.ui.compressionThreadsSpinBox.value),
+                         dedup_cache=self.logic.dedupCachePath() if self.ui.skipDuplicatesCheckBox.checked else None,
+                         pseudonym_store=self.logic.pseudonymStorePath() if self.ui.keepPseudonymsCheckBox.checked else None,
+                         archive_format=self.ui.archiveComboBox.currentText if self.ui.archiveComboBox.currentIndex > 0 else None,
+                         session=session)
+    finally:
+      self.setRunning(False)
+      if self._endSessionPending:
+        self._endSessionPending = False
+        self.logic.endSession()
+
+  def onWatchToggled(self, checked):
+    if not checked:
+      self.stopWatch()
+      self.ui.progressLabel.text = "Stopped watching"
+      self.updateParameterNodeFromGUI()
+      return
+    if self.input_path is None or not self.input_path.exists() or self.output_dir is None or not self.output_dir.exists():
+      slicer.util.errorDisplay("Select the input and output directories before watching the input directory")
+      self.ui.watchCheckBox.checked = False
+      return
+    self.stopScan()
+    # Directories of previous runs into the output directory are not processed again, unless they change
+    input_pattern = self.ui.inputFormatComboBox.currentText.split(',')
+    self.watcher = FolderWatcher(self.input_path, input_pattern, self.ui.quietSecondsSpinBox.value, index=self.directoryIndex)
+    self.watcher.markProcessed(Crosswalk.fromJournal(self.output_dir))
+    self.ui.progressLabel.text = "Watching " + str(self.input_path)
+    self.watchTimer.start()
+    self.updateParameterNodeFromGUI()
+
+  def onWatchTimeout(self):
+    """
+    Anonymize the directories of the input that became quiet, appending them to the crosswalk and its file.
+    """
+    if self.watcher is None or self._watchBusy:
+      return
+    self._watchBusy = True
+    try:
+      self.watcher.poll()
+      # Processed together, with the number of workers set in the outputs
+      ready = self.watcher.takeReady(max(4, 4 * self.ui.workersSpinBox.value))
+      if len(ready) == 0:
+        return
+      for result in ready:
+        self.input_image_list.addNamed(result.path, self.crosswalkModel.prefix, self.crosswalkModel.use_uuid,
+                                       self.crosswalkModel.secret, result.first_file)
+      self.crosswalkModel.appendRows()
+      self.updateParameterNodeFromGUI()
+      self.processImageList(self.input_image_list.subset([result.path for result in ready]), True, session=True)
+      self.ui.progressLabel.text = "Watching {}: {} directories waiting".format(self.input_path, self.watcher.numQueued())
+    except Exception as e:
+      logging.error("Failed to process the new directories: {}".format(e))
+    finally:
+      self._watchBusy = False
+
+  def stopWatch(self):
+    self.watchTimer.stop()
+    self.watcher = None
+    if self._running:
+      # The running batch still writes to the journal of the session
+      self._endSessionPending = True
+    else:
+      self.logic.endSession()
+
 #
 # SlicerBatchAnonymizeLogic
 #
@@ -393,28 +707,83 @@ class SlicerBatchAnonymizeLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # Files imported into the DICOM database together, cancel and pause are checked between two chunks
+  IMPORT_CHUNK_SIZE = 100
+
   def __init__(self):
     """
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
-    self.process_cont = False
+    # Cancel and pause of the running batch, from the GUI buttons
+    self.controller = JobController()
+    # Progress of the running batch, shown by a timer. The batch runs in the GUI thread, publishing
+    # lets the events (timer, buttons) be processed a few times per second.
+    self.progressChannel = ProgressChannel(pump=slicer.app.processEvents)
+    # BatchRunner kept open between the batches of a watch session, see process()
+    self.sessionRunner = None
 
   def setDefaultParameters(self, parameterNode):
     """
     Initialize parameter node with default settings.
     """
     parameterNode.SetParameter("UseUUID", "false")
+    parameterNode.SetParameter("HashedUUID", "false")
+    parameterNode.SetParameter("DirectRead", "false")
+    parameterNode.SetParameter("TempDatabase", "false")
     parameterNode.SetParameter("OutputPrefix", "File")
     parameterNode.SetParameter("InListDetailsString", "No directory selected")
     parameterNode.SetParameter("InputDirectory", "")
     parameterNode.SetParameter("OutputDirectory", "")
     parameterNode.SetParameter("InputFormat", "*.dcm,*.dicom,*.DICOM,*.DCM")
     parameterNode.SetParameter("OutputFormat", ".nii.gz")
+    parameterNode.SetParameter("NumberOfWorkers", "1")
+    parameterNode.SetParameter("HeaderOnly", "false")
+    parameterNode.SetParameter("Resume", "false")
+    parameterNode.SetParameter("ShowTimings", "false")
+    parameterNode.SetParameter("SkipDuplicates", "false")
+    parameterNode.SetParameter("KeepPseudonyms", "false")
+    parameterNode.SetParameter("ArchiveFormat", "No archive")
+    parameterNode.SetParameter("QuietSeconds", "30")
+    parameterNode.SetParameter("MemoryLimit", "0")
+    parameterNode.SetParameter("CompressionLevel", "-1")
+    parameterNode.SetParameter("CompressionThreads", "1")
     # parameterNode.SetParameter("ProgressText", "Nothing")
     # parameterNode.SetParameter("ProgressValue", "0")
 
-  def reportProgress(self, msg, percentage, progressbar, progressmsg):
+  def reportProgress(self, msg, percentage):
+    """
+    Publish the progress, shown on the next tick of the progress timer, see showProgress().
+    """
+    self.progressChannel.publish(msg, percentage)
+
+  def isCanceled(self):
+    """
+    Let pending GUI events run if they were not recently, wait while the batch is paused,
+    and tell if the user stopped processing.
+    """
+    self.progressChannel.pumpIfDue()
+    try:
+      self.controller.checkpoint(self.progressChannel.pumpIfDue)
+    except SeriesWorker.JobCanceled:
+      return True
+    return False
+
+  def checkpoint(self):
+    """
+    Raise SeriesWorker.JobCanceled if the user stopped processing, wait while the batch is paused.
+    """
+    if self.isCanceled():
+      raise SeriesWorker.JobCanceled("User stopped processing")
+
+  def showProgress(self, progressbar, progressmsg):
+    """
+    Show the progress published since the last call, if any.
+    """
+    progress = self.progressChannel.read()
+    if progress is None:
+      return
+    msg, percentage = progress
     # Abort download if cancel is clicked in progress bar
     # if slicer.progressWindow.wasCanceled:
     #   raise Exception("process aborted")
@@ -429,36 +798,25 @@ class SlicerBatchAnonymizeLogic(ScriptedLoadableModuleLogic):
       if percentage == 0:
         progressbar.reset()
       progressbar.value = percentage
-      progressbar.update()
     if progressmsg is not None:
       progressmsg.text = msg
-      progressmsg.update()
     
-  def process(self, input_image_list, output_dir, out_format, keep_gender=False, keep_age=False, progressbar=None, progressmsg=None):
+  def dedupCachePath(self):
     """
-    Run the processing algorithm.
-    Can be used without GUI widget.
-    :param inputVolume: volume to be thresholded
-    :param outputVolume: thresholding result
-    :param imageThreshold: values above/below this threshold will be set to 0
-    :param invert: if True then values above the threshold will be set to 0, otherwise values below are set to 0
-    :param showResult: show output volume in slice viewers
+    Duplicate cache of the module (see DedupCache), shared by all the batches run in Slicer.
     """
-    self.process_cont = True
-    if input_image_list is None or output_dir is None or out_format is None:
-      return
+    return os.path.join(slicer.app.cachePath, "SlicerBatchAnonymize", "dedup_cache.sqlite")
 
-    if len(input_image_list) == 0 or not output_dir.exists():
-      raise ValueError("Input or output specified is invalid")
-
-    
-    import time
-    startTime = time.time()
-    logging.info('Processing started')
+  def pseudonymStorePath(self):
+    """
+    Pseudonym store of the module (see PseudonymStore), next to the Slicer settings.
+    """
+    return os.path.join(os.path.dirname(slicer.app.slicerUserSettingsFilePath), "SlicerBatchAnonymize", "pseudonyms.sqlite")
 
-    crosswalk = []
-    error_files = []
-    # read the input directory for dicoms,
+  def openDatabase(self):
+    """
+    Return the Slicer DICOM database, opening (or creating) it at the location stored in the settings.
+    """
     slicerdb = slicer.dicomDatabase
     if not slicerdb.isOpen:
         # Get the directory path for the Slicer database, and try to open it.
@@ -481,168 +839,352 @@ class SlicerBatchAnonymizeLogic(ScriptedLoadableModuleLogic):
           raise OSError('Slicer DICOM database cannot be accessed/generated. Tried at: {}'.format(databaseDirectory))
         else:
           logging.info("Generated Slicer DICOM Database at: {}".format(databaseDirectory))
+    return slicerdb
 
+  def importToDatabase(self, slicerdb, input_image_list):
+    """
+    Import all the input directories into the DICOM database, IMPORT_CHUNK_SIZE files at a time
+    so that a large directory can be paused or canceled too.
+    """
     stage = "Importing DICOM Data to database"
-    self.reportProgress(stage, 0, progressbar, progressmsg)
-    #progress = qt.QProgressDialog("Importing DICOM Data to database", "Abort Load", 0, len(input_image_list))
-    #progress.reset()
-    #progress.setWindowModality(qt.Qt.WindowModal)
-    for idx, imgpath in enumerate(list(input_image_list.keys())):
-      self.reportProgress(stage, (idx+1)*100.0/len(input_image_list), progressbar, progressmsg)
-      if self.process_cont == False:
-        self.reportProgress("Process canceled", 0, progressbar, progressmsg)
-        break      
-      #progress.setValue(idx+1)
-      # if progress.wasCanceled:
-      #   break
-      dutils.importDicom( imgpath, slicerdb)
-    # progress.setValue(len(input_image_list))
-    # progress.reset()
+    self.reportProgress(stage, 0)
+    indexer = ctk.ctkDICOMIndexer()
+    indexer.database = slicerdb
+    canceled = False
+    for idx, imgpath in enumerate(input_image_list.paths()):
+      self.reportProgress(stage, (idx+1)*100.0/len(input_image_list))
+      try:
+        with os.scandir(str(imgpath)) as it:
+          files = sorted(e.path for e in it if e.is_file())
+      except OSError as e:
+        logging.warning("Cannot read directory {}: {}".format(imgpath, e))
+        continue
+      for start in range(0, len(files), self.IMPORT_CHUNK_SIZE):
+        if self.isCanceled():
+          canceled = True
+          break
+        indexer.addListOfFiles(files[start:start+self.IMPORT_CHUNK_SIZE])
+        indexer.waitForImportFinished()
+      if canceled:
+        self.reportProgress("Process canceled", 0)
+        break
     print("Done importing to Slicer DICOM Database")
-    #del progress
-    self.reportProgress("Done importing to Slicer DICOM Database", 0, progressbar, progressmsg)
-    slicer.app.processEvents()
-    # # progress.setWindowModality(qt.Qt.WindowModal)
-    stage = "Anonymizing and Exporting"
-    self.reportProgress(stage, 0, progressbar, progressmsg)
-    self.process_cont = True
-    scalarVolumeReader = DICOMScalarVolumePlugin.DICOMScalarVolumePluginClass()
-    slicer.app.processEvents()
-    #slicer.progressWindow = slicer.util.createProgressDialog(parent=slicer.util.mainWindow(),windowTitle='Anonymizing and exporting')
-    idx = 0
+    self.reportProgress("Done importing to Slicer DICOM Database", 0)
+
+  def collectSeriesFromDatabase(self, slicerdb, input_image_list):
+    """
+    Walk patients, studies and series of the database and keep the series stored in one of the input directories.
+    :return: list of dicts with "patient", "study", "series", "files", "imgpath", "header" and "groups"
+    """
+    series_list = []
+    for patient in slicerdb.patients():
+      for study in slicerdb.studiesForPatient(patient):
+        for series in slicerdb.seriesForStudy(study):
+          files = slicerdb.filesForSeries(series)
+          imgpath =  Path(files[0]).parent
+          if imgpath in input_image_list:
+            # One header read per file, the first one gives the tags instead of a database lookup per tag
+            header, groups = DicomHeaders.readSeries(files)
+            if header is None:
+              logging.warning("Cannot read the DICOM header of {}".format(files[0]))
+              header = DicomHeaders.SeriesHeader("", "", series, "", "", "", "")
+            series_list.append({"patient": patient, "study": study, "series": series, "files": files, "imgpath": imgpath, "header": header,
+                                "groups": groups})
+    return series_list
+
+  def process(self, input_image_list, output_dir, out_format, keep_gender=False, keep_age=False, progressbar=None, progressmsg=None, num_workers=1, direct=False, temp_database=False, header_only=False, resume=False, show_timings=False, memory_limit_mb=0, writer_options=None, dedup_cache=None, duplicate_mode="link", pseudonym_store=None,
+              archive_format=None, archive_max_series=0, archive_max_mb=0, pipeline_depth=1, session=False, state_dir=None):
+    """
+    Run the processing algorithm.
+    Can be used without GUI widget.
+    :param input_image_list: Crosswalk of the series directories and their output names
+    :param output_dir: directory the anonymized files and the crosswalk are written to
+    :param out_format: output extension, e.g. ".nii.gz" or ".dcm"
+    :param keep_gender: keep the PatientSex tag (DICOM output)
+    :param keep_age: keep the age related tags, birth date is shifted (DICOM output)
+    :param num_workers: number of worker processes used to export non-DICOM formats.
+      With 1 (default) the series are loaded and saved in the scene one at a time.
+    :param direct: group the files of the input directories into series from their headers
+      instead of importing them into the Slicer DICOM database
+    :param temp_database: import into a scratch DICOM database created for this run and deleted
+      at the end, instead of the persistent Slicer DICOM database. Ignored with direct.
+    :param header_only: for DICOM output, anonymize by rewriting the headers of the source files.
+      Pixel data is copied as is (compressed transfer syntaxes are kept) instead of being loaded and re-exported.
+    :param resume: continue the batch recorded in the journal of output_dir, skipping the series it completed.
+      Otherwise the journal and the output files of a previous run are overwritten.
+    :param show_timings: add the throughput summary to the progress message. The time spent per stage
+      and per series is always written to timings.json and timings.csv in output_dir.
+    :param memory_limit_mb: resident memory ceiling in MB, 0 for none. Worker processes above it are
+      restarted. In the scene the memory is released when it is exceeded, and the batch stops if it
+      stays above: it can be resumed after restarting Slicer.
+    :param writer_options: ImageWriter.WriterOptions, compression of the non-DICOM outputs.
+      The Slicer defaults (compressed) if None.
+    :param dedup_cache: sqlite file of the series already anonymized (see DedupCache), their copies reuse
+      the first output instead of being loaded and exported. None to export every series.
+    :param duplicate_mode: "link" to hard link (or copy) the first output for each copy, "record" to only
+      record the copy in the crosswalk
+    :param pseudonym_store: sqlite file of the pseudonyms kept across batches (see PseudonymStore).
+      None for new pseudonyms in every batch.
+    :param archive_format: ".zip" or ".tar" to store the outputs in archives of output_dir instead of one
+      file or folder per series (see ArchiveWriter), None for no archive
+    :param archive_max_series: series per archive, 0 for no limit
+    :param archive_max_mb: size in MB above which a new archive is started, 0 for no limit
+    :param pipeline_depth: when the series are exported outside of the scene without worker processes,
+      the next series is read while the current one is written, with at most this many series waiting
+      between two steps. 0 exports the series one after the other.
+    :param session: keep the journal and the other outputs open after the batch, the next batches
+      with session are appended to them until endSession() (watch mode). The other parameters of
+      the first batch of a session apply to the whole session.
+    :param state_dir: directory of the journal, which links the original identifiers to their pseudonyms
+      and must stay outside output_dir. BatchJournal.defaultStateDir() (next to output_dir) if None.
+    """
+    self.controller.reset()
+    if input_image_list is None or output_dir is None or out_format is None:
+      return
+
+    if len(input_image_list) == 0 or not output_dir.exists():
+      raise ValueError("Input or output specified is invalid")
+
+    # Progress is published by the batch and shown from this timer, at most max_rate times per second
+    progressTimer = qt.QTimer()
+    progressTimer.setInterval(int(1000 * self.progressChannel.interval))
+    progressTimer.connect('timeout()', lambda: self.showProgress(progressbar, progressmsg))
+    progressTimer.start()
     try:
-      patient_db = []
-      import pydicom
-      import random
-      for patient in slicerdb.patients():
-        patientid_ded = pydicom.uid.generate_uid(None)
-        #create an offset in days (3-6) months to add to birth date when age is requested to be kept in tact.
-        random_offset = random.choice([-5, -4, -3, 3, 4, 5])*30
-        for study in slicerdb.studiesForPatient(patient):
-          studyid_ded = pydicom.uid.generate_uid(None)
-          for series in slicerdb.seriesForStudy(study):
-            series_ded = pydicom.uid.generate_uid(None)
-            if self.process_cont == False:
-              raise Exception("User stopped processing")            
-            files = slicerdb.filesForSeries(series)
-            imgpath =  Path(files[0]).parent
-            
-            if imgpath in input_image_list:
-              print("Will export this: " + str(imgpath))
-              gender = slicerdb.fileValue(files[0], "0010,0040")
-              agestr = slicerdb.fileValue(files[0], "0010, 1010")
-              dob = slicerdb.fileValue(files[0], "0010,0030")
-              if dob!="":
-                dob_dt = datetime.strptime(dob, '%Y%m%d')
-                dob_dt = dob_dt + timedelta(days=random_offset)
-              studydate = slicerdb.fileValue(files[0], "0008,0020")
-              if agestr == '' and dob!= "" and studydate !="":
-                  study_dt = datetime.strptime(studydate, '%Y%m%d')
-                  age = int((study_dt - dob_dt).days/365)
-                  agestr =  str(age).zfill(3)+'Y'
-              self.reportProgress(stage + " : " + str(imgpath), (idx+1)*100.0/len(input_image_list), progressbar, progressmsg)
-              slicer.app.processEvents()
-              try:
-                loadable = scalarVolumeReader.examineForImport([files])[0]
-                image_node = scalarVolumeReader.load(loadable)
-                if image_node.GetImageData().GetDimensions()[2] == 1:
-                  logging.warning("Image has only one slice, ignoring")
-                  slicer.mrmlScene.RemoveNode(image_node)
-                  continue
-                if out_format == ".dcm":
-                  sdict = {}
-                  sdict['PatientID'] = patientid_ded
-                  sdict['StudyID'] = studyid_ded
-                  sdict['SeriesID'] = series_ded
-                  #filename = input_image_list[imgpath][1] + out_format
-                  #out_path = output_dir / filename
-                  output_folder = output_dir / input_image_list[imgpath][1]
-                  output_folder.mkdir(parents=True, exist_ok=True)
-                  # Create patient and study and put the volume under the study
-                  shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-                  patientItemID = shNode.CreateSubjectItem(shNode.GetSceneItemID(), input_image_list[imgpath][1])
-                  studyItemID = shNode.CreateStudyItem(patientItemID, input_image_list[imgpath][1]+'_Study')
-                  volumeShItemID = shNode.GetItemByDataNode(image_node)
-                  shNode.SetItemParent(volumeShItemID, studyItemID)
-                  exporter = DICOMScalarVolumePlugin.DICOMScalarVolumePluginClass()
-                  exportables = exporter.examineForExport(volumeShItemID)
-                  if len(exportables) == 0:
-                    logging.error("Cannot export this image (either 1 image or no image in the series)")
-                    slicer.mrmlScene.RemoveNode(image_node)
-                    continue
-                  for exp in exportables:
-                    exp.directory = output_folder
-                    exp.setTag("PatientID", patientid_ded)
-                    exp.setTag("StudyInstanceUID", studyid_ded)
-                    exp.setTag("SeriesInstanceUID", series_ded)
-                    exp.setTag("StudyTime", "")
-                    exp.setTag("ContentDate", "")
-                    exp.setTag("ContentTime", "")
-                    exp.setTag("StudyDate", "")
-                    if keep_age:
-                      exp.setTag("PatientAge", agestr)
-                      exp.setTag("StudyDate", studydate)
-                      exp.setTag("PatientBirthDate", dob_dt.strftime("%Y%m%d"))
-                      sdict['StudyDate'] = studydate
-                      sdict['PatientAge'] = agestr
-                      sdict["PatientBirthDate"] = dob_dt.strftime("%Y%m%d")
-                    if keep_gender:
-                      exp.setTag("PatientSex", gender)
-                      sdict['Gender'] = gender
-                  exporter.export(exportables)
-                  slicer.mrmlScene.RemoveNode(shNode)
-                  out_path = output_folder / ('ScalarVolume_' + str(exportables[0].subjectHierarchyItemID))
-                  patient_db.append(sdict)
-                else:
-                  filename = input_image_list[imgpath][1] + out_format
-                  out_path = output_dir / filename
-                  slicer.util.saveNode(image_node, str(out_path))
-              except Exception as e:
-                logging.error("Error reading/writing file: {}\n{}".format(imgpath,e))
-                if image_node is not None:
-                  slicer.mrmlScene.RemoveNode(image_node)
-                error_files.append(imgpath)
-              else:
-                slicer.mrmlScene.RemoveNode(image_node)
-                crosswalk.append( {"input": imgpath, "output" : out_path})
-              idx+=1
+      if temp_database and not direct:
+        # The scratch database only holds this batch, so lookups do not slow down as runs accumulate.
+        # It replaces slicer.dicomDatabase while it is open so the DICOM plugins use it too.
+        databaseDirectory = tempfile.mkdtemp(prefix="SlicerBatchAnonymizeDB_")
+        logging.info("Using scratch DICOM database at: {}".format(databaseDirectory))
+        try:
+          with dutils.TemporaryDICOMDatabase(databaseDirectory) as slicerdb:
+            if slicerdb is None or not slicerdb.isOpen:
+              raise OSError('Scratch DICOM database cannot be generated at: {}'.format(databaseDirectory))
+            self.runBatch(input_image_list, output_dir, out_format, keep_gender, keep_age,
+                          num_workers, direct, header_only, resume, show_timings, memory_limit_mb, writer_options,
+                          dedup_cache, duplicate_mode, pseudonym_store, archive_format, archive_max_series, archive_max_mb,
+                          pipeline_depth, session, state_dir, slicerdb)
+        finally:
+          shutil.rmtree(databaseDirectory, ignore_errors=True)
+      else:
+        self.runBatch(input_image_list, output_dir, out_format, keep_gender, keep_age,
+                      num_workers, direct, header_only, resume, show_timings, memory_limit_mb, writer_options,
+                      dedup_cache, duplicate_mode, pseudonym_store, archive_format, archive_max_series, archive_max_mb,
+                      pipeline_depth, session, state_dir)
+    finally:
+      progressTimer.stop()
+      # Last message of the batch
+      self.showProgress(progressbar, progressmsg)
+
+  def runBatch(self, input_image_list, output_dir, out_format, keep_gender, keep_age,
+               num_workers, direct, header_only, resume, show_timings=False, memory_limit_mb=0, writer_options=None,
+               dedup_cache=None, duplicate_mode="link", pseudonym_store=None, archive_format=None, archive_max_series=0,
+               archive_max_mb=0, pipeline_depth=1, session=False, state_dir=None, slicerdb=None):
+    """
+    Anonymize and export the batch, see process() for the parameters.
+    :param slicerdb: DICOM database to import into, the Slicer DICOM database if None
+    """
+    logging.info('Processing started')
+    runner = self.sessionRunner if session else None
+    if runner is None:
+      runner = self.createRunner(output_dir, out_format, keep_gender, keep_age, num_workers, header_only, show_timings,
+                                 memory_limit_mb, writer_options, dedup_cache, duplicate_mode, pseudonym_store,
+                                 archive_format, archive_max_series, archive_max_mb, pipeline_depth, direct, state_dir)
+      if session:
+        runner.open(resume)
+        self.sessionRunner = runner
+    timings = runner.timings
+
+    if direct:
+      # Group the files of the selected folders by series from their headers, no database involved
+      stage = "Reading DICOM headers"
+      self.reportProgress(stage, 0)
+      with timings.stage("read headers"):
+        series_list = DicomHeaders.collectSeriesFromFiles(input_image_list.paths(), self.isCanceled)
+      logging.info("Found {} series in {} directories".format(len(series_list), len(input_image_list)))
+    else:
+      # read the input directory for dicoms,
+      if slicerdb is None:
+        slicerdb = self.openDatabase()
+      with timings.stage("import"):
+        self.importToDatabase(slicerdb, input_image_list)
+      with timings.stage("query database"):
+        series_list = self.collectSeriesFromDatabase(slicerdb, input_image_list)
+
+    try:
+      runner.run(series_list, input_image_list.names(), resume)
     except Exception as e:
-      self.reportProgress("Process canceled", 0, progressbar, progressmsg)
+      self.reportProgress("Process canceled", 0)
       logging.error("Export aborted: {}".format(e))
-    #slicer.progressWindow.close()
+    logging.info('Processing completed in {0:.2f} seconds'.format(timings.elapsed()))
 
-    if len(crosswalk) > 0:
-      try:
-        with open(output_dir/"crosswalk.csv", "w", encoding="utf-8") as f:
-          w = csv.DictWriter(f, crosswalk[0].keys())
-          w.writeheader()
-          w.writerows(crosswalk)
-      except Exception as e:
-        logging.error("Failed to write the crosswalk file")
-        logging.error(e)
-        slicer.util.errorDisplay("Failed to write the crosswalk file")
-
-    if len(patient_db) > 0: 
-      try:
-        with open(output_dir/"details.csv", "w", encoding="utf-8") as f:
-          w = csv.DictWriter(f, patient_db[0].keys())
-          w.writeheader()
-          w.writerows(patient_db)
-      except Exception as e:
-        logging.error("Failed to write the patientdb file")
-        logging.error(e)
-        slicer.util.errorDisplay("Failed to write the patient db file")
-
-    if len(error_files) > 0:
-      try:
-        with open(output_dir / "files_not_converted.txt", "w") as f:
-          for e in error_files:
-            f.write(str(e)+"\n")
-      except IOError:
-        logging.error("Failed to write the list of failed files")
-        slicer.util.errorDisplay("Failed to write the list of failed files")
-    stopTime = time.time()
-    logging.info('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
+  def createRunner(self, output_dir, out_format, keep_gender, keep_age, num_workers, header_only, show_timings,
+                   memory_limit_mb, writer_options, dedup_cache, duplicate_mode, pseudonym_store, archive_format,
+                   archive_max_series, archive_max_mb, pipeline_depth, direct, state_dir=None):
+    """
+    BatchRunner reporting to the module, see process() for the parameters.
+    """
+    runner = BatchRunner(output_dir, out_format, keep_gender, keep_age, num_workers, header_only)
+    runner.progressCallback = self.reportProgress
+    runner.liveTimings = show_timings
+    runner.cancelCallback = self.isCanceled
+    runner.controller = self.controller
+    runner.eventPump = self.progressChannel.pumpIfDue
+    runner.memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb > 0 else None
+    runner.releaseMemory = self.releaseMemory
+    if writer_options is not None:
+      runner.writer_options = writer_options
+    runner.dedup_cache = dedup_cache
+    runner.duplicateMode = duplicate_mode
+    runner.pseudonym_store = pseudonym_store
+    runner.archive_format = archive_format
+    runner.archive_max_series = archive_max_series
+    runner.archive_max_bytes = archive_max_mb * 1024 * 1024
+    runner.pipeline_depth = pipeline_depth
+    runner.state_dir = state_dir
+    # DICOM export through the subject hierarchy always runs in the scene. Other formats are loaded
+    # and saved in the scene unless they can be read outside of it (worker processes, or no database).
+    if out_format == ".dcm":
+      use_scene = not header_only
+    else:
+      use_scene = num_workers <= 1 and not direct
+    if use_scene:
+      runner.sceneExport = lambda series_info, name, dcm_tags: self.exportSeriesInScene(series_info, runner.exportDir(), name, out_format, dcm_tags,
+                                                                                        runner.timings, runner.writer_options)
+    return runner
+
+  def endSession(self):
+    """
+    Close the outputs kept open by the batches run with session, see process().
+    """
+    if self.sessionRunner is not None:
+      self.sessionRunner.close()
+      self.sessionRunner = None
+
+  def exportSeriesInScene(self, series_info, output_dir, name, out_format, dcm_tags, timings=None, writer_options=None):
+    """
+    Load a series in the scene and export it, as a DICOM series through the subject hierarchy
+    or to a single file with saveNode.
+    :param timings: BatchTimings the time of each step is added to
+    :param writer_options: ImageWriter.WriterOptions of the non-DICOM outputs
+    :return: (status, output path, message), status is one of SeriesWorker.STATUS_*
+    """
+    if timings is None:
+      timings = BatchTimings()
+    imgpath = series_info["imgpath"]
+    files = series_info["files"]
+    scalarVolumeReader = DICOMScalarVolumePlugin.DICOMScalarVolumePluginClass()
+    image_node = None
+    sh_item_ids = []
+    try:
+      with timings.stage("examine"):
+        loadable = scalarVolumeReader.examineForImport([files])[0]
+      self.checkpoint()
+      with timings.stage("load"):
+        image_node = scalarVolumeReader.load(loadable)
+      self.checkpoint()
+      if image_node is None:
+        return SeriesWorker.STATUS_ERROR, None, "Cannot load the series"
+      if image_node.GetImageData().GetDimensions()[2] == 1:
+        logging.warning("Image has only one slice, ignoring")
+        return SeriesWorker.STATUS_SKIPPED, None, "Image has only one slice"
+      if out_format == ".dcm":
+        #filename = name + out_format
+        #out_path = output_dir / filename
+        output_folder = output_dir / name
+        output_folder.mkdir(parents=True, exist_ok=True)
+        # Create patient and study and put the volume under the study
+        with timings.stage("subject hierarchy"):
+          shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+          patientItemID = shNode.CreateSubjectItem(shNode.GetSceneItemID(), name)
+          sh_item_ids.append(patientItemID)
+          studyItemID = shNode.CreateStudyItem(patientItemID, name+'_Study')
+          sh_item_ids.append(studyItemID)
+          volumeShItemID = shNode.GetItemByDataNode(image_node)
+          shNode.SetItemParent(volumeShItemID, studyItemID)
+        exporter = DICOMScalarVolumePlugin.DICOMScalarVolumePluginClass()
+        with timings.stage("examine for export"):
+          exportables = exporter.examineForExport(volumeShItemID)
+        if len(exportables) == 0:
+          logging.error("Cannot export this image (either 1 image or no image in the series)")
+          return SeriesWorker.STATUS_SKIPPED, None, "Cannot export this image"
+        for exp in exportables:
+          exp.directory = output_folder
+          for tag, value in dcm_tags.items():
+            exp.setTag(tag, value)
+        self.checkpoint()
+        with timings.stage("export"):
+          exporter.export(exportables)
+        out_path = output_folder / ('ScalarVolume_' + str(exportables[0].subjectHierarchyItemID))
+        del exportables
+      else:
+        filename = name + out_format
+        out_path = output_dir / filename
+        with timings.stage("save"):
+          self.saveVolume(image_node, out_path, writer_options)
+    except SeriesWorker.JobCanceled as e:
+      return SeriesWorker.STATUS_CANCELED, None, str(e)
+    except Exception as e:
+      logging.error("Error reading/writing file: {}\n{}".format(imgpath,e))
+      return SeriesWorker.STATUS_ERROR, None, str(e)
+    finally:
+      # Whatever happened, nothing of the series stays in the scene
+      with timings.stage("cleanup"):
+        self.removeSeriesFromScene(image_node, sh_item_ids)
+    return SeriesWorker.STATUS_DONE, out_path, ""
+
+  def removeSeriesFromScene(self, image_node, sh_item_ids=()):
+    """
+    Remove a series loaded by exportSeriesInScene(): the subject hierarchy items created for it,
+    the volume node with its display and storage nodes. The image data is released even if a
+    reference to the volume node is still held somewhere.
+    """
+    scene = slicer.mrmlScene
+    nodes = []
+    if image_node is not None:
+      nodes = [image_node.GetNthDisplayNode(i) for i in range(image_node.GetNumberOfDisplayNodes())]
+      nodes.append(image_node.GetStorageNode())
+      image_node.SetAndObserveImageData(None)
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(scene)
+    for itemID in reversed(sh_item_ids):
+      if shNode.GetItemParent(itemID) != shNode.GetInvalidItemID():
+        shNode.RemoveItem(itemID)
+    for node in [image_node] + nodes:
+      if node is not None and node.GetScene() is not None:
+        scene.RemoveNode(node)
+
+  def saveVolume(self, image_node, out_path, writer_options=None):
+    """
+    Save a volume node to a file with the compression options, see ImageWriter.WriterOptions.
+    """
+    if writer_options is None:
+      writer_options = WriterOptions()
+    if writer_options.parallel(out_path):
+      # Compressed on several threads once written
+      written_path = uncompressedPath(out_path)
+      if not slicer.util.saveNode(image_node, str(written_path), {"useCompression": 0}):
+        raise OSError("Cannot write {}".format(written_path))
+      compressWrittenFile(written_path, out_path, writer_options)
+      return
+    properties = {"useCompression": 1 if writer_options.compress(out_path) else 0}
+    if writer_options.level > 0:
+      # The storage nodes only offer three compression presets
+      if writer_options.level <= 3:
+        properties["compressionParameter"] = "CompressionParameterFastest"
+      elif writer_options.level <= 6:
+        properties["compressionParameter"] = "CompressionParameterNormal"
+      else:
+        properties["compressionParameter"] = "CompressionParameterMinimumSize"
+    if not slicer.util.saveNode(image_node, str(out_path), properties):
+      raise OSError("Cannot write {}".format(out_path))
+
+  def releaseMemory(self):
+    """
+    Free what the scene may still hold after the series were removed, when over the memory ceiling.
+    """
+    slicer.mrmlScene.ClearUndoStack()
+    # Objects scheduled for deletion are deleted by the event loop
+    slicer.app.processEvents()
 
     # for idx, imgpath in enumerate(input_image_list):
     #   progress.setValue(idx)
@@ -686,6 +1228,8 @@ class SlicerBatchAnonymizeTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_SlicerBatchAnonymize1()
+    self.setUp()
+    self.test_SlicerBatchAnonymizeSynthetic()
 
   def test_SlicerBatchAnonymize1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -711,4 +1255,35 @@ class SlicerBatchAnonymizeTest(ScriptedLoadableModuleTest):
     logic.process(None, None, None, None, None)
 
     self.delayDisplay('Test passed')
+
+  def test_SlicerBatchAnonymizeSynthetic(self):
+    """ Anonymize a small synthetic batch mixing transfer syntaxes, with single slice series that must be skipped.
+    Larger batches and throughput baselines are run with SlicerBatchAnonymizeLib.Benchmark.
+    """
+    from SlicerBatchAnonymizeLib import SyntheticData
+    from SlicerBatchAnonymizeLib.BatchJournal import BatchJournal
+
+    self.delayDisplay("Starting the synthetic batch test")
+    work_dir = Path(tempfile.mkdtemp(prefix="SlicerBatchAnonymizeTest_"))
+    try:
+      summary = SyntheticData.generateDataset(work_dir / "input", "small")
+      output_dir = work_dir / "output"
+      output_dir.mkdir()
+      input_image_list = Crosswalk()
+      for result in DirectoryScanner(work_dir / "input", "*.dcm"):
+        input_image_list.add(result.path, first_file=result.first_file)
+      input_image_list.assignNames("File")
+
+      logic = SlicerBatchAnonymizeLogic()
+      logic.process(input_image_list, output_dir, ".nii.gz", direct=True)
+
+      records = BatchJournal.loadRecords(output_dir).values()
+      self.assertEqual(len(records), summary["num_series"])
+      self.assertEqual(sum(1 for r in records if r["status"] == SeriesWorker.STATUS_SKIPPED), summary["num_single_slice"])
+      self.assertEqual(sum(1 for r in records if r["status"] == SeriesWorker.STATUS_DONE),
+                       summary["num_series"] - summary["num_single_slice"])
+    finally:
+      shutil.rmtree(str(work_dir), ignore_errors=True)
+
+    self.delayDisplay('Test passed')
  
\ No newline at end of file
@@ -0,0 +1,201 @@
+import os
+import re
+import csv
+import tarfile
+import zipfile
+import logging
+from pathlib import Path
+
+__all__ = ["ArchiveWriter", "ARCHIVE_FORMATS", "readArchiveIndex", "readArchiveMember"]
+
+ARCHIVE_FORMATS = [".zip", ".tar"]
+
+#
+# ArchiveWriter
+#
+
+class ArchiveWriter:
+  """
+  Store the outputs of a batch in a sequence of zip or tar archives (archive_0001.zip, ...) instead
+  of one file or folder per series, starting a new archive after max_series series or max_bytes.
+  Members are stored uncompressed (the outputs are compressed images or DICOM files), so each one
+  is a contiguous range of its archive: archive_index.csv gives the input directory, archive, offset
+  and size of every member, and a single series can be read without unpacking the archive (see
+  readArchiveMember()). The input column joins the index with the rows of crosswalk.csv.
+  Series are added once written, the caller then removes the written files. Zip archives are only
+  complete once closed, tar archives can be read up to the last series added: when resuming, zip
+  archives a crash left unfinished are removed with their index rows, and listed in discarded so
+  their series are exported again.
+  """
+
+  INDEX_NAME = "archive_index.csv"
+  INDEX_FIELDS = ["name", "input", "archive", "member", "offset", "size"]
+
+  def __init__(self, output_dir, archive_format=".zip", max_series=0, max_bytes=0, resume=False):
+    """
+    :param max_series: series per archive, 0 for no limit
+    :param max_bytes: size of an archive above which the next series goes to a new one, 0 for no limit
+    :param resume: keep the archives and the index of a previous run, new series go to new archives
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+      raise ValueError("Unknown archive format {}".format(archive_format))
+    self.output_dir = Path(output_dir)
+    self.archive_format = archive_format
+    self.max_series = max_series
+    self.max_bytes = max_bytes
+    self._number = 0
+    # Names of the unfinished archives removed when resuming
+    self.discarded = set()
+    index_path = self.output_dir / self.INDEX_NAME
+    if resume:
+      pattern = re.compile(r"archive_(\d+)" + re.escape(archive_format) + "$")
+      archives = [(int(m.group(1)), p) for m, p in ((pattern.match(p.name), p) for p in self.output_dir.iterdir()) if m]
+      self._number = max((number for number, p in archives), default=0)
+      if archive_format == ".zip":
+        self.discarded = set(p.name for number, p in archives if not zipfile.is_zipfile(str(p)))
+      if self.discarded:
+        self._discard(index_path)
+      if index_path.exists() and self._readFields(index_path) != self.INDEX_FIELDS:
+        # Index of an earlier version, without the input column
+        self._rewriteIndex(index_path, self._readRows(index_path))
+    append = resume and index_path.exists()
+    self._index_file = open(str(index_path), "a" if append else "w", encoding="utf-8", newline="")
+    self._index = csv.DictWriter(self._index_file, self.INDEX_FIELDS)
+    if not append:
+      self._index.writeheader()
+    self._archive = None
+    self._archive_path = None
+    self._num_series = 0
+
+  def _discard(self, index_path):
+    """
+    Remove the discarded archives and their rows of the index. The index is replaced atomically.
+    """
+    for name in sorted(self.discarded):
+      logging.warning("Removing unfinished archive {}, its series are exported again".format(name))
+      (self.output_dir / name).unlink()
+    if index_path.exists():
+      self._rewriteIndex(index_path, [row for row in self._readRows(index_path) if row["archive"] not in self.discarded])
+
+  @staticmethod
+  def _readFields(index_path):
+    with open(str(index_path), encoding="utf-8", newline="") as f:
+      return csv.DictReader(f).fieldnames
+
+  @staticmethod
+  def _readRows(index_path):
+    with open(str(index_path), encoding="utf-8", newline="") as f:
+      return list(csv.DictReader(f))
+
+  def _rewriteIndex(self, index_path, rows):
+    """
+    Replace the index atomically.
+    """
+    temp_path = index_path.with_name(index_path.name + ".tmp")
+    with open(str(temp_path), "w", encoding="utf-8", newline="") as f:
+      writer = csv.DictWriter(f, self.INDEX_FIELDS, restval="", extrasaction="ignore")
+      writer.writeheader()
+      writer.writerows(rows)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(str(temp_path), str(index_path))
+
+  def _open(self):
+    self._number += 1
+    self._archive_path = self.output_dir / ("archive_%04d" % self._number + self.archive_format)
+    if self.archive_format == ".zip":
+      self._archive = zipfile.ZipFile(str(self._archive_path), "w", zipfile.ZIP_STORED, allowZip64=True)
+    else:
+      self._archive = tarfile.open(str(self._archive_path), "w")
+    self._num_series = 0
+    logging.info("Writing archive {}".format(self._archive_path))
+
+  def _size(self):
+    return self._archive.fp.tell() if self.archive_format == ".zip" else self._archive.offset
+
+  def _full(self):
+    if self.max_series and self._num_series >= self.max_series:
+      return True
+    return bool(self.max_bytes) and self._size() >= self.max_bytes
+
+  def _addFile(self, path, member):
+    """
+    :return: offset of the member data in the archive
+    """
+    if self.archive_format == ".zip":
+      self._archive.write(str(path), member)
+      info = self._archive.getinfo(member)
+      # Local header: 30 bytes, the name and the extra field
+      self._archive.fp.flush()
+      with open(str(self._archive_path), "rb") as f:
+        f.seek(info.header_offset + 26)
+        header = f.read(4)
+      return info.header_offset + 30 + int.from_bytes(header[:2], "little") + int.from_bytes(header[2:], "little")
+    info = self._archive.gettarinfo(str(path), member)
+    with open(str(path), "rb") as f:
+      self._archive.addfile(info, f)
+    # The data, padded to a whole number of blocks, ends the archive
+    padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return self._archive.offset - padded
+
+  def add(self, name, path, input=""):
+    """
+    Add the output file or folder of a series. A folder is stored under the name of the series,
+    a file under its own name.
+    :param input: input directory of the series, as in crosswalk.csv
+    :return: (archive path, member): the member is the file, or the folder followed by "/"
+    """
+    if self._archive is None or self._full():
+      self.close(index=False)
+      self._open()
+    path = Path(path)
+    if path.is_dir():
+      member = name + "/"
+      files = sorted(p for p in path.rglob("*") if p.is_file())
+      members = [member + p.relative_to(path).as_posix() for p in files]
+    else:
+      member = path.name
+      files = [path]
+      members = [member]
+    for f, m in zip(files, members):
+      offset = self._addFile(f, m)
+      self._index.writerow({"name": name, "input": str(input), "archive": self._archive_path.name, "member": m,
+                            "offset": offset, "size": os.path.getsize(str(f))})
+    self._index_file.flush()
+    self._num_series += 1
+    return self._archive_path, member
+
+  def addReference(self, name, archive, member, input=""):
+    """
+    Index a series stored under another name, e.g. a duplicate of a series already archived.
+    """
+    self._index.writerow({"name": name, "input": str(input), "archive": Path(archive).name, "member": member,
+                          "offset": "", "size": ""})
+    self._index_file.flush()
+
+  def close(self, index=True):
+    if self._archive is not None:
+      self._archive.close()
+      self._archive = None
+    if index and self._index_file is not None:
+      self._index_file.close()
+      self._index_file = None
+
+def readArchiveIndex(output_dir):
+  """
+  :return: dict of series name to the list of its index rows
+  """
+  rows = {}
+  with open(str(Path(output_dir) / ArchiveWriter.INDEX_NAME), encoding="utf-8", newline="") as f:
+    for row in csv.DictReader(f):
+      rows.setdefault(row["name"], []).append(row)
+  return rows
+
+def readArchiveMember(output_dir, row):
+  """
+  Read one member of an archive from its index row, without reading the rest of the archive.
+  :return: bytes of the member
+  """
+  with open(str(Path(output_dir) / row["archive"]), "rb") as f:
+    f.seek(int(row["offset"]))
+    return f.read(int(row["size"]))
@@ -0,0 +1,325 @@
+"""
+Command line entry point for batch anonymization, without the module GUI.
+
+With --direct the series are grouped from the DICOM headers and exported outside of the scene,
+so this runs in a plain Python interpreter with pydicom and SimpleITK (e.g. PythonSlicer):
+
+  PythonSlicer -m SlicerBatchAnonymizeLib.BatchCLI --direct --input /data/in --output /data/out --format .nii.gz
+
+Inside Slicer the SlicerBatchAnonymize logic is used, and the DICOM database can be used too:
+
+  Slicer --no-main-window --python-script /path/to/SlicerBatchAnonymizeLib/BatchCLI.py --input /data/in --output /data/out
+
+The compression of the outputs is a trade-off between speed and size, --benchmark-writers compares
+the formats, levels and threads on the first series of the input and writes output/writer_benchmark.csv:
+
+  PythonSlicer -m SlicerBatchAnonymizeLib.BatchCLI --input /data/in --output /tmp/bench --benchmark-writers
+
+The journal of a batch links the original identifiers to their pseudonyms, it is written to a state
+directory next to the output (/data/out.state, or --state-dir) so the output can be shared without it.
+
+A batch can be split across machines: every node runs the same command with --num-shards N and its own
+--shard-index, writing to output/shard_<k>_of_<N> (journal in <state dir>/shard_<k>_of_<N>), then
+--merge-shards combines the crosswalks in output, with the same --state-dir if one was given:
+
+  ... --input /data/in --output /data/out --num-shards 4 --shard-index 0
+  ... --output /data/out --merge-shards
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+from pathlib import Path
+
+if __package__ in (None, ""):
+  # Run as a script (Slicer --python-script), make the package importable
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SlicerBatchAnonymizeLib import DicomHeaders, ImageWriter, SeriesWorker, Sharding
+from SlicerBatchAnonymizeLib.BatchRunner import BatchRunner
+from SlicerBatchAnonymizeLib.Crosswalk import Crosswalk
+from SlicerBatchAnonymizeLib.DedupCache import DedupCache
+from SlicerBatchAnonymizeLib.DirectoryScanner import DirectoryScanner
+from SlicerBatchAnonymizeLib.FolderWatcher import FolderWatcher
+
+OUTPUT_FORMATS = [".nii", ".nii.gz", ".gipl", ".gipl.gz", ".nrrd", ".dcm"]
+
+def buildArgumentParser():
+  parser = argparse.ArgumentParser(description="Anonymize a batch of DICOM series.")
+  parser.add_argument("--input", help="Top directory of the DICOM series, searched recursively")
+  parser.add_argument("--output", required=True, help="Directory the anonymized series and the crosswalk are written to")
+  parser.add_argument("--format", default=".nii.gz", choices=OUTPUT_FORMATS, help="Output format (default: %(default)s)")
+  parser.add_argument("--patterns", default="*.dcm,*.dicom", help="Comma separated file name patterns of the DICOM files, "
+                      "matched case insensitively (default: %(default)s)")
+  naming = parser.add_mutually_exclusive_group()
+  naming.add_argument("--prefix", default="File", help="Output names are <prefix>_0001, <prefix>_0002, ... (default: %(default)s)")
+  naming.add_argument("--uuid", action="store_true", help="Use random UUIDs as output names")
+  naming.add_argument("--hash-secret-file", help="Use UUIDs derived from a keyed hash of the SeriesInstanceUID as output names, "
+                      "with the project secret read from this file. Repeated runs give the same names.")
+  parser.add_argument("--keep-age", action="store_true", help="Keep the age related tags (DICOM output)")
+  parser.add_argument("--keep-gender", action="store_true", help="Keep the PatientSex tag (DICOM output)")
+  parser.add_argument("--workers", type=int, default=1, help="Number of worker processes (default: %(default)s)")
+  parser.add_argument("--direct", action="store_true", help="Group the series from the DICOM headers, without the DICOM database. "
+                      "Required outside of Slicer.")
+  parser.add_argument("--temp-database", action="store_true", help="Import into a scratch DICOM database (Slicer only)")
+  parser.add_argument("--header-only", action="store_true", help="DICOM output: rewrite the headers, copy the pixel data as is")
+  parser.add_argument("--resume", action="store_true", help="Continue the batch recorded in the journal of the output directory")
+  parser.add_argument("--state-dir", help="Directory of the journal of the batch, which links the original identifiers to "
+                      "their pseudonyms and must stay outside the output directory (default: <output>.state)")
+  parser.add_argument("--memory-limit", type=int, default=0, help="Resident memory ceiling in MB per process, 0 for none. "
+                      "Workers above it are restarted, the batch stops if the main process stays above it (default: %(default)s)")
+  parser.add_argument("--compression-level", type=int, default=-1, choices=range(-1, 10), metavar="{-1..9}",
+                      help="Gzip level of the non-DICOM outputs, 1 fastest to 9 smallest, 0 for uncompressed data, "
+                      "-1 for the writer default (default: %(default)s)")
+  parser.add_argument("--compression-threads", type=int, default=1, help="Threads compressing each output file "
+                      "(default: %(default)s)")
+  parser.add_argument("--dedup-cache", help="sqlite file of the series already anonymized: copies of a series found again, "
+                      "in this batch or a later one, reuse its output instead of being exported. Entries made with other "
+                      "anonymization settings are dropped.")
+  parser.add_argument("--duplicates", default="link", choices=["link", "record"], help="With --dedup-cache: hard link (or "
+                      "copy) the first output for each duplicate, or only record it in the crosswalk (default: %(default)s)")
+  parser.add_argument("--dedup-max-entries", type=int, default=100000, help="With --dedup-cache: the least recently used "
+                      "entries above this number are evicted (default: %(default)s)")
+  parser.add_argument("--dedup-max-age", type=float, help="With --dedup-cache: entries older than this number of days "
+                      "are evicted")
+  parser.add_argument("--clear-dedup-cache", action="store_true", help="Empty the --dedup-cache file before the run")
+  parser.add_argument("--pseudonym-store", help="sqlite file of the pseudonyms of the patients, studies and series: every "
+                      "batch run with the same file reuses them, with the same date shift per patient")
+  parser.add_argument("--archive", choices=["zip", "tar"], help="Store the outputs in archives of the output directory "
+                      "(archive_0001.zip, ...) instead of one file or folder per series, with archive_index.csv giving the "
+                      "archive, offset and size of every file")
+  parser.add_argument("--archive-max-series", type=int, default=0, help="With --archive: series per archive, 0 for no "
+                      "limit (default: %(default)s)")
+  parser.add_argument("--archive-max-size", type=int, default=0, help="With --archive: size in MB above which a new archive "
+                      "is started, 0 for no limit (default: %(default)s)")
+  parser.add_argument("--pipeline-depth", type=int, default=1, help="Without worker processes, read the next series while "
+                      "the current one is written, with at most this many series waiting between two steps. 0 processes "
+                      "the series one after the other (default: %(default)s)")
+  parser.add_argument("--benchmark-writers", action="store_true", help="Write the first series of the input in every "
+                      "format and compression setting, report the time and size in writer_benchmark.csv and exit")
+  parser.add_argument("--num-shards", type=int, default=1, help="Split the batch into this many shards (default: %(default)s)")
+  parser.add_argument("--shard-index", type=int, default=0, help="Shard processed by this run, from 0 to num-shards - 1")
+  parser.add_argument("--merge-shards", action="store_true", help="Merge the crosswalk, details and error files of the shards "
+                      "in the output directory and exit")
+  parser.add_argument("--watch", action="store_true", help="Keep running and anonymize the series directories as they arrive "
+                      "in the input directory, appending to the crosswalk. Stop with Ctrl+C.")
+  parser.add_argument("--quiet-seconds", type=float, default=30, help="Watch: a directory is processed once its files did not "
+                      "change for this long (default: %(default)s)")
+  parser.add_argument("--poll-interval", type=float, default=5, help="Watch: seconds between two polls of the input directory "
+                      "(default: %(default)s)")
+  parser.add_argument("--watch-batch-size", type=int, default=16, help="Watch: maximum number of directories processed together "
+                      "(default: %(default)s)")
+  parser.add_argument("--watch-queue-size", type=int, default=100, help="Watch: maximum number of ready directories waiting "
+                      "to be processed (default: %(default)s)")
+  return parser
+
+def collectInputImageList(input_dir, patterns, prefix, use_uuid=False, secret=None):
+  """
+  Find the directories holding DICOM files, and name their output.
+  :return: Crosswalk of the directories, as built by the module widget
+  """
+  input_image_list = Crosswalk()
+  for result in DirectoryScanner(input_dir, patterns):
+    input_image_list.add(result.path, first_file=result.first_file)
+  input_image_list.assignNames(prefix, use_uuid, secret)
+  return input_image_list
+
+def readSecret(path):
+  with open(path, encoding="utf-8") as f:
+    return f.read().strip()
+
+def createRunner(args):
+  """
+  BatchRunner configured from the command line.
+  """
+  runner = BatchRunner(args.output, args.format, args.keep_gender, args.keep_age, args.workers, args.header_only)
+  runner.writer_options = ImageWriter.WriterOptions(args.compression_level, args.compression_threads)
+  if args.memory_limit > 0:
+    runner.memory_limit = args.memory_limit * 1024 * 1024
+  runner.dedup_cache = args.dedup_cache
+  runner.dedup_max_entries = args.dedup_max_entries
+  runner.dedup_max_age_days = args.dedup_max_age
+  runner.duplicateMode = args.duplicates
+  runner.pseudonym_store = args.pseudonym_store
+  runner.pipeline_depth = args.pipeline_depth
+  runner.state_dir = args.state_dir
+  if args.archive:
+    runner.archive_format = "." + args.archive
+    runner.archive_max_series = args.archive_max_series
+    runner.archive_max_bytes = args.archive_max_size * 1024 * 1024
+  return runner
+
+def runDirect(args, input_image_list, runner=None):
+  """
+  Run the batch without Slicer.
+  :param runner: BatchRunner kept open for a watch session, see BatchRunner.open(). A new one if None.
+  """
+  if runner is None:
+    runner = createRunner(args)
+  with runner.timings.stage("read headers"):
+    series_list = DicomHeaders.collectSeriesFromFiles(input_image_list.paths())
+  logging.info("Found {} series in {} directories".format(len(series_list), len(input_image_list)))
+  runner.run(series_list, input_image_list.names(), args.resume)
+
+def runInSlicer(args, input_image_list, logic=None, session=False):
+  """
+  Run the batch with the module logic.
+  :param logic: logic of a watch session, a new one if None
+  :param session: keep the outputs open for the next batch, see SlicerBatchAnonymizeLogic.endSession()
+  """
+  if logic is None:
+    from SlicerBatchAnonymize import SlicerBatchAnonymizeLogic
+    logic = SlicerBatchAnonymizeLogic()
+  logic.process(input_image_list, Path(args.output), args.format, args.keep_gender, args.keep_age,
+                num_workers=args.workers, direct=args.direct, temp_database=args.temp_database,
+                header_only=args.header_only, resume=args.resume, memory_limit_mb=args.memory_limit,
+                writer_options=ImageWriter.WriterOptions(args.compression_level, args.compression_threads),
+                dedup_cache=args.dedup_cache, duplicate_mode=args.duplicates, pseudonym_store=args.pseudonym_store,
+                archive_format="." + args.archive if args.archive else None, archive_max_series=args.archive_max_series,
+                archive_max_mb=args.archive_max_size, pipeline_depth=args.pipeline_depth, session=session,
+                state_dir=args.state_dir)
+
+def runWriterBenchmark(args, input_image_list):
+  """
+  Compare the output formats and compression settings on the first series of the input.
+  """
+  import SimpleITK as sitk
+  series_list = DicomHeaders.collectSeriesFromFiles(input_image_list.paths()[:1])
+  if len(series_list) == 0:
+    logging.error("No series to benchmark in {}".format(args.input))
+    return 1
+  series_info = series_list[0]
+  reader = sitk.ImageSeriesReader()
+  reader.SetFileNames(SeriesWorker._sortedSeriesFiles(series_info["files"], series_info["series"]))
+  image = reader.Execute()
+  threads = max(2, args.compression_threads)
+  options_list = [ImageWriter.WriterOptions(level, num_threads) for level in (0, 1, 6, 9) for num_threads in (1, threads)
+                  if level != 0 or num_threads == 1]
+  rows = ImageWriter.benchmarkWriters(image, args.output, [".nii", ".nii.gz", ".nrrd", ".gipl.gz"], options_list)
+  for row in rows:
+    print("{:8} level {:2} threads {:2}: {:>8} s {:12} bytes".format(row["format"], row["level"], row["threads"],
+                                                                      row["seconds"], row["bytes"]))
+  return 0
+
+def runWatch(args, secret=None):
+  """
+  Anonymize the directories arriving in the input directory until interrupted. The output
+  directory is resumed once, and each batch of quiet directories is appended to its journal,
+  crosswalk and timings.
+  """
+  use_uuid = args.uuid or secret is not None
+  input_image_list = Crosswalk.fromJournal(args.output, args.state_dir)
+  watcher = FolderWatcher(args.input, args.patterns, args.quiet_seconds, args.watch_queue_size)
+  watcher.markProcessed(input_image_list)
+  args.resume = True
+  logging.info("Watching {} ({} directories already processed)".format(args.input, len(input_image_list)))
+  runner = None
+  logic = None
+  if isSlicerRunning():
+    from SlicerBatchAnonymize import SlicerBatchAnonymizeLogic
+    logic = SlicerBatchAnonymizeLogic()
+  else:
+    runner = createRunner(args)
+    runner.open(resume=True)
+  try:
+    while True:
+      watcher.poll()
+      ready = watcher.takeReady(args.watch_batch_size)
+      if len(ready) == 0:
+        time.sleep(args.poll_interval)
+        continue
+      for result in ready:
+        input_image_list.addNamed(result.path, args.prefix, use_uuid, secret, result.first_file)
+      batch = input_image_list.subset([result.path for result in ready])
+      logging.info("Will anonymize: {} images, {} waiting".format(len(batch), watcher.numQueued()))
+      if logic is not None:
+        runInSlicer(args, batch, logic, session=True)
+      else:
+        runDirect(args, batch, runner)
+  except KeyboardInterrupt:
+    logging.info("Stopped watching {}".format(args.input))
+  finally:
+    if runner is not None:
+      runner.close()
+    if logic is not None:
+      logic.endSession()
+
+def isSlicerRunning():
+  try:
+    import slicer
+    return hasattr(slicer, "app")
+  except Exception:
+    return False
+
+def main(argv=None):
+  parser = buildArgumentParser()
+  args = parser.parse_args(argv)
+  if args.merge_shards:
+    Sharding.mergeShards(args.output, args.state_dir)
+    return 0
+  if args.input is None:
+    parser.error("--input is required")
+  if args.num_shards < 1 or not 0 <= args.shard_index < args.num_shards:
+    parser.error("--shard-index must be between 0 and --num-shards - 1")
+  if args.benchmark_writers:
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    return runWriterBenchmark(args, collectInputImageList(args.input, args.patterns, args.prefix))
+  in_slicer = isSlicerRunning()
+  if not in_slicer and not args.direct:
+    logging.error("The DICOM database is only available in Slicer, use --direct")
+    return 2
+  if not in_slicer and args.format == ".dcm" and not args.header_only:
+    logging.error("DICOM output outside of Slicer requires --header-only")
+    return 2
+  output_dir = Path(args.output)
+  if args.watch and args.num_shards > 1:
+    parser.error("--watch cannot be used with --num-shards")
+
+  if args.clear_dedup_cache and args.dedup_cache:
+    cache = DedupCache(args.dedup_cache, None)
+    cache.clear()
+    cache.close()
+  secret = None
+  if args.hash_secret_file:
+    secret = readSecret(args.hash_secret_file)
+    if secret == "":
+      logging.error("The secret file {} is empty".format(args.hash_secret_file))
+      return 2
+  if args.watch:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    runWatch(args, secret)
+    return 0
+  input_image_list = collectInputImageList(args.input, args.patterns, args.prefix, args.uuid or secret is not None, secret)
+  if len(input_image_list) == 0:
+    logging.error("No DICOM files found in {}".format(args.input))
+    return 1
+  if args.num_shards > 1:
+    # Names are assigned on the full list so the shards never produce the same name
+    shard_name = Sharding.shardDirectoryName(args.num_shards, args.shard_index)
+    args.state_dir = str(Sharding.shardStateDir(output_dir, args.state_dir, shard_name))
+    output_dir = output_dir / shard_name
+    output_dir.mkdir(parents=True, exist_ok=True)
+    Sharding.writeShardInfo(output_dir, input_image_list, args.input, args.num_shards, args.shard_index)
+    input_image_list = Sharding.selectShard(input_image_list, args.num_shards, args.shard_index)
+    args.output = str(output_dir)
+  output_dir.mkdir(parents=True, exist_ok=True)
+  logging.info("Will anonymize: {} images".format(len(input_image_list)))
+  if in_slicer:
+    runInSlicer(args, input_image_list)
+  else:
+    try:
+      runDirect(args, input_image_list)
+    except MemoryError as e:
+      logging.error(str(e))
+      return 3
+  return 0
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+  exit_code = main()
+  if isSlicerRunning():
+    import slicer
+    slicer.util.exit(exit_code)
+  else:
+    sys.exit(exit_code)
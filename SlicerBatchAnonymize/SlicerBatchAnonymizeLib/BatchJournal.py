@@ -0,0 +1,185 @@
+import os
+import csv
+import json
+import shutil
+import logging
+from pathlib import Path
+
+from .SeriesWorker import STATUS_DONE, STATUS_SKIPPED, STATUS_ERROR
+
+__all__ = ["BatchJournal"]
+
+#
+# BatchJournal
+#
+
+class BatchJournal:
+  """
+  Append-only record of the series processed into an output directory.
+  Every finished series is appended to journal.jsonl (one JSON object per line) and flushed to
+  disk, and crosswalk.csv, details.csv and files_not_converted.txt are written as the series
+  complete instead of at the end of the run.
+  The journal holds the original identifiers next to their pseudonyms and date offsets, so it is
+  kept in a state directory outside the output directory (see defaultStateDir()): the output can
+  be handed over without the key to re-identify it.
+  When resuming, the journal of the previous run is read back: series that were done or skipped
+  are not processed again, series that failed are retried, and the output files are rewritten
+  from the journal before new rows are appended. The journal itself is never rewritten, new
+  records are appended after the previous ones and the last record of a series wins.
+  """
+
+  JOURNAL_NAME = "journal.jsonl"
+  CROSSWALK_NAME = "crosswalk.csv"
+  DETAILS_NAME = "details.csv"
+  ERRORS_NAME = "files_not_converted.txt"
+  STATE_SUFFIX = ".state"
+
+  def __init__(self, output_dir, resume=False, retry=None, state_dir=None):
+    """
+    :param retry: f(record) -> True to export a completed series again when resuming, e.g. its output was lost
+    :param state_dir: directory of the journal, defaultStateDir() if None. Must not be inside output_dir.
+    """
+    self.output_dir = Path(output_dir)
+    self.state_dir = Path(state_dir) if state_dir is not None else self.defaultStateDir(output_dir)
+    self.state_dir.mkdir(parents=True, exist_ok=True)
+    self.records = {}
+    self._files = {}
+    self._writers = {}
+    journal_path = self.state_dir / self.JOURNAL_NAME
+    legacy_path = self.output_dir / self.JOURNAL_NAME
+    if legacy_path.exists():
+      # Journal written into the output directory by an earlier version
+      if resume and not journal_path.exists():
+        shutil.move(str(legacy_path), str(journal_path))
+      else:
+        legacy_path.unlink()
+    if resume and journal_path.exists():
+      self.records = self.loadRecords(self.output_dir, self.state_dir)
+    # Outputs of the previous run are rebuilt from the journal
+    for name in (self.CROSSWALK_NAME, self.DETAILS_NAME, self.ERRORS_NAME):
+      if (self.output_dir / name).exists():
+        (self.output_dir / name).unlink()
+    if resume:
+      self._journal = open(journal_path, "a", encoding="utf-8")
+      if not self._endsWithNewline(journal_path):
+        # A crash left the last line incomplete, it is skipped when reading and the next records start on a new line
+        self._journal.write("\n")
+        self._journal.flush()
+    else:
+      self._journal = open(journal_path, "w", encoding="utf-8")
+    if retry is not None:
+      for key in [key for key, record in self.records.items() if self.isCompleted(key) and retry(record)]:
+        # Recorded as failed, so the series is retried by this run or the next one
+        self.records[key] = dict(self.records[key], status=STATUS_ERROR, message="Output lost, exported again")
+        self._journal.write(json.dumps(self.records[key]) + "\n")
+      self._journal.flush()
+      os.fsync(self._journal.fileno())
+    if self.records:
+      logging.info("Resuming batch: {} series already completed".format(self.numCompleted()))
+    for record in self.records.values():
+      if record["status"] == STATUS_DONE:
+        self._writeOutputs(record)
+
+  @staticmethod
+  def _endsWithNewline(path):
+    with open(path, "rb") as f:
+      f.seek(0, os.SEEK_END)
+      if f.tell() == 0:
+        return True
+      f.seek(-1, os.SEEK_END)
+      return f.read(1) == b"\n"
+
+  @classmethod
+  def defaultStateDir(cls, output_dir):
+    """
+    Directory next to output_dir holding its journal, e.g. out.state for out.
+    """
+    output_dir = Path(output_dir)
+    return output_dir.with_name(output_dir.name + cls.STATE_SUFFIX)
+
+  @classmethod
+  def loadRecords(cls, output_dir, state_dir=None):
+    """
+    Read the journal of output_dir, without modifying it.
+    :param state_dir: directory of the journal, defaultStateDir() if None
+    :return: dict of series key to the last record of the series, in journal order
+    """
+    records = {}
+    path = Path(state_dir if state_dir is not None else cls.defaultStateDir(output_dir)) / cls.JOURNAL_NAME
+    if not path.exists():
+      return records
+    with open(path, encoding="utf-8") as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # The last line may be incomplete if the previous run was killed while writing it
+          logging.warning("Ignoring incomplete journal entry in {}".format(path))
+          continue
+        records[record["key"]] = record
+    return records
+
+  @staticmethod
+  def seriesKey(imgpath, series_uid):
+    """
+    Key identifying a series of the batch in the journal.
+    """
+    return "{}|{}".format(imgpath, series_uid)
+
+  def isCompleted(self, key):
+    record = self.records.get(key)
+    return record is not None and record["status"] in (STATUS_DONE, STATUS_SKIPPED)
+
+  def numCompleted(self):
+    return len([key for key in self.records if self.isCompleted(key)])
+
+  def completedRecords(self):
+    return [record for key, record in self.records.items() if self.isCompleted(key)]
+
+  def record(self, key, status, input, output=None, message="", details=None, **info):
+    """
+    Append the result of a series to the journal and to the output files.
+    :param status: one of STATUS_DONE, STATUS_SKIPPED and STATUS_ERROR
+    :param details: row of details.csv, if any
+    :param info: additional JSON serializable values stored in the journal entry
+    """
+    record = dict(info)
+    record.update({"key": key, "status": status, "input": str(input),
+                   "output": None if output is None else str(output), "message": message, "details": details})
+    self.records[key] = record
+    self._journal.write(json.dumps(record) + "\n")
+    self._journal.flush()
+    os.fsync(self._journal.fileno())
+    if status == STATUS_DONE:
+      self._writeOutputs(record)
+    elif status == STATUS_ERROR:
+      self._write(self.ERRORS_NAME, None, record["input"])
+
+  def _writeOutputs(self, record):
+    self._write(self.CROSSWALK_NAME, ["input", "output"], {"input": record["input"], "output": record["output"]})
+    if record.get("details"):
+      self._write(self.DETAILS_NAME, list(record["details"].keys()), record["details"])
+
+  def _write(self, name, fieldnames, row):
+    """
+    Append a row to one of the output files, creating it on first use.
+    """
+    if name not in self._files:
+      self._files[name] = open(self.output_dir / name, "w", encoding="utf-8", newline="" if fieldnames else None)
+      if fieldnames:
+        self._writers[name] = csv.DictWriter(self._files[name], fieldnames, extrasaction="ignore")
+        self._writers[name].writeheader()
+    if fieldnames:
+      self._writers[name].writerow(row)
+    else:
+      self._files[name].write(row + "\n")
+    self._files[name].flush()
+
+  def close(self):
+    for f in self._files.values():
+      f.close()
+    self._files = {}
+    self._writers = {}
+    if self._journal is not None:
+      self._journal.close()
+      self._journal = None
@@ -0,0 +1,578 @@
+import os
+import gc
+import hmac
+import uuid
+import random
+import shutil
+import hashlib
+import logging
+import tempfile
+import functools
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from . import SeriesWorker, TagRewrite
+from .ArchiveWriter import ArchiveWriter
+from .BatchJournal import BatchJournal
+from .BatchTimings import BatchTimings, pathSize, currentRSS
+from .DedupCache import DedupCache, contentHash, settingsFingerprint, linkOutput
+from .DicomHeaders import FrameGroup
+from .ImageWriter import WriterOptions
+from .PseudonymStore import PseudonymStore, DATE_OFFSETS
+
+__all__ = ["BatchRunner", "anonymizedTags", "defaultOutputName", "hashedOutputName"]
+
+def defaultOutputName(index, prefix, use_uuid=False):
+  """
+  Output name of the series directory at position index (0 based) of the batch.
+  """
+  if use_uuid:
+    return str(uuid.uuid4())
+  return prefix + "_%04d"%(index+1)
+
+def hashedOutputName(series_uid, secret):
+  """
+  Output name derived from a keyed hash (HMAC-SHA256) of the SeriesInstanceUID, formatted as a UUID.
+  The same series and secret always give the same name, and the name cannot be traced back to the
+  series without the secret.
+  """
+  digest = hmac.new(secret.encode("utf-8"), series_uid.encode("utf-8"), hashlib.sha256).digest()
+  return str(uuid.UUID(bytes=digest[:16]))
+
+def anonymizedTags(header, patient_id, study_uid, series_uid, date_offset, keep_age=False, keep_gender=False):
+  """
+  Compute the anonymized tags of a series.
+  :param header: SeriesHeader of the original series
+  :param date_offset: number of days the birth date is shifted by
+  :return: (tags, details): DICOM keyword to value for the output, and the row of details.csv
+  """
+  tags = {"PatientID": patient_id, "StudyInstanceUID": study_uid, "SeriesInstanceUID": series_uid,
+          "StudyTime": "", "ContentDate": "", "ContentTime": "", "StudyDate": ""}
+  details = {'PatientID': patient_id, 'StudyID': study_uid, 'SeriesID': series_uid}
+  if keep_age:
+    agestr = header.age
+    dob = ""
+    if header.birth_date != "":
+      dob_dt = datetime.strptime(header.birth_date, '%Y%m%d') + timedelta(days=date_offset)
+      dob = dob_dt.strftime("%Y%m%d")
+      if agestr == '' and header.study_date != "":
+        study_dt = datetime.strptime(header.study_date, '%Y%m%d')
+        age = int((study_dt - dob_dt).days/365)
+        agestr =  str(age).zfill(3)+'Y'
+    tags["PatientAge"] = agestr
+    tags["StudyDate"] = header.study_date
+    tags["PatientBirthDate"] = dob
+    details['StudyDate'] = header.study_date
+    details['PatientAge'] = agestr
+    details["PatientBirthDate"] = dob
+  if keep_gender:
+    tags["PatientSex"] = header.sex
+    details['Gender'] = header.sex
+  return tags, details
+
+#
+# BatchRunner
+#
+
+class BatchRunner:
+  """
+  Anonymize and export a list of series, recording the results in the journal of the output directory
+  (kept in its state directory, see BatchJournal).
+  This does not depend on Slicer: series are exported by worker tasks (SimpleITK, or DICOM header
+  rewrite) unless a scene export callback is set, which the Slicer logic uses to load and export
+  the series in the MRML scene.
+  """
+
+  def __init__(self, output_dir, out_format, keep_gender=False, keep_age=False, num_workers=1, header_only=False):
+    """
+    See SlicerBatchAnonymizeLogic.process() for the parameters.
+    """
+    self.output_dir = Path(output_dir)
+    self.out_format = out_format
+    self.keep_gender = keep_gender
+    self.keep_age = keep_age
+    self.num_workers = num_workers
+    self.header_only = header_only and out_format == ".dcm"
+    # f(series_info, name, dcm_tags) -> (status, output path, message), runs in the calling thread
+    self.sceneExport = None
+    # f(message, percentage)
+    self.progressCallback = None
+    # f() -> True to stop the batch
+    self.cancelCallback = None
+    # JobController to cancel or pause the batch, checked between series and by the tasks between files
+    self.controller = None
+    # f(), processes the GUI events while waiting for a worker or while paused
+    self.eventPump = None
+    # Stage times of the batch, written next to the crosswalk at the end of run()
+    self.timings = BatchTimings()
+    # Append the throughput summary to the progress messages
+    self.liveTimings = False
+    # Resident memory ceiling in bytes, None for no limit. Worker processes above it are restarted,
+    # the batch stops if this process stays above it after releaseMemory.
+    self.memory_limit = None
+    # f(), frees the memory held by the scene exports (e.g. undo stack)
+    self.releaseMemory = None
+    # Compression of the non-DICOM outputs written by the worker tasks
+    self.writer_options = WriterOptions()
+    # sqlite file of the duplicate cache (see DedupCache), None to export every series
+    self.dedup_cache = None
+    self.dedup_max_entries = 100000
+    self.dedup_max_age_days = None
+    # "link": a duplicate gets its own output, hard linked (or copied) from the first one. DICOM files
+    # are copied with the output name of the duplicate as PatientName.
+    # "record": the crosswalk points the duplicate to the first output, PatientName included. So does
+    # a duplicate of an archived series, indexed as a reference to the archive member of the first one.
+    self.duplicateMode = "link"
+    # sqlite file of the pseudonyms kept across batches (see PseudonymStore), None for new pseudonyms in every batch
+    self.pseudonym_store = None
+    # ".zip" or ".tar" to store the outputs in archives (see ArchiveWriter) instead of one file or folder
+    # per series. The series are written to a local staging directory first.
+    self.archive_format = None
+    # Series and bytes per archive, 0 for no limit
+    self.archive_max_series = 0
+    self.archive_max_bytes = 0
+    # Series waiting between two stages (read, anonymize, write) when the tasks run in this process,
+    # see SeriesWorker.runSeriesPipeline(). 0 runs the series one after the other.
+    self.pipeline_depth = 1
+    # Directory of the journal, outside the output directory. None for BatchJournal.defaultStateDir().
+    self.state_dir = None
+    self._journal = None
+    self._dedup = None
+    self._pseudonyms = None
+    self._archive = None
+    self._staging = None
+    # Pseudonyms of the patients and studies of the open journal, see open()
+    self._patient_ids = {}
+    self._study_ids = {}
+
+  def reportProgress(self, msg, percentage):
+    if self.controller is not None and self.controller.etaText():
+      msg += " (" + self.controller.etaText() + ")"
+    if self.liveTimings and len(self.timings.series) > 0:
+      msg += "\n" + self.timings.summary()
+    if self.progressCallback is not None:
+      with self.timings.stage("progress"):
+        self.progressCallback(msg, percentage)
+    else:
+      logging.info("{} ({:.0f}%)".format(msg, percentage))
+
+  def checkCanceled(self):
+    """
+    Raise if the batch was canceled, wait while it is paused.
+    """
+    if self.cancelCallback is not None and self.cancelCallback():
+      raise SeriesWorker.JobCanceled("User stopped processing")
+    if self.controller is not None:
+      self.controller.checkpoint(self.eventPump)
+
+  def checkMemory(self):
+    """
+    Raise MemoryError when this process stays above the memory ceiling after releasing what it can.
+    The completed series are in the journal, the batch can be resumed after restarting.
+    """
+    if not self.memory_limit:
+      return
+    rss = currentRSS()
+    if rss is None or rss <= self.memory_limit:
+      return
+    with self.timings.stage("release memory"):
+      if self.releaseMemory is not None:
+        self.releaseMemory()
+      gc.collect()
+    rss = currentRSS()
+    if rss is not None and rss > self.memory_limit:
+      raise MemoryError("Memory use ({:.0f} MB) is above the limit ({:.0f} MB), restart and resume the batch".format(
+        rss / (1024 * 1024), self.memory_limit / (1024 * 1024)))
+
+  def open(self, resume=False):
+    """
+    Open the journal of the output directory, and the duplicate cache, pseudonym store and archive
+    if set. run() opens and closes them itself unless they are already open: a watch session opens
+    them once and runs a batch per group of new directories, each one appended to the same files.
+    :param resume: skip the series completed by a previous run, see BatchJournal
+    """
+    self._archive = None
+    self._staging = None
+    retry = None
+    if self.archive_format is not None:
+      self._archive = ArchiveWriter(self.output_dir, self.archive_format, self.archive_max_series, self.archive_max_bytes, resume)
+      self._staging = Path(tempfile.mkdtemp(prefix="SlicerBatchAnonymize_"))
+      discarded = self._archive.discarded
+      # Series of the archives a crash left unfinished are exported again
+      retry = lambda record: record["output"] is not None and Path(record["output"]).name in discarded
+    self._journal = BatchJournal(self.output_dir, resume, retry, self.state_dir)
+    self._dedup = None
+    if self.dedup_cache is not None:
+      self._dedup = DedupCache(self.dedup_cache, self.dedupSettings(), self.dedup_max_entries, self.dedup_max_age_days)
+    self._pseudonyms = None
+    if self.pseudonym_store is not None:
+      self._pseudonyms = PseudonymStore(self.pseudonym_store)
+    self._patient_ids = {}
+    self._study_ids = {}
+    # Series completed by a previous run keep their pseudonyms
+    for record in self._journal.completedRecords():
+      if "patient" in record:
+        self._patient_ids[record["patient"]] = (record["patient_ded"], record["date_offset"])
+        self._study_ids[record["study"]] = record["study_ded"]
+        if self._pseudonyms is not None:
+          self._pseudonyms.add("patient", record["patient"], record["patient_ded"], record["date_offset"])
+          self._pseudonyms.add("study", record["study"], record["study_ded"])
+
+  def close(self):
+    """
+    Close what open() opened, and write the timings.
+    """
+    if self._journal is None:
+      return
+    self._journal.close()
+    self._journal = None
+    if self._archive is not None:
+      self._archive.close()
+      self._archive = None
+      shutil.rmtree(str(self._staging), ignore_errors=True)
+      self._staging = None
+    if self._dedup is not None:
+      self._dedup.close()
+      self._dedup = None
+    if self._pseudonyms is not None:
+      self._pseudonyms.close()
+      self._pseudonyms = None
+    self.timings.write(self.output_dir)
+    logging.info(self.timings.summary())
+
+  def isOpen(self):
+    return self._journal is not None
+
+  def run(self, series_list, names, resume=False):
+    """
+    :param series_list: series to export, see DicomHeaders.collectSeriesFromFiles()
+    :param names: dict of series directory to output name
+    :param resume: skip the series completed by a previous run, see BatchJournal. Ignored if the
+      runner is already open, see open().
+    """
+    if self.out_format == ".dcm" and not self.header_only and self.sceneExport is None:
+      raise ValueError("DICOM output without the scene requires the header only rewrite")
+    session = self.isOpen()
+    if not session:
+      self.open(resume)
+    try:
+      self._run(self._journal, series_list, names)
+    finally:
+      if session:
+        # The timings of the series of this batch are appended
+        self.timings.write(self.output_dir)
+      else:
+        self.close()
+
+  def exportDir(self):
+    """
+    Directory the series are written to: the output directory, or the staging directory when archiving.
+    """
+    return self.output_dir if self._staging is None else self._staging
+
+  def _archiveOutput(self, name, status, output, written_path, input):
+    """
+    Add a series written to the staging directory to the archive, if archiving.
+    :param input: input directory of the series, indexed with its members
+    :return: (output recorded in the journal, archive member or None)
+    """
+    if self._archive is None or status != SeriesWorker.STATUS_DONE:
+      return output, None
+    with self.timings.stage("archive"):
+      return self._archive.add(name, written_path, input)
+
+  def _removeStaged(self, written_path):
+    if self._archive is None or written_path is None or not os.path.exists(str(written_path)):
+      return
+    if os.path.isdir(str(written_path)):
+      shutil.rmtree(str(written_path), ignore_errors=True)
+    else:
+      os.remove(str(written_path))
+
+  def dedupSettings(self):
+    """
+    Fingerprint of the settings the outputs depend on, cached outputs made with other settings are dropped.
+    """
+    return settingsFingerprint(format=self.out_format, keep_gender=self.keep_gender, keep_age=self.keep_age,
+                               header_only=self.header_only, compression_level=self.writer_options.level)
+
+  def _patientPseudonym(self, patient):
+    """
+    :return: (pseudonymized PatientID, offset in days added to the birth date when the age is kept)
+    """
+    if self._pseudonyms is not None:
+      return self._pseudonyms.patient(patient)
+    import pydicom
+    #create an offset in days (3-6) months to add to birth date when age is requested to be kept in tact.
+    return pydicom.uid.generate_uid(None), random.choice(DATE_OFFSETS)
+
+  def _uidPseudonym(self, kind, uid):
+    if self._pseudonyms is not None:
+      return self._pseudonyms.study(uid) if kind == "study" else self._pseudonyms.series(uid)
+    import pydicom
+    return pydicom.uid.generate_uid(None)
+
+  def _recordDuplicate(self, journal, key, input, name, cached):
+    """
+    Record a series identical to one already exported, reusing its output, see duplicateMode.
+    :param cached: values stored in the duplicate cache for the first series
+    """
+    self.timings.beginSeries()
+    source = Path(cached["output"])
+    output = source
+    if cached.get("member"):
+      # Archived: the duplicate points to the same archive member
+      if self._archive is not None:
+        self._archive.addReference(name, source, cached["member"], input)
+    elif self.duplicateMode == "link" or self._archive is not None:
+      output = self.exportDir() / (name if source.is_dir() else name + self.out_format)
+      if output != source and self.out_format == ".dcm":
+        # The DICOM files name the series in PatientName, they are copied with the name of the duplicate
+        with self.timings.stage("rename duplicate"):
+          TagRewrite.renameSeries(source, output, name)
+      elif output != source:
+        with self.timings.stage("link duplicate"):
+          linkOutput(source, output)
+      staged = output
+      output, member = self._archiveOutput(name, SeriesWorker.STATUS_DONE, output, staged, input)
+      self._removeStaged(staged)
+    message = "Duplicate of " + cached["input"]
+    logging.info("{}: {}".format(message, input))
+    with self.timings.stage("journal"):
+      journal.record(key, SeriesWorker.STATUS_DONE, input, output, message, cached["details"], name=name, **cached["pseudonyms"])
+    self._recordTimings([], input, SeriesWorker.STATUS_DONE, output, None)
+    if self.controller is not None:
+      self.controller.advance()
+
+  def _recordPendingDuplicate(self, journal, key, input, name, task):
+    """
+    Record a copy of a series exported by a task of the batch, see _recordDuplicate().
+    The task is recorded already, with its "result" and "cached" record.
+    """
+    result = task["result"]
+    if result["status"] == SeriesWorker.STATUS_DONE:
+      self._recordDuplicate(journal, key, input, name, task["cached"])
+      return
+    with self.timings.stage("journal"):
+      journal.record(key, result["status"], input, None, "Duplicate of {}: {}".format(task["input"], result["message"]),
+                     name=name, **task["pseudonyms"])
+    if self.controller is not None:
+      self.controller.advance()
+
+  def _recordSkipped(self, journal, key, input, name, pseudonyms):
+    """
+    Record a series with a single slice, known from its headers.
+    """
+    message = "Image has only one slice, ignoring"
+    logging.warning(message + ": " + str(input))
+    self.timings.beginSeries()
+    with self.timings.stage("journal"):
+      journal.record(key, SeriesWorker.STATUS_SKIPPED, input, None, message, name=name, **pseudonyms)
+    self._recordTimings([], input, SeriesWorker.STATUS_SKIPPED, None, None)
+    if self.controller is not None:
+      self.controller.advance()
+
+  def _storeExport(self, dedup_key, cached):
+    """
+    :param cached: values reused by the duplicates of the series, see _cachedRecord()
+    """
+    if self._dedup is not None and dedup_key is not None:
+      self._dedup.store(dedup_key[0], dedup_key[1], cached["output"], cached)
+
+  @staticmethod
+  def _cachedRecord(input, output, member, details, pseudonyms):
+    return {"input": str(input), "output": str(output), "member": member, "details": details, "pseudonyms": pseudonyms}
+
+  def _recordTimings(self, files, input, status, out_path, written_path, stages=None, rss=None):
+    """
+    :param written_path: file or folder the series was written to, for the number of bytes written
+    :param rss: resident memory of the worker that exported the series, this process if None
+    """
+    bytes_read = 0
+    for f in files:
+      try:
+        bytes_read += os.path.getsize(f)
+      except OSError:
+        pass
+    bytes_written = pathSize(written_path) if status == SeriesWorker.STATUS_DONE else 0
+    self.timings.endSeries(input, out_path, status, bytes_read, bytes_written, stages, rss)
+
+  def _exportUnits(self, series_info, name):
+    """
+    Split a series into the volumes exported separately, from the frame groups its headers were
+    classified into (see DicomHeaders.groupFrames()). A header only rewrite keeps the series whole.
+    Volumes of a single slice (e.g. scouts) are skipped: the output names get a suffix "_<number>"
+    only when more than one volume is exported, otherwise the series keeps its name.
+    :return: list of (series_info, journal key, output name, FrameGroup, volume id), the volume id
+      is the SeriesInstanceUID, followed by "/<number>" of the volume when the series is split
+    """
+    imgpath = series_info["imgpath"]
+    groups = series_info.get("groups") or [FrameGroup(list(series_info["files"]), len(series_info["files"]))]
+    if self.header_only or len(groups) == 1:
+      files = [f for group in groups for f in group.files]
+      group = FrameGroup(files, sum(group.num_frames for group in groups))
+      return [(series_info, BatchJournal.seriesKey(imgpath, series_info["series"]), name, group, series_info["series"])]
+    num_exported = sum(1 for group in groups if group.num_frames >= 2)
+    units = []
+    number = 0
+    for k, group in enumerate(groups):
+      volume = series_info["series"] + "/" + str(k+1)
+      if group.num_frames < 2:
+        # Recorded as skipped under the name of the series, no output is written
+        units.append((series_info, BatchJournal.seriesKey(imgpath, volume), name, group, volume))
+      elif num_exported == 1:
+        units.append((series_info, BatchJournal.seriesKey(imgpath, series_info["series"]), name, group, series_info["series"]))
+      else:
+        number += 1
+        units.append((series_info, BatchJournal.seriesKey(imgpath, volume), name + "_%d" % number, group, volume))
+    return units
+
+  def _run(self, journal, series_list, names):
+    stage = "Anonymizing and Exporting"
+    self.reportProgress(stage, 0)
+    use_workers = self.num_workers > 1 and self.sceneExport is None
+    if self.num_workers > 1 and not use_workers:
+      logging.info("Series are exported in the scene, ignoring the number of workers")
+    task_function = TagRewrite.rewriteSeries if self.header_only else SeriesWorker.exportSeries
+    worker_tasks = []
+    patient_ids = self._patient_ids
+    study_ids = self._study_ids
+    units = [unit for series_info in series_list for unit in self._exportUnits(series_info, names[series_info["imgpath"]])]
+    if self.controller is not None:
+      self.controller.start(sum(1 for unit in units if not journal.isCompleted(unit[1])))
+    # Copies of a series waiting for the first one, by (SeriesInstanceUID, content hash)
+    pending = {}
+    # Series recorded without being exported (skipped, duplicates) wait for the tasks before them,
+    # by number of tasks, so the journal and the crosswalk keep the order of a serial run
+    deferred = {}
+    def defer(function, *args):
+      if self.sceneExport is not None:
+        # Exported in this loop, the tasks before are already recorded
+        function(*args)
+      else:
+        deferred.setdefault(len(worker_tasks), []).append(functools.partial(function, *args))
+    def recordDeferred(position):
+      for function in deferred.pop(position, []):
+        function()
+    idx = 0
+    for series_info, key, name, group, volume in units:
+      self.checkCanceled()
+      files = group.files
+      imgpath = series_info["imgpath"]
+      if journal.isCompleted(key):
+        continue
+      header = series_info["header"]
+      patient = header.patient_id or series_info["patient"]
+      study = header.study_uid or series_info["study"]
+      if patient not in patient_ids:
+        patient_ids[patient] = self._patientPseudonym(patient)
+      patientid_ded, random_offset = patient_ids[patient]
+      if study not in study_ids:
+        study_ids[study] = self._uidPseudonym("study", study)
+      studyid_ded = study_ids[study]
+      pseudonyms = {"patient": patient, "patient_ded": patientid_ded, "date_offset": random_offset,
+                    "study": study, "study_ded": studyid_ded}
+      if group.num_frames < 2:
+        # Known from the headers, the pixel data is never read
+        defer(self._recordSkipped, journal, key, imgpath, name, pseudonyms)
+        continue
+      dedup_key = None
+      if self._dedup is not None:
+        with self.timings.stage("hash"):
+          dedup_key = (series_info["series"], contentHash(files))
+        cached = self._dedup.lookup(*dedup_key)
+        if cached is not None:
+          defer(self._recordDuplicate, journal, key, imgpath, name, cached)
+          continue
+        if dedup_key in pending:
+          defer(self._recordPendingDuplicate, journal, key, imgpath, name, pending[dedup_key])
+          continue
+      # Volumes of a series each get their own SeriesInstanceUID
+      series_ded = self._uidPseudonym("series", volume)
+      logging.info("Will export this: " + str(imgpath))
+      dcm_tags, sdict = anonymizedTags(header, patientid_ded, studyid_ded, series_ded, random_offset, self.keep_age, self.keep_gender)
+      details = sdict if self.out_format == ".dcm" else None
+      if self.sceneExport is not None:
+        self.reportProgress(stage + " : " + str(imgpath), (idx+1)*100.0/len(units))
+        self.timings.beginSeries()
+        status, out_path, message = self.sceneExport(dict(series_info, files=list(files)), name, dcm_tags)
+        if status == SeriesWorker.STATUS_CANCELED:
+          # Not recorded, processed again when the batch is resumed
+          raise SeriesWorker.JobCanceled(message)
+        written = self.exportDir() / name if self.out_format == ".dcm" else out_path
+        out_path, member = self._archiveOutput(name, status, out_path, written, imgpath)
+        with self.timings.stage("journal"):
+          journal.record(key, status, imgpath, out_path, message, details, name=name, **pseudonyms)
+        if status == SeriesWorker.STATUS_DONE:
+          self._storeExport(dedup_key, self._cachedRecord(imgpath, out_path, member, details, pseudonyms))
+        self._recordTimings(files, imgpath, status, out_path, written)
+        self._removeStaged(written)
+        if self.controller is not None:
+          self.controller.advance()
+        self.checkMemory()
+        idx += 1
+        continue
+      task = {"index": len(worker_tasks), "files": list(files), "series": series_info["series"], "input": imgpath,
+              "output": self.exportDir() / (name + self.out_format), "key": key, "name": name, "pseudonyms": pseudonyms, "details": details}
+      if self.header_only:
+        task["output"] = self.exportDir() / name
+        task["tags"] = dcm_tags
+      else:
+        task["writer"] = self.writer_options
+      if dedup_key is not None:
+        task["dedup"] = dedup_key
+        pending[dedup_key] = task
+      worker_tasks.append(task)
+
+    if len(worker_tasks) == 0:
+      recordDeferred(0)
+      return
+    if use_workers:
+      self.reportProgress(stage + " with {} workers".format(self.num_workers), 0)
+      results = SeriesWorker.runSeriesTasks(worker_tasks, self.num_workers, task_function, self.memory_limit,
+                                            self.controller, self.eventPump)
+    else:
+      if self.controller is not None:
+        # Tasks run here check the controller between files too
+        self.controller.installInProcess(self.eventPump)
+      if self.pipeline_depth > 0:
+        stages = TagRewrite.REWRITE_STAGES if self.header_only else SeriesWorker.EXPORT_STAGES
+        results = SeriesWorker.runSeriesPipeline(worker_tasks, stages, self.pipeline_depth, self.eventPump)
+      else:
+        results = (task_function(task) for task in worker_tasks)
+    try:
+      # Results come back in task order, the crosswalk and error list match a serial run
+      for result in results:
+        recordDeferred(result["index"])
+        # Journal and archive times of this series, its export stages come with the result
+        self.timings.beginSeries()
+        task = worker_tasks[result["index"]]
+        if result["status"] == SeriesWorker.STATUS_CANCELED:
+          # Not recorded, processed again when the batch is resumed
+          raise SeriesWorker.JobCanceled(result["message"])
+        self.reportProgress(stage + " : " + str(task["input"]), (result["index"]+1)*100.0/len(worker_tasks))
+        if result["status"] == SeriesWorker.STATUS_ERROR:
+          logging.error("Error reading/writing file: {}\n{}".format(task["input"], result["message"]))
+        elif result["status"] == SeriesWorker.STATUS_SKIPPED:
+          logging.warning(result["message"])
+        output, member = self._archiveOutput(task["name"], result["status"], task["output"], task["output"], task["input"])
+        with self.timings.stage("journal"):
+          journal.record(task["key"], result["status"], task["input"], output, result["message"],
+                         task["details"], name=task["name"], **task["pseudonyms"])
+        self._recordTimings(task["files"], task["input"], result["status"], output, task["output"],
+                            result.get("stages"), result.get("rss") if use_workers else None)
+        self._removeStaged(task["output"])
+        if self.controller is not None:
+          self.controller.advance()
+        # Read by the duplicates of the series, see _recordPendingDuplicate()
+        task["result"] = result
+        task["cached"] = self._cachedRecord(task["input"], output, member, task["details"], task["pseudonyms"])
+        if result["status"] == SeriesWorker.STATUS_DONE:
+          self._storeExport(task.get("dedup"), task["cached"])
+        if not use_workers:
+          self.checkMemory()
+        self.checkCanceled()
+      recordDeferred(len(worker_tasks))
+    finally:
+      results.close()
+      SeriesWorker.initWorker()
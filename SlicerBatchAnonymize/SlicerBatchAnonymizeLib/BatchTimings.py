@@ -0,0 +1,169 @@
+import os
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+__all__ = ["BatchTimings", "pathSize", "currentRSS"]
+
+def currentRSS():
+  """
+  Resident set size of this process in bytes, with psutil or /proc. None if it cannot be measured.
+  """
+  if psutil is not None:
+    return psutil.Process().memory_info().rss
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return None
+
+def pathSize(path):
+  """
+  Size in bytes of a file, or of all the files under a directory. 0 if path does not exist.
+  """
+  if path is None:
+    return 0
+  path = str(path)
+  if os.path.isfile(path):
+    return os.path.getsize(path)
+  total = 0
+  for root, dirs, files in os.walk(path):
+    for f in files:
+      try:
+        total += os.path.getsize(os.path.join(root, f))
+      except OSError:
+        pass
+  return total
+
+#
+# BatchTimings
+#
+
+class BatchTimings:
+  """
+  Time spent per stage (import, load, export, ...) for the whole batch and for each series,
+  with the bytes read and written. Written next to the crosswalk as timings.json (totals,
+  throughput and series) and timings.csv (one row per series).
+  Stage times measured in worker processes are summed over the workers, so with several
+  workers the stage totals can exceed the elapsed time.
+  The resident memory is sampled at the end of each stage, the highest value per stage is
+  reported as its peak. Series exported by workers report the memory of their worker.
+  """
+
+  JSON_NAME = "timings.json"
+  CSV_NAME = "timings.csv"
+
+  def __init__(self):
+    self.start_time = time.time()
+    self.stages = {}
+    self.peak_rss = {}
+    self.series = []
+    self._current = None
+    # Series rows and stage columns of timings.csv written by write()
+    self._csv_rows = 0
+    self._csv_stages = None
+
+  def elapsed(self):
+    return time.time() - self.start_time
+
+  @contextmanager
+  def stage(self, name):
+    """
+    Time the enclosed block, counted in the stage totals and in the current series if any.
+    """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.addTime(name, time.perf_counter() - start)
+      self.addMemory(name, currentRSS())
+
+  def addMemory(self, name, rss):
+    if rss is not None:
+      self.peak_rss[name] = max(self.peak_rss.get(name, 0), rss)
+
+  def addTime(self, name, seconds):
+    self.stages[name] = self.stages.get(name, 0.0) + seconds
+    if self._current is not None:
+      self._current[name] = self._current.get(name, 0.0) + seconds
+
+  def beginSeries(self):
+    """
+    Following stage times are also counted for the series passed to the next endSeries().
+    """
+    self._current = {}
+
+  def endSeries(self, input, output, status, bytes_read=0, bytes_written=0, stages=None, rss=None):
+    """
+    Record a series.
+    :param stages: stage name to seconds measured elsewhere (e.g. in a worker process), added to the totals
+    :param rss: resident memory measured elsewhere, the memory of this process if None
+    """
+    series_stages = self._current or {}
+    self._current = None
+    if rss is None:
+      rss = currentRSS()
+    for name, seconds in (stages or {}).items():
+      self.addTime(name, seconds)
+      self.addMemory(name, rss)
+      series_stages[name] = series_stages.get(name, 0.0) + seconds
+    self.series.append({"input": str(input), "output": None if output is None else str(output), "status": status,
+                        "bytes_read": bytes_read, "bytes_written": bytes_written, "rss": rss,
+                        "seconds": sum(series_stages.values()), "stages": series_stages})
+
+  def totals(self):
+    elapsed = self.elapsed()
+    bytes_read = sum(s["bytes_read"] for s in self.series)
+    bytes_written = sum(s["bytes_written"] for s in self.series)
+    return {"elapsed": elapsed, "num_series": len(self.series),
+            "series_per_second": len(self.series) / elapsed if elapsed > 0 else 0.0,
+            "bytes_read": bytes_read, "bytes_written": bytes_written,
+            "read_mb_per_second": bytes_read / 1e6 / elapsed if elapsed > 0 else 0.0,
+            "written_mb_per_second": bytes_written / 1e6 / elapsed if elapsed > 0 else 0.0,
+            "peak_rss": max(self.peak_rss.values()) if self.peak_rss else None}
+
+  def summary(self):
+    """
+    One line summary, e.g. for the progress label.
+    """
+    totals = self.totals()
+    text = "{} series in {:.1f} s ({:.2f} series/s, read {:.1f} MB/s, written {:.1f} MB/s)".format(
+      totals["num_series"], totals["elapsed"], totals["series_per_second"],
+      totals["read_mb_per_second"], totals["written_mb_per_second"])
+    if self.stages:
+      slowest = max(self.stages, key=self.stages.get)
+      text += ", most time in {} ({:.1f} s)".format(slowest, self.stages[slowest])
+    return text
+
+  def write(self, output_dir):
+    """
+    Write timings.json and timings.csv to output_dir. Called again (e.g. after each batch of a watch
+    session), the series recorded since are appended to timings.csv, which is only rewritten when
+    they bring new stage columns, and timings.json holds the totals of all the series.
+    """
+    with open(os.path.join(str(output_dir), self.JSON_NAME), "w", encoding="utf-8") as f:
+      json.dump({"totals": self.totals(), "stages": self.stages, "peak_rss": self.peak_rss, "series": self.series}, f, indent=2)
+    new_series = self.series[self._csv_rows:]
+    stage_names = set(name for s in new_series for name in s["stages"])
+    if self._csv_stages is not None and stage_names <= set(self._csv_stages):
+      mode = "a"
+    else:
+      mode = "w"
+      new_series = self.series
+      self._csv_stages = sorted(stage_names.union(self._csv_stages or []))
+    stage_names = self._csv_stages
+    self._csv_rows = len(self.series)
+    with open(os.path.join(str(output_dir), self.CSV_NAME), mode, encoding="utf-8", newline="") as f:
+      w = csv.writer(f)
+      if mode == "w":
+        w.writerow(["input", "output", "status", "bytes_read", "bytes_written", "rss", "seconds"] + stage_names)
+      for s in new_series:
+        w.writerow([s["input"], s["output"] or "", s["status"], s["bytes_read"], s["bytes_written"], s["rss"] or "",
+                    "%.4f" % s["seconds"]] +
+                   ["%.4f" % s["stages"].get(name, 0.0) for name in stage_names])
@@ -0,0 +1,159 @@
+"""
+Throughput benchmark of the batch anonymization on synthetic DICOM data.
+
+Generates a synthetic batch (see SyntheticData), then measures the directory scan, the header
+reading and a full run per output format, from the stage times of timings.json. Results are
+written to benchmark.json in the work directory; they can be saved as a baseline and later
+runs compared to it, failing when a throughput drops by more than the tolerance:
+
+  PythonSlicer -m SlicerBatchAnonymizeLib.Benchmark --work-dir /tmp/bench --preset medium --save-baseline baseline.json
+  PythonSlicer -m SlicerBatchAnonymizeLib.Benchmark --work-dir /tmp/bench --preset medium --baseline baseline.json
+
+Outside of Slicer the runs use the direct reading (no DICOM database), so there is no import stage.
+Formats other than .dcm need SimpleITK.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+from pathlib import Path
+
+if __package__ in (None, ""):
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SlicerBatchAnonymizeLib import DicomHeaders, SyntheticData
+from SlicerBatchAnonymizeLib.BatchRunner import BatchRunner
+from SlicerBatchAnonymizeLib.BatchTimings import BatchTimings
+from SlicerBatchAnonymizeLib.Crosswalk import Crosswalk
+from SlicerBatchAnonymizeLib.DirectoryScanner import DirectoryScanner
+
+RESULTS_NAME = "benchmark.json"
+
+# Throughput values compared to the baseline, higher is better
+THROUGHPUT_KEYS = ["scan_directories_per_second", "headers_files_per_second", "series_per_second", "read_mb_per_second"]
+
+def runDirect(input_image_list, output_dir, out_format, num_workers=1):
+  """
+  Default batch function of runBenchmark(): direct reading and worker exports, as the command line does.
+  """
+  runner = BatchRunner(output_dir, out_format, num_workers=num_workers, header_only=out_format == ".dcm")
+  with runner.timings.stage("read headers"):
+    series_list = DicomHeaders.collectSeriesFromFiles(input_image_list.paths())
+  runner.run(series_list, input_image_list.names())
+
+def runBenchmark(work_dir, spec, formats, num_workers=1, batch=runDirect, seed=0):
+  """
+  Generate the synthetic batch of spec in work_dir (kept between runs if it exists) and benchmark it.
+  :param spec: SyntheticData.DatasetSpec or the name of a preset
+  :param batch: f(input_image_list, output_dir, out_format, num_workers), runs a batch writing timings.json
+    to output_dir, e.g. with the Slicer logic to include the DICOM database import
+  :return: dict with "dataset", "environment", "scan", "headers" and "formats" (format to totals and stage seconds)
+  """
+  if isinstance(spec, str):
+    spec = SyntheticData.PRESETS[spec]
+  work_dir = Path(work_dir)
+  data_dir = work_dir / ("data_" + spec.name)
+  summary_path = data_dir / "dataset.json"
+  if summary_path.exists():
+    with open(str(summary_path), encoding="utf-8") as f:
+      dataset = json.load(f)
+  else:
+    shutil.rmtree(str(data_dir), ignore_errors=True)
+    dataset = SyntheticData.generateDataset(data_dir, spec, seed)
+    dataset["spec"] = spec._asdict()
+    with open(str(summary_path), "w", encoding="utf-8") as f:
+      json.dump(dataset, f, indent=2)
+
+  results = {"dataset": dataset, "environment": {"python": platform.python_version(), "machine": platform.machine(),
+                                                  "cpus": os.cpu_count(), "workers": num_workers},
+             "formats": {}}
+  start = time.perf_counter()
+  scanner = DirectoryScanner(data_dir, "*.dcm")
+  input_image_list = Crosswalk()
+  for result in scanner:
+    input_image_list.add(result.path, first_file=result.first_file)
+  seconds = time.perf_counter() - start
+  results["scan"] = {"seconds": seconds, "directories": scanner.num_directories,
+                     "scan_directories_per_second": scanner.num_directories / seconds if seconds > 0 else 0.0}
+  input_image_list.assignNames("File")
+
+  start = time.perf_counter()
+  DicomHeaders.collectSeriesFromFiles(input_image_list.paths())
+  seconds = time.perf_counter() - start
+  results["headers"] = {"seconds": seconds,
+                        "headers_files_per_second": dataset["num_files"] / seconds if seconds > 0 else 0.0}
+
+  for out_format in formats:
+    output_dir = work_dir / ("output" + out_format.replace(".", "_"))
+    shutil.rmtree(str(output_dir), ignore_errors=True)
+    output_dir.mkdir(parents=True)
+    batch(input_image_list, output_dir, out_format, num_workers)
+    with open(str(output_dir / BatchTimings.JSON_NAME), encoding="utf-8") as f:
+      timings = json.load(f)
+    results["formats"][out_format] = dict(timings["totals"], stages=timings["stages"],
+                                          statuses={status: sum(1 for s in timings["series"] if s["status"] == status)
+                                                    for status in set(s["status"] for s in timings["series"])})
+    logging.info("{}: {:.2f} series/s, read {:.1f} MB/s".format(
+      out_format, timings["totals"]["series_per_second"], timings["totals"]["read_mb_per_second"]))
+  with open(str(work_dir / RESULTS_NAME), "w", encoding="utf-8") as f:
+    json.dump(results, f, indent=2)
+  return results
+
+def _throughputs(results):
+  values = {"scan_directories_per_second": results["scan"]["scan_directories_per_second"],
+            "headers_files_per_second": results["headers"]["headers_files_per_second"]}
+  for out_format, totals in results["formats"].items():
+    for key in ("series_per_second", "read_mb_per_second"):
+      values[out_format + " " + key] = totals[key]
+  return values
+
+def compareToBaseline(results, baseline, tolerance=0.25):
+  """
+  :return: list of (measure, baseline value, value) for the throughputs that dropped by more than tolerance
+  """
+  regressions = []
+  current = _throughputs(results)
+  for key, reference in _throughputs(baseline).items():
+    value = current.get(key)
+    if value is not None and reference > 0 and value < reference * (1.0 - tolerance):
+      regressions.append((key, reference, value))
+  return regressions
+
+def buildArgumentParser():
+  parser = argparse.ArgumentParser(description="Benchmark the batch anonymization on synthetic DICOM data.")
+  parser.add_argument("--work-dir", required=True, help="Directory for the synthetic data, the outputs and benchmark.json")
+  parser.add_argument("--preset", default="small", choices=sorted(SyntheticData.PRESETS), help="Size of the synthetic batch "
+                      "(default: %(default)s)")
+  parser.add_argument("--formats", default=".dcm", help="Comma separated output formats (default: %(default)s)")
+  parser.add_argument("--workers", type=int, default=1, help="Number of worker processes (default: %(default)s)")
+  parser.add_argument("--baseline", help="Compare to this baseline, exit with 1 on a regression")
+  parser.add_argument("--tolerance", type=float, default=0.25, help="Relative throughput drop reported as a regression "
+                      "(default: %(default)s)")
+  parser.add_argument("--save-baseline", help="Save the results as a baseline to this file")
+  return parser
+
+def main(argv=None):
+  args = buildArgumentParser().parse_args(argv)
+  formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+  results = runBenchmark(args.work_dir, args.preset, formats, args.workers)
+  for key, value in sorted(_throughputs(results).items()):
+    print("{:40} {:10.2f}".format(key, value))
+  if args.save_baseline:
+    with open(args.save_baseline, "w", encoding="utf-8") as f:
+      json.dump(results, f, indent=2)
+  if args.baseline:
+    with open(args.baseline, encoding="utf-8") as f:
+      regressions = compareToBaseline(results, json.load(f), args.tolerance)
+    for key, reference, value in regressions:
+      logging.error("Regression in {}: {:.2f} (baseline {:.2f})".format(key, value, reference))
+    if regressions:
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+  sys.exit(main())
@@ -0,0 +1,205 @@
+import uuid
+from pathlib import Path
+
+from . import DicomHeaders
+from .BatchJournal import BatchJournal
+from .BatchRunner import defaultOutputName, hashedOutputName
+
+__all__ = ["CrosswalkEntry", "Crosswalk"]
+
+class CrosswalkEntry:
+  """
+  Output name of one series directory. manual is True when the name was edited by the user,
+  automatic names are recomputed when the naming changes. The random UUID, and the
+  SeriesInstanceUID and PatientID of the first file are computed once, when first needed.
+  """
+  __slots__ = ("path", "name", "manual", "first_file", "uuid", "series_uid", "patient_id")
+
+  def __init__(self, path, name="", manual=False, first_file=None):
+    self.path = path
+    self.name = name
+    self.manual = manual
+    self.first_file = first_file
+    self.uuid = None
+    self.series_uid = None
+    self.patient_id = None
+
+  def __repr__(self):
+    return "CrosswalkEntry({!r}, {!r}, {!r})".format(self.path, self.name, self.manual)
+
+#
+# Crosswalk
+#
+
+class Crosswalk:
+  """
+  Series directories of a batch, in scan order, with their output names.
+  Entries are found by row (position in the batch) or by directory in constant time.
+  Iterating gives the directories, like the keys of a dict.
+  """
+
+  def __init__(self):
+    self._entries = []
+    self._rows = {}
+
+  @classmethod
+  def fromJournal(cls, output_dir, state_dir=None):
+    """
+    Crosswalk of the directories recorded in the journal of output_dir, with the names they were exported to.
+    Directories added afterwards are numbered after them.
+    :param state_dir: directory of the journal, see BatchJournal.loadRecords()
+    """
+    crosswalk = cls()
+    for record in BatchJournal.loadRecords(output_dir, state_dir).values():
+      if record.get("name"):
+        crosswalk.add(record["input"], record["name"], True)
+      else:
+        crosswalk.add(record["input"])
+    return crosswalk
+
+  def add(self, path, name="", manual=False, first_file=None):
+    """
+    Append a directory, or return the row of a directory already in the crosswalk.
+    :param first_file: a DICOM file of the directory, read for the hashed names
+    :return: row of the entry
+    """
+    path = Path(path)
+    row = self._rows.get(path)
+    if row is not None:
+      return row
+    return self.addEntry(CrosswalkEntry(path, name, manual, first_file))
+
+  def addEntry(self, entry):
+    """
+    Append an entry, e.g. kept from a previous crosswalk of the same directories.
+    :return: row of the entry
+    """
+    row = self._rows.get(entry.path)
+    if row is not None:
+      return row
+    row = len(self._entries)
+    self._entries.append(entry)
+    self._rows[entry.path] = row
+    return row
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __iter__(self):
+    return (entry.path for entry in self._entries)
+
+  def __contains__(self, path):
+    return Path(path) in self._rows
+
+  def entry(self, row):
+    return self._entries[row]
+
+  def row(self, path):
+    """
+    :return: row of the directory, None if it is not in the crosswalk
+    """
+    return self._rows.get(Path(path))
+
+  def entryForPath(self, path):
+    row = self.row(path)
+    return None if row is None else self._entries[row]
+
+  def entries(self):
+    return list(self._entries)
+
+  def paths(self):
+    return [entry.path for entry in self._entries]
+
+  def rename(self, row, name):
+    """
+    Set a manual output name.
+    """
+    entry = self._entries[row]
+    entry.name = name
+    entry.manual = True
+
+  def _readFirstFile(self, entry):
+    entry.series_uid = ""
+    entry.patient_id = ""
+    if entry.first_file is not None:
+      header = DicomHeaders.readSeriesHeader(entry.first_file)
+      if header is not None:
+        entry.series_uid = header.series_uid
+        entry.patient_id = header.patient_id
+
+  def seriesUID(self, row):
+    """
+    SeriesInstanceUID of the first DICOM file of the directory, "" if it cannot be read.
+    """
+    entry = self._entries[row]
+    if entry.series_uid is None:
+      self._readFirstFile(entry)
+    return entry.series_uid
+
+  def patientID(self, row):
+    """
+    PatientID (PatientName if empty) of the first DICOM file of the directory, "" if it cannot be read.
+    """
+    entry = self._entries[row]
+    if entry.patient_id is None:
+      self._readFirstFile(entry)
+    return entry.patient_id
+
+  def outputName(self, row, prefix, use_uuid=False, secret=None):
+    """
+    Output name of a row: the manual name if any, otherwise a name derived from the naming options.
+    With use_uuid a random UUID is generated once per entry and kept, with a secret as well the
+    name is the keyed hash of the SeriesInstanceUID (of the directory path if there is none).
+    """
+    entry = self._entries[row]
+    if entry.manual:
+      return entry.name
+    if use_uuid and secret:
+      return hashedOutputName(self.seriesUID(row) or str(entry.path), secret)
+    if use_uuid:
+      if entry.uuid is None:
+        entry.uuid = str(uuid.uuid4())
+      return entry.uuid
+    return defaultOutputName(row, prefix)
+
+  def addNamed(self, path, prefix, use_uuid=False, secret=None, first_file=None):
+    """
+    Append a directory and set its name from the naming options, see outputName().
+    A directory already in the crosswalk keeps its entry.
+    :return: row of the entry
+    """
+    row = self.add(path, first_file=first_file)
+    entry = self._entries[row]
+    entry.name = self.outputName(row, prefix, use_uuid, secret)
+    return row
+
+  def assignNames(self, prefix, use_uuid=False, secret=None):
+    """
+    Set the name of the entries that were not renamed manually, see outputName().
+    """
+    for row in range(len(self._entries)):
+      self._entries[row].name = self.outputName(row, prefix, use_uuid, secret)
+
+  def subset(self, paths):
+    """
+    Crosswalk of the given directories, in that order, sharing the entries.
+    """
+    part = Crosswalk()
+    for path in paths:
+      part.addEntry(self.entryForPath(path))
+    return part
+
+  def names(self):
+    """
+    :return: dict of directory to output name
+    """
+    return {entry.path: entry.name for entry in self._entries}
+
+  def slice(self, start, stop):
+    """
+    Crosswalk of the rows [start, stop), sharing the entries: names are kept as they are.
+    """
+    part = Crosswalk()
+    for entry in self._entries[start:stop]:
+      part.addEntry(entry)
+    return part
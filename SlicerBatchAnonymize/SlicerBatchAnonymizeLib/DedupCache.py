@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+from pathlib import Path
+
+__all__ = ["DedupCache", "contentHash", "settingsFingerprint", "linkOutput"]
+
+# Bytes hashed at the start and at the end of each file
+SAMPLE_SIZE = 64 * 1024
+
+def _fileDigest(path, sample_size):
+  size = os.path.getsize(path)
+  digest = hashlib.blake2b(str(size).encode("ascii"), digest_size=16)
+  with open(path, "rb") as f:
+    digest.update(f.read(sample_size))
+    if size > 2 * sample_size:
+      f.seek(-sample_size, os.SEEK_END)
+      digest.update(f.read(sample_size))
+    elif size > sample_size:
+      digest.update(f.read())
+  return digest.digest()
+
+def contentHash(files, sample_size=SAMPLE_SIZE):
+  """
+  Fast hash of the content of a series: size, start and end of each file. The start holds the
+  header of a DICOM file (with its SOPInstanceUID) and the end the last of its pixel data, so
+  copies of a series match wherever they are stored and whatever their file names.
+  """
+  digests = sorted(_fileDigest(str(f), sample_size) for f in files)
+  return hashlib.blake2b(b"".join(digests), digest_size=16).hexdigest()
+
+def settingsFingerprint(**settings):
+  """
+  Hash of the anonymization settings, outputs made with other settings are not reused.
+  """
+  text = json.dumps(settings, sort_keys=True, default=str)
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def _linkOrCopy(src, dst):
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+  return dst
+
+def linkOutput(src, dst):
+  """
+  Make dst a copy of the output file or folder src, hard linked when the file system allows it.
+  """
+  src = Path(src)
+  dst = Path(dst)
+  if dst.exists():
+    if dst.is_dir():
+      shutil.rmtree(str(dst))
+    else:
+      dst.unlink()
+  if src.is_dir():
+    shutil.copytree(str(src), str(dst), copy_function=_linkOrCopy)
+  else:
+    _linkOrCopy(str(src), str(dst))
+
+#
+# DedupCache
+#
+
+class DedupCache:
+  """
+  Persistent cache of the series already anonymized, keyed by SeriesInstanceUID and content hash
+  (see contentHash()), with the output and the journal entry they produced. A copy of a series
+  found again, in another folder or in a later batch, reuses that output instead of being exported.
+  Entries are only valid for the settings they were made with: opening the cache with other
+  settings drops them. The least recently used entries are evicted above max_entries, and entries
+  older than max_age_days or whose output was removed are dropped.
+  """
+
+  def __init__(self, path, settings, max_entries=100000, max_age_days=None, clock=time.time):
+    """
+    :param path: sqlite file of the cache, created if needed
+    :param settings: fingerprint of the anonymization settings, see settingsFingerprint(). None keeps
+      all the entries, e.g. to clear() the cache.
+    """
+    self.path = Path(path)
+    self.settings = settings
+    self.max_entries = max_entries
+    self.max_age_days = max_age_days
+    self._clock = clock
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    self._db = sqlite3.connect(str(self.path))
+    self._db.execute("CREATE TABLE IF NOT EXISTS entries (series_uid TEXT, content_hash TEXT, settings TEXT, "
+                     "output TEXT, record TEXT, created REAL, last_used REAL, PRIMARY KEY (series_uid, content_hash))")
+    self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+    if settings is not None:
+      dropped = self._db.execute("DELETE FROM entries WHERE settings != ?", (settings,)).rowcount
+      self._db.commit()
+      if dropped > 0:
+        logging.info("Anonymization settings changed, dropped {} entries of the duplicate cache".format(dropped))
+
+  def __len__(self):
+    return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+  def lookup(self, series_uid, content_hash):
+    """
+    :return: the record stored for the series, None if it is not cached or its output is gone
+    """
+    row = self._db.execute("SELECT output, record FROM entries WHERE series_uid = ? AND content_hash = ?",
+                           (series_uid, content_hash)).fetchone()
+    if row is None:
+      return None
+    if not os.path.exists(row[0]):
+      self._db.execute("DELETE FROM entries WHERE series_uid = ? AND content_hash = ?", (series_uid, content_hash))
+      self._db.commit()
+      return None
+    self._db.execute("UPDATE entries SET last_used = ? WHERE series_uid = ? AND content_hash = ?",
+                     (self._clock(), series_uid, content_hash))
+    self._db.commit()
+    return json.loads(row[1])
+
+  def store(self, series_uid, content_hash, output, record):
+    """
+    :param output: file or folder the series was exported to
+    :param record: JSON serializable values reused by the duplicates, e.g. the journal entry
+    """
+    now = self._clock()
+    self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (series_uid, content_hash, self.settings, str(output), json.dumps(record), now, now))
+    self._db.commit()
+
+  def evict(self):
+    """
+    Drop the entries older than max_age_days, then the least recently used ones above max_entries.
+    :return: number of entries dropped
+    """
+    dropped = 0
+    if self.max_age_days is not None:
+      oldest = self._clock() - self.max_age_days * 24 * 3600
+      dropped += self._db.execute("DELETE FROM entries WHERE created < ?", (oldest,)).rowcount
+    if self.max_entries is not None:
+      dropped += self._db.execute("DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY last_used DESC "
+                                  "LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+    self._db.commit()
+    return dropped
+
+  def clear(self):
+    self._db.execute("DELETE FROM entries")
+    self._db.commit()
+
+  def close(self):
+    if self._db is not None:
+      self.evict()
+      self._db.close()
+      self._db = None
@@ -0,0 +1,201 @@
+import os
+import logging
+from pathlib import Path
+from collections import namedtuple, OrderedDict
+
+__all__ = ["SeriesHeader", "FrameInfo", "FrameGroup", "readHeader", "readSeriesHeader", "frameInfo", "groupFrames", "classifyFiles",
+           "readSeries", "collectSeriesFromFiles"]
+
+# Tags read from every file to group it into patient/study/series
+GROUPING_TAGS = ["PatientID", "PatientName", "StudyInstanceUID", "SeriesInstanceUID"]
+# Tags needed to anonymize a series, read from its first file
+SERIES_TAGS = ["PatientSex", "PatientAge", "PatientBirthDate", "StudyDate"]
+# Tags splitting the files of a series into volumes, read from every file
+FRAME_TAGS = ["Rows", "Columns", "ImageOrientationPatient", "ImagePositionPatient", "NumberOfFrames",
+              "TemporalPositionIdentifier"]
+
+# Everything the anonymization needs from the header of a series, read once per series.
+# All values are strings, empty when the element is missing.
+SeriesHeader = namedtuple("SeriesHeader", ["patient_id", "study_uid", "series_uid", "sex", "age", "birth_date", "study_date"])
+
+# Stack key (size, orientation, temporal position), rounded slice position and number of frames of a file
+FrameInfo = namedtuple("FrameInfo", ["stack", "position", "num_frames"])
+
+# Files of a series that form one volume, and its number of slices (frames of multi-frame files included)
+FrameGroup = namedtuple("FrameGroup", ["files", "num_frames"])
+
+def readHeader(path, tags=None):
+  """
+  Read the header of a DICOM file, without the pixel data.
+  :param tags: keywords of the elements to read, all elements if None
+  :return: pydicom Dataset, or None if the file is not a DICOM file
+  """
+  import pydicom
+  try:
+    return pydicom.dcmread(str(path), stop_before_pixels=True, specific_tags=tags)
+  except (pydicom.errors.InvalidDicomError, OSError, EOFError) as e:
+    logging.debug("Not a DICOM file {}: {}".format(path, e))
+    return None
+
+def _value(ds, keyword):
+  value = ds.get(keyword, "")
+  return "" if value is None else str(value)
+
+def _seriesHeader(ds):
+  return SeriesHeader(
+    patient_id=_value(ds, "PatientID") or _value(ds, "PatientName"),
+    study_uid=_value(ds, "StudyInstanceUID"),
+    series_uid=_value(ds, "SeriesInstanceUID"),
+    sex=_value(ds, "PatientSex"),
+    age=_value(ds, "PatientAge"),
+    birth_date=_value(ds, "PatientBirthDate"),
+    study_date=_value(ds, "StudyDate"),
+    )
+
+def readSeriesHeader(path):
+  """
+  Read all the tags needed to anonymize a series from one of its files, in a single pass.
+  :return: SeriesHeader, or None if the file is not a DICOM file
+  """
+  ds = readHeader(path, GROUPING_TAGS + SERIES_TAGS)
+  return None if ds is None else _seriesHeader(ds)
+
+def _numFrames(ds):
+  try:
+    return max(1, int(ds.get("NumberOfFrames", 1) or 1))
+  except (TypeError, ValueError):
+    return 1
+
+def _rounded(ds, keyword):
+  try:
+    return tuple(round(float(v), 3) for v in (ds.get(keyword) or []))
+  except (TypeError, ValueError):
+    return ()
+
+def frameInfo(ds):
+  """
+  What groupFrames() needs from the header of a file, small enough to be kept for every file of a batch.
+  """
+  num_frames = _numFrames(ds)
+  stack = (_value(ds, "Rows"), _value(ds, "Columns"), _rounded(ds, "ImageOrientationPatient"),
+           _value(ds, "TemporalPositionIdentifier"))
+  return FrameInfo(stack, _rounded(ds, "ImagePositionPatient"), num_frames)
+
+def groupFrames(file_infos):
+  """
+  Split the files of a series into the volumes they form, from their headers only.
+  Files are stacked together when they have the same size, orientation and temporal position.
+  A multi-frame file is a volume on its own. When the slice positions of a stack repeat the
+  same number of times (several acquisitions without a temporal tag), each repetition is a volume.
+  :param file_infos: list of (path, FrameInfo), see frameInfo()
+  :return: list of FrameGroup, in the order of their first file
+  """
+  stacks = OrderedDict()
+  for path, info in sorted(file_infos, key=lambda item: item[0]):
+    key = ("multi-frame", path) if info.num_frames > 1 else info.stack
+    stacks.setdefault(key, []).append((path, info))
+  groups = []
+  for items in stacks.values():
+    if len(items) == 1:
+      groups.append(FrameGroup([items[0][0]], items[0][1].num_frames))
+      continue
+    occurrences = OrderedDict()
+    for path, info in items:
+      occurrences.setdefault(info.position, []).append(path)
+    counts = set(len(paths) for paths in occurrences.values())
+    if len(counts) == 1 and counts != {1} and () not in occurrences:
+      for repetition in range(counts.pop()):
+        files = [paths[repetition] for paths in occurrences.values()]
+        groups.append(FrameGroup(files, len(files)))
+    else:
+      groups.append(FrameGroup([path for path, info in items], len(items)))
+  return groups
+
+def classifyFiles(files, known=None):
+  """
+  Split the files of a series into volumes, reading their headers (see groupFrames()).
+  Files that cannot be read are kept in the first volume, so they are reported by the export.
+  :param known: dict of path to the FrameInfo of the files whose header was already read
+  :return: list of FrameGroup
+  """
+  file_infos = []
+  unreadable = []
+  for path in files:
+    if known is not None and path in known:
+      file_infos.append((path, known[path]))
+      continue
+    ds = readHeader(path, FRAME_TAGS)
+    if ds is None:
+      unreadable.append(path)
+    else:
+      file_infos.append((path, frameInfo(ds)))
+  groups = groupFrames(file_infos)
+  if unreadable:
+    if groups:
+      groups[0] = FrameGroup(groups[0].files + unreadable, groups[0].num_frames + len(unreadable))
+    else:
+      groups = [FrameGroup(list(unreadable), len(unreadable))]
+  return groups
+
+def readSeries(files):
+  """
+  Header of a series and its volumes, reading the first file once for both (see readSeriesHeader()
+  and classifyFiles()).
+  :return: (SeriesHeader or None if the first file cannot be read, list of FrameGroup)
+  """
+  ds = readHeader(files[0], GROUPING_TAGS + SERIES_TAGS + FRAME_TAGS)
+  if ds is None:
+    return None, classifyFiles(files)
+  return _seriesHeader(ds), classifyFiles(files, {files[0]: frameInfo(ds)})
+
+def collectSeriesFromFiles(directories, is_canceled=None):
+  """
+  Group the DICOM files found directly in the given directories by SeriesInstanceUID,
+  reading headers only. No DICOM database is involved. A series copied to several directories
+  is found once per directory, each copy has its own output.
+  :param directories: iterable of directories, each expected to hold one or more series
+  :param is_canceled: optional callable, the collection stops when it returns True
+  :return: list of dicts with "patient", "study", "series", "files", "imgpath", "header" (SeriesHeader)
+    and "groups" (FrameGroup of each volume, see groupFrames()), ordered by patient, study and series
+    in the order they were first found
+  """
+  series_by_uid = {}
+  file_infos = {}
+  for directory in directories:
+    if is_canceled is not None and is_canceled():
+      break
+    try:
+      with os.scandir(directory) as it:
+        paths = sorted(e.path for e in it if e.is_file())
+    except OSError as e:
+      logging.warning("Cannot read directory {}: {}".format(directory, e))
+      continue
+    for path in paths:
+      ds = readHeader(path, GROUPING_TAGS + SERIES_TAGS + FRAME_TAGS)
+      if ds is None or "SeriesInstanceUID" not in ds:
+        continue
+      uid = _value(ds, "SeriesInstanceUID")
+      series_key = (directory, uid)
+      if series_key not in series_by_uid:
+        header = _seriesHeader(ds)
+        series_by_uid[series_key] = {
+          "patient": header.patient_id,
+          "study": header.study_uid,
+          "series": uid,
+          "files": [],
+          "imgpath": Path(directory),
+          "header": header,
+          }
+      series_by_uid[series_key]["files"].append(path)
+      file_infos.setdefault(series_key, []).append((path, frameInfo(ds)))
+  # Classified from the headers already read, the pixel data is not touched
+  for series_key, info in series_by_uid.items():
+    info["groups"] = groupFrames(file_infos[series_key])
+
+  # Same nesting as walking patients -> studies -> series in a database
+  patient_order = {}
+  study_order = {}
+  for info in series_by_uid.values():
+    patient_order.setdefault(info["patient"], len(patient_order))
+    study_order.setdefault(info["study"], len(study_order))
+  return sorted(series_by_uid.values(), key=lambda info: (patient_order[info["patient"]], study_order[info["study"]]))
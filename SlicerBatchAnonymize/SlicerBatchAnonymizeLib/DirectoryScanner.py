@@ -0,0 +1,186 @@
+import os
+import re
+import time
+import fnmatch
+import logging
+from collections import namedtuple
+
+__all__ = ["DirectoryScanResult", "DirectoryIndex", "DirectoryScanner", "scanDirectories"]
+
+# A directory holding at least one file that matches the input patterns
+DirectoryScanResult = namedtuple("DirectoryScanResult", ["path", "first_file", "num_files"])
+
+# Listing of a directory: modification time, (st_dev, st_ino), file names and subdirectory paths, sorted
+DirectoryListing = namedtuple("DirectoryListing", ["mtime_ns", "inode", "files", "subdirs"])
+
+#
+# DirectoryIndex
+#
+
+class DirectoryIndex:
+  """
+  Cache of directory listings, keyed by path. A listing stays valid while the modification
+  time of its directory is unchanged, as adding, removing or renaming an entry updates it.
+  Scanning again with an index only stats the directories, and a scan that does not
+  revalidate (e.g. when only the patterns changed) does not touch the disk at all.
+  """
+
+  def __init__(self):
+    self._listings = {}
+
+  def __len__(self):
+    return len(self._listings)
+
+  def __contains__(self, directory):
+    return str(directory) in self._listings
+
+  def get(self, directory):
+    return self._listings.get(str(directory))
+
+  def set(self, directory, listing):
+    self._listings[str(directory)] = listing
+
+  def clear(self):
+    self._listings = {}
+
+#
+# DirectoryScanner
+#
+
+class DirectoryScanner:
+  """
+  Single pass walk of a directory tree, looking for directories with files matching
+  any of the given glob patterns (case insensitive).
+  The walk can be run in small steps (see step()) so that a GUI can interleave it with
+  event processing and cancel it at any time. Directories are reported in the same order
+  as sorting their paths, i.e. the order the recursive glob used to produce.
+  Only the directory entries are read, files are never opened.
+  With a DirectoryIndex, listings are reused for the directories whose modification time did not
+  change, and stored for the others.
+  """
+
+  def __init__(self, root, patterns, index=None, revalidate=True):
+    """
+    :param root: top directory of the walk
+    :param patterns: list (or comma separated string) of glob patterns, e.g. "*.dcm,*.DCM"
+    :param index: DirectoryIndex to read listings from and store them to
+    :param revalidate: check the modification time of indexed directories. Without, indexed
+      listings are used as they are.
+    """
+    self.root = str(root)
+    self.patterns = self.normalizePatterns(patterns)
+    self._matcher = re.compile("|".join(fnmatch.translate(p) for p in self.patterns))
+    self._stack = [self.root]
+    self._visited = set()
+    self.index = index
+    self.revalidate = revalidate
+    self.canceled = False
+    self.num_directories = 0
+    self.num_listed = 0
+    self.num_files = 0
+
+  @staticmethod
+  def normalizePatterns(patterns):
+    """
+    Lower case, stripped and de-duplicated list of patterns.
+    """
+    if isinstance(patterns, str):
+      patterns = patterns.split(",")
+    normalized = []
+    for pattern in patterns:
+      pattern = pattern.strip().lower()
+      if pattern and pattern not in normalized:
+        normalized.append(pattern)
+    return normalized
+
+  def matches(self, file_name):
+    return self._matcher.match(file_name.lower()) is not None
+
+  @property
+  def done(self):
+    return self.canceled or len(self._stack) == 0
+
+  def cancel(self):
+    self.canceled = True
+    self._stack = []
+
+  def step(self, max_seconds=None):
+    """
+    Visit directories until the walk is done or max_seconds elapsed.
+    :return: list of DirectoryScanResult found during this step
+    """
+    found = []
+    deadline = None if max_seconds is None else time.monotonic() + max_seconds
+    while not self.done:
+      result = self._visit(self._stack.pop())
+      if result is not None:
+        found.append(result)
+      if deadline is not None and time.monotonic() >= deadline:
+        break
+    return found
+
+  def __iter__(self):
+    while not self.done:
+      # Yield each directory as soon as it is found
+      for result in self.step(0):
+        yield result
+
+  def _listDirectory(self, directory):
+    """
+    :return: DirectoryListing, from the index if it is still valid
+    """
+    listing = self.index.get(directory) if self.index is not None else None
+    if listing is not None and not self.revalidate:
+      return listing
+    st = os.stat(directory)
+    if listing is not None and listing.mtime_ns == st.st_mtime_ns:
+      return listing
+    files = []
+    subdirs = []
+    with os.scandir(directory) as it:
+      entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+      try:
+        is_dir = entry.is_dir()
+      except OSError:
+        continue
+      if is_dir:
+        subdirs.append(entry.path)
+      else:
+        files.append(entry.name)
+    self.num_listed += 1
+    listing = DirectoryListing(st.st_mtime_ns, (st.st_dev, st.st_ino), files, subdirs)
+    if self.index is not None:
+      self.index.set(directory, listing)
+    return listing
+
+  def _visit(self, directory):
+    try:
+      listing = self._listDirectory(directory)
+    except OSError as e:
+      logging.warning("Cannot read directory {}: {}".format(directory, e))
+      return None
+    # Guard against symbolic link loops
+    if listing.inode in self._visited:
+      return None
+    self._visited.add(listing.inode)
+    self.num_directories += 1
+    first_file = None
+    num_files = 0
+    for name in listing.files:
+      if self.matches(name):
+        num_files += 1
+        if first_file is None:
+          first_file = os.path.join(directory, name)
+    # Depth first, in name order
+    self._stack.extend(reversed(listing.subdirs))
+    if num_files == 0:
+      return None
+    self.num_files += num_files
+    return DirectoryScanResult(directory, first_file, num_files)
+
+def scanDirectories(root, patterns):
+  """
+  Generator of DirectoryScanResult for all directories under root with matching files.
+  """
+  return iter(DirectoryScanner(root, patterns))
@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+from collections import deque, namedtuple
+from pathlib import Path
+
+from .DirectoryScanner import DirectoryIndex, DirectoryScanner
+
+__all__ = ["FolderWatcher"]
+
+# Series directory still being written: signature of its files and since when it is unchanged
+_PendingDirectory = namedtuple("_PendingDirectory", ["signature", "since", "result"])
+
+#
+# FolderWatcher
+#
+
+class FolderWatcher:
+  """
+  Polls a drop folder for series directories, and queues each directory once its files did not
+  change for quiet_seconds, i.e. once the scanner finished sending it.
+  Every poll walks the tree with a DirectoryIndex, so unchanged directories are only stat'ed.
+  The files of a directory are only stat'ed while it is waiting for its quiet period.
+  A queued directory is not reported again unless it changes afterwards (e.g. another series
+  is added to it). At most max_queue directories wait in the queue, the others are admitted
+  on a later poll, so a burst of arrivals does not grow the queue without bounds.
+  """
+
+  def __init__(self, root, patterns, quiet_seconds=30.0, max_queue=100, index=None):
+    """
+    :param root: drop folder
+    :param patterns: patterns of the DICOM files, see DirectoryScanner
+    :param index: DirectoryIndex shared with other scans of root, a new one if None
+    """
+    self.root = str(root)
+    self.patterns = patterns
+    self.quiet_seconds = quiet_seconds
+    self.max_queue = max_queue
+    self.index = index if index is not None else DirectoryIndex()
+    self._pending = {}
+    # Directory path to its modification time when it was queued, None if not known yet
+    self._processed = {}
+    self._queue = deque()
+
+  def markProcessed(self, directories):
+    """
+    Do not queue these directories (e.g. found in the journal of the output directory) unless they change.
+    """
+    for directory in directories:
+      self._processed.setdefault(str(directory), None)
+
+  def numQueued(self):
+    return len(self._queue)
+
+  def numPending(self):
+    return len(self._pending)
+
+  def _signature(self, scanner, directory, listing):
+    num_files = 0
+    total_size = 0
+    latest = 0
+    for name in listing.files:
+      if not scanner.matches(name):
+        continue
+      try:
+        st = os.stat(os.path.join(directory, name))
+      except OSError:
+        continue
+      num_files += 1
+      total_size += st.st_size
+      latest = max(latest, st.st_mtime_ns)
+    return (num_files, total_size, latest)
+
+  def poll(self, now=None):
+    """
+    Look for new or changed directories, and queue the ones that became quiet.
+    :return: number of directories in the queue
+    """
+    now = time.monotonic() if now is None else now
+    scanner = DirectoryScanner(self.root, self.patterns, self.index)
+    seen = set()
+    for result in scanner:
+      directory = str(Path(result.path))
+      seen.add(directory)
+      listing = self.index.get(directory)
+      if directory in self._processed:
+        if self._processed[directory] is None:
+          self._processed[directory] = listing.mtime_ns
+        if self._processed[directory] == listing.mtime_ns:
+          continue
+        # Files were added or removed since it was processed
+        del self._processed[directory]
+      signature = self._signature(scanner, directory, listing)
+      pending = self._pending.get(directory)
+      if pending is None or pending.signature != signature:
+        self._pending[directory] = _PendingDirectory(signature, now, result)
+        continue
+      if now - pending.since < self.quiet_seconds:
+        continue
+      if len(self._queue) >= self.max_queue:
+        # Admitted on a later poll
+        continue
+      del self._pending[directory]
+      self._processed[directory] = listing.mtime_ns
+      self._queue.append(result)
+      logging.info("Series directory ready: {}".format(directory))
+    # Directories removed before their quiet period ended
+    for directory in [d for d in self._pending if d not in seen]:
+      del self._pending[directory]
+    return len(self._queue)
+
+  def takeReady(self, max_count=None):
+    """
+    Remove directories from the queue, in the order they became quiet.
+    :return: list of DirectoryScanResult
+    """
+    ready = []
+    while len(self._queue) > 0 and (max_count is None or len(ready) < max_count):
+      ready.append(self._queue.popleft())
+    return ready
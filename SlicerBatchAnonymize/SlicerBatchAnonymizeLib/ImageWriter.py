@@ -0,0 +1,165 @@
+import os
+import csv
+import time
+import zlib
+import logging
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ["WriterOptions", "parallelGzip", "compressWrittenFile", "uncompressedPath", "writeImage", "benchmarkWriters"]
+
+# Formats whose data can be gzip compressed: compressed by their extension, or optionally (NRRD)
+GZIP_FORMATS = [".nii.gz", ".gipl.gz"]
+OPTIONAL_GZIP_FORMATS = [".nrrd"]
+
+# Uncompressed data is compressed in blocks of this size, each block is a separate gzip member
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def _outputFormat(path):
+  name = str(path).lower()
+  for ext in GZIP_FORMATS + OPTIONAL_GZIP_FORMATS:
+    if name.endswith(ext):
+      return ext
+  return os.path.splitext(name)[1]
+
+#
+# WriterOptions
+#
+
+class WriterOptions:
+  """
+  Compression settings of the non-DICOM outputs.
+  level is the gzip level from 1 (fastest) to 9 (smallest), -1 for the default of the writer, and
+  0 for no compression: NRRD data is then written raw, .gz formats are written with stored blocks.
+  With more than one thread, the data is written uncompressed then gzip compressed in blocks
+  on that many threads (like pigz). Each block is a gzip member, which the ITK and Slicer
+  readers decompress as one stream.
+  """
+
+  def __init__(self, level=-1, threads=1):
+    self.level = level
+    self.threads = max(1, threads)
+
+  def __repr__(self):
+    return "WriterOptions(level={}, threads={})".format(self.level, self.threads)
+
+  def compress(self, path):
+    """
+    True if the data of path is compressed.
+    """
+    out_format = _outputFormat(path)
+    return out_format in GZIP_FORMATS or (out_format in OPTIONAL_GZIP_FORMATS and self.level != 0)
+
+  def parallel(self, path):
+    """
+    True if path is written uncompressed first, then compressed with parallelGzip(): with several
+    threads, or to store the data of a .gz format without compression.
+    """
+    return self.compress(path) and (self.threads > 1 or self.level == 0)
+
+def uncompressedPath(path):
+  """
+  Path the uncompressed data of path is written to before parallel compression, in the same directory.
+  """
+  path = Path(path)
+  out_format = _outputFormat(path)
+  stem = path.name[:-len(out_format)]
+  if out_format in GZIP_FORMATS:
+    out_format = out_format[:-len(".gz")]
+  return path.with_name(stem + ".partial" + out_format)
+
+def _compressBlock(data, level):
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+def parallelGzip(src, dst, level=-1, threads=1, block_size=BLOCK_SIZE):
+  """
+  Gzip compress the data read from the file object src to the file object dst, in blocks compressed
+  on threads threads (zlib releases the GIL). At most two blocks per thread are held in memory.
+  """
+  pending = deque()
+  with ThreadPoolExecutor(max_workers=threads) as pool:
+    # At least one member, an empty file is not a valid gzip file
+    pending.append(pool.submit(_compressBlock, src.read(block_size), level))
+    for data in iter(lambda: src.read(block_size), b""):
+      pending.append(pool.submit(_compressBlock, data, level))
+      if len(pending) >= 2 * threads:
+        dst.write(pending.popleft().result())
+    while pending:
+      dst.write(pending.popleft().result())
+
+def compressWrittenFile(uncompressed_path, path, options):
+  """
+  Compress a file written uncompressed (see uncompressedPath()) to path, and remove it.
+  A raw NRRD file keeps its header, with its encoding changed to gzip.
+  """
+  with open(str(uncompressed_path), "rb") as src, open(str(path), "wb") as dst:
+    if _outputFormat(path) == ".nrrd":
+      header = b""
+      while True:
+        line = src.readline()
+        if line == b"":
+          raise ValueError("No data in NRRD file {}".format(uncompressed_path))
+        if line.startswith(b"data file:"):
+          raise ValueError("NRRD files with detached data are not supported: {}".format(uncompressed_path))
+        if line.startswith(b"encoding:"):
+          line = b"encoding: gzip\n"
+        header += line
+        if line in (b"\n", b"\r\n"):
+          break
+      dst.write(header)
+    parallelGzip(src, dst, options.level, options.threads)
+  os.remove(str(uncompressed_path))
+
+def writeImage(image, path, options=None):
+  """
+  Write a SimpleITK image with the compression options.
+  :param options: WriterOptions, the writer defaults (compressed) if None
+  """
+  import SimpleITK as sitk
+  options = options or WriterOptions()
+  path = Path(path)
+  writer = sitk.ImageFileWriter()
+  if options.parallel(path):
+    written_path = uncompressedPath(path)
+    writer.SetUseCompression(False)
+  else:
+    written_path = path
+    writer.SetUseCompression(options.compress(path))
+    if options.level > 0 and hasattr(writer, "SetCompressionLevel"):
+      writer.SetCompressionLevel(options.level)
+  writer.SetFileName(str(written_path))
+  writer.Execute(image)
+  if written_path != path:
+    compressWrittenFile(written_path, path, options)
+
+def benchmarkWriters(image, work_dir, formats, options_list, writer=writeImage):
+  """
+  Write image in every format with every WriterOptions, and measure the time and file size.
+  Formats that are never compressed (.nii, .gipl) are only written with the first options.
+  :param writer: f(image, path, options), writeImage by default
+  :return: list of dicts with "format", "level", "threads", "seconds" and "bytes", also written to
+    writer_benchmark.csv in work_dir
+  """
+  work_dir = Path(work_dir)
+  work_dir.mkdir(parents=True, exist_ok=True)
+  rows = []
+  for out_format in formats:
+    for options in options_list:
+      path = work_dir / ("benchmark" + out_format)
+      if _outputFormat(path) not in GZIP_FORMATS + OPTIONAL_GZIP_FORMATS and options is not options_list[0]:
+        continue
+      start = time.perf_counter()
+      writer(image, path, options)
+      seconds = time.perf_counter() - start
+      rows.append({"format": out_format, "level": options.level, "threads": options.threads,
+                   "seconds": "%.4f" % seconds, "bytes": os.path.getsize(str(path))})
+      os.remove(str(path))
+      logging.info("{} level {} with {} threads: {:.3f} s, {} bytes".format(
+        out_format, options.level, options.threads, seconds, rows[-1]["bytes"]))
+  with open(str(work_dir / "writer_benchmark.csv"), "w", encoding="utf-8", newline="") as f:
+    w = csv.DictWriter(f, fieldnames=["format", "level", "threads", "seconds", "bytes"])
+    w.writeheader()
+    w.writerows(rows)
+  return rows
@@ -0,0 +1,135 @@
+import time
+import multiprocessing
+
+from .SeriesWorker import JobCanceled, initWorker
+
+__all__ = ["JobController"]
+
+#
+# JobController
+#
+
+class JobController:
+  """
+  Cancel, pause and resume a running batch, and estimate the time left from the measured throughput.
+  The state is held in multiprocessing events, passed to the worker processes when the pool is
+  created (see SeriesWorker.createWorkerPool()), so workers check it between files: a cancel stops
+  the running series within a file, a pause holds them until resumed.
+  Time spent paused is not counted in the throughput.
+  """
+
+  def __init__(self, clock=time.monotonic):
+    context = multiprocessing.get_context("spawn")
+    self._cancel_event = context.Event()
+    # Set while running, cleared while paused
+    self._run_event = context.Event()
+    self._run_event.set()
+    self._clock = clock
+    self.reset()
+
+  def reset(self, total=0):
+    """
+    Start a new batch: clear the cancel and pause requests, see start() for total.
+    """
+    self._cancel_event.clear()
+    self._run_event.set()
+    self.start(total)
+
+  def start(self, total):
+    """
+    Start measuring the throughput of total series, e.g. once the series to process are known.
+    """
+    self.total = total
+    self.completed = 0
+    self._active_seconds = 0.0
+    self._running_since = self._clock()
+
+  def workerArgs(self):
+    """
+    Arguments of SeriesWorker.initWorker() for the worker processes.
+    """
+    return (self._cancel_event, self._run_event)
+
+  def installInProcess(self, pump=None):
+    """
+    Make SeriesWorker.checkpoint() follow this controller in this process, for tasks not run by workers.
+    :param pump: f() called while paused, e.g. to process the GUI events
+    """
+    initWorker(self._cancel_event, self._run_event, pump)
+
+  def cancel(self):
+    self._cancel_event.set()
+    # Paused workers wake up to stop
+    self.resume()
+
+  def pause(self):
+    if self.isPaused() or self.isCanceled():
+      return
+    self._active_seconds += self._clock() - self._running_since
+    self._run_event.clear()
+
+  def resume(self):
+    if not self.isPaused():
+      return
+    self._running_since = self._clock()
+    self._run_event.set()
+
+  def isCanceled(self):
+    return self._cancel_event.is_set()
+
+  def isPaused(self):
+    return not self._run_event.is_set()
+
+  def checkpoint(self, pump=None):
+    """
+    Raise JobCanceled if canceled, wait while paused.
+    :param pump: f() called every 0.1 s while paused
+    """
+    if self.isCanceled():
+      raise JobCanceled("User stopped processing")
+    while not self._run_event.wait(0.1):
+      if pump is not None:
+        pump()
+      if self.isCanceled():
+        raise JobCanceled("User stopped processing")
+    # cancel() resumes the paused waiters so that they stop
+    if self.isCanceled():
+      raise JobCanceled("User stopped processing")
+
+  def advance(self, count=1):
+    """
+    Count series finished, for the ETA.
+    """
+    self.completed += count
+
+  def activeSeconds(self):
+    """
+    Time spent running since reset(), without the pauses.
+    """
+    if self.isPaused():
+      return self._active_seconds
+    return self._active_seconds + self._clock() - self._running_since
+
+  def eta(self):
+    """
+    Estimated seconds left, None before the first series is finished.
+    """
+    if self.completed == 0 or self.total == 0:
+      return None
+    remaining = max(0, self.total - self.completed)
+    return self.activeSeconds() / self.completed * remaining
+
+  def etaText(self):
+    """
+    Short text of the ETA for the progress message, "" if it is not known yet.
+    """
+    eta = self.eta()
+    if eta is None:
+      return ""
+    if self.isPaused():
+      return "paused"
+    minutes, seconds = divmod(int(eta + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+      return "about {}h{:02d}m left".format(hours, minutes)
+    return "about {}m{:02d}s left".format(minutes, seconds)
@@ -0,0 +1,94 @@
+import queue
+import logging
+import threading
+
+__all__ = ["runPipeline"]
+
+# Marks the end of the items in a queue
+_END = object()
+
+class _Failure:
+  """
+  Exception raised by a stage, passed down the queues and raised again by runPipeline().
+  """
+  def __init__(self, exception):
+    self.exception = exception
+
+def _put(q, item, stop):
+  while not stop.is_set():
+    try:
+      q.put(item, timeout=0.1)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+def _get(q, stop):
+  while not stop.is_set():
+    try:
+      return q.get(timeout=0.1)
+    except queue.Empty:
+      pass
+  return _END
+
+def _feed(items, q, stop):
+  try:
+    for item in items:
+      if not _put(q, item, stop):
+        return
+  except Exception as e:
+    _put(q, _Failure(e), stop)
+  _put(q, _END, stop)
+
+def _runStage(stage, q_in, q_out, stop):
+  while True:
+    item = _get(q_in, stop)
+    if item is _END:
+      _put(q_out, _END, stop)
+      return
+    if not isinstance(item, _Failure):
+      try:
+        item = stage(item)
+      except Exception as e:
+        item = _Failure(e)
+    if not _put(q_out, item, stop):
+      return
+
+def runPipeline(items, stages, queue_size=1, wait=None):
+  """
+  Run each item through the stages, each stage in its own thread, the stages joined by queues of
+  queue_size items. While a stage works on an item, the previous one already works on the next
+  item, e.g. reading the next series while the current one is written: I/O overlaps with compute
+  as far as the stages release the GIL (file I/O, SimpleITK, zlib). A stage waits when its output
+  queue is full, so at most queue_size items are held between two stages.
+  Results are yielded in the order of the items. Closing the generator early stops the stages
+  after the items they are working on.
+  :param stages: functions f(item) -> item, the first one is called with the items
+  :param wait: f() called every 0.1 s while waiting for a result, e.g. to process the GUI events
+  """
+  stop = threading.Event()
+  queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+  threads = [threading.Thread(target=_feed, args=(items, queues[0], stop), name="pipeline feed", daemon=True)]
+  for k, stage in enumerate(stages):
+    threads.append(threading.Thread(target=_runStage, args=(stage, queues[k], queues[k+1], stop),
+                                    name="pipeline stage {}".format(k+1), daemon=True))
+  for thread in threads:
+    thread.start()
+  try:
+    while True:
+      try:
+        item = queues[-1].get(timeout=0.1)
+      except queue.Empty:
+        if wait is not None:
+          wait()
+        continue
+      if item is _END:
+        break
+      if isinstance(item, _Failure):
+        raise item.exception
+      yield item
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+    logging.debug("Pipeline stopped")
@@ -0,0 +1,76 @@
+import time
+import threading
+
+__all__ = ["ProgressChannel"]
+
+#
+# ProgressChannel
+#
+
+class ProgressChannel:
+  """
+  Latest progress message and percentage of a batch. The processing loop publishes to it, which
+  only stores the values, and the GUI reads them from a timer: nothing is painted from the loop,
+  and many updates between two reads cost a single repaint.
+  When the batch runs in the GUI thread, the loop yields to the event loop (pump) at most max_rate
+  times per second, so the timer and the cancel controls still run. Publishing is thread safe.
+  """
+
+  def __init__(self, max_rate=10.0, pump=None, clock=time.monotonic):
+    """
+    :param pump: f(), processes the pending GUI events, e.g. slicer.app.processEvents
+    """
+    self.max_rate = max_rate
+    self.pump = pump
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._message = ""
+    self._percentage = 0.0
+    self._serial = 0
+    self._read_serial = 0
+    self._last_pump = None
+
+  @property
+  def interval(self):
+    """
+    Seconds between two reads or pumps.
+    """
+    return 1.0 / self.max_rate
+
+  def publish(self, message, percentage):
+    with self._lock:
+      self._message = message
+      self._percentage = percentage
+      self._serial += 1
+    self.pumpIfDue()
+
+  def pumpIfDue(self):
+    """
+    Call pump if it was not called in the last interval.
+    :return: True if it was called
+    """
+    if self.pump is None:
+      return False
+    now = self._clock()
+    if self._last_pump is not None and now - self._last_pump < self.interval:
+      return False
+    self._last_pump = now
+    self.pump()
+    return True
+
+  def latest(self):
+    """
+    :return: (message, percentage) last published
+    """
+    with self._lock:
+      return self._message, self._percentage
+
+  def read(self):
+    """
+    :return: (message, percentage) if something was published since the last read, None otherwise
+    """
+    with self._lock:
+      if self._serial == self._read_serial:
+        return None
+      self._read_serial = self._serial
+      return self._message, self._percentage
@@ -0,0 +1,128 @@
+import hmac
+import uuid
+import logging
+import hashlib
+import secrets
+import sqlite3
+from pathlib import Path
+
+__all__ = ["PseudonymStore", "DATE_OFFSETS"]
+
+# Days the birth date of a patient can be shifted by, 3 to 5 months either way
+DATE_OFFSETS = [d * 30 for d in (-5, -4, -3, 3, 4, 5)]
+
+#
+# PseudonymStore
+#
+
+class PseudonymStore:
+  """
+  Persistent pseudonyms of the patients (with their date offset), studies and series, keyed by the
+  original PatientID, StudyInstanceUID and SeriesInstanceUID, so every batch run with the same store
+  reuses them.
+  New pseudonyms are derived from a keyed hash of the original identifier, with a secret created
+  with the store: processes sharing the store (concurrent batches, shards) derive the same values
+  without waiting for each other, so writes are batched and conflicts are harmless (INSERT OR IGNORE,
+  the first stored value wins and is read back by flush()). Lookups go through an in-memory cache,
+  then the primary key of the table.
+  """
+
+  KINDS = ("patient", "study", "series")
+
+  def __init__(self, path, batch_size=1000):
+    """
+    :param path: sqlite file of the store, created if needed
+    :param batch_size: number of new pseudonyms written together
+    """
+    self.path = Path(path)
+    self.batch_size = batch_size
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    self._db = sqlite3.connect(str(self.path), timeout=30)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    self._db.execute("CREATE TABLE IF NOT EXISTS pseudonyms (kind TEXT, original TEXT, pseudonym TEXT, date_offset INTEGER, "
+                     "PRIMARY KEY (kind, original)) WITHOUT ROWID")
+    self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    self._db.execute("INSERT OR IGNORE INTO meta VALUES ('secret', ?)", (secrets.token_hex(32),))
+    self._db.commit()
+    self._secret = self._db.execute("SELECT value FROM meta WHERE key = 'secret'").fetchone()[0].encode("ascii")
+    self._cache = {}
+    self._pending = {}
+
+  def _digest(self, kind, original):
+    return hmac.new(self._secret, (kind + "|" + original).encode("utf-8"), hashlib.sha256).digest()
+
+  def _get(self, kind, original):
+    key = (kind, original)
+    if key in self._cache:
+      return self._cache[key]
+    row = self._db.execute("SELECT pseudonym, date_offset FROM pseudonyms WHERE kind = ? AND original = ?", key).fetchone()
+    if row is None:
+      digest = self._digest(kind, original)
+      # UID from a UUID, as pydicom.uid.generate_uid(None) does
+      row = ("2.25.{}".format(uuid.UUID(bytes=digest[:16]).int), DATE_OFFSETS[digest[16] % len(DATE_OFFSETS)]
+             if kind == "patient" else None)
+      self._add(key, row)
+    self._cache[key] = tuple(row)
+    return self._cache[key]
+
+  def _add(self, key, row):
+    self._pending[key] = row
+    if len(self._pending) >= self.batch_size:
+      self.flush()
+
+  def patient(self, original):
+    """
+    :return: (pseudonymized PatientID, date offset in days)
+    """
+    return self._get("patient", original)
+
+  def study(self, original):
+    return self._get("study", original)[0]
+
+  def series(self, original):
+    return self._get("series", original)[0]
+
+  def add(self, kind, original, pseudonym, date_offset=None):
+    """
+    Store a pseudonym made elsewhere (e.g. in the journal of an earlier batch) unless the original
+    identifier already has one, in the cache or in the table: the stored value is kept.
+    :param kind: one of KINDS
+    :return: (pseudonym, date offset) of the original identifier from now on
+    """
+    key = (kind, original)
+    if key not in self._cache:
+      row = self._db.execute("SELECT pseudonym, date_offset FROM pseudonyms WHERE kind = ? AND original = ?", key).fetchone()
+      if row is None:
+        self._add(key, (pseudonym, date_offset))
+      self._cache[key] = (pseudonym, date_offset) if row is None else tuple(row)
+    if self._cache[key] != (pseudonym, date_offset):
+      logging.warning("The pseudonym store already has another {} pseudonym for this identifier, keeping it".format(kind))
+    return self._cache[key]
+
+  def flush(self):
+    """
+    Write the new pseudonyms in one transaction. Where another process stored a different value
+    first, its value replaces the cached one.
+    """
+    if not self._pending:
+      return
+    pending = self._pending
+    self._pending = {}
+    with self._db:
+      self._db.executemany("INSERT OR IGNORE INTO pseudonyms VALUES (?, ?, ?, ?)",
+                           [key + row for key, row in pending.items()])
+    for key in pending:
+      row = self._db.execute("SELECT pseudonym, date_offset FROM pseudonyms WHERE kind = ? AND original = ?", key).fetchone()
+      if row is not None:
+        self._cache[key] = tuple(row)
+
+  def __len__(self):
+    self.flush()
+    return self._db.execute("SELECT COUNT(*) FROM pseudonyms").fetchone()[0]
+
+  def close(self):
+    if self._db is not None:
+      self.flush()
+      self._db.close()
+      self._db = None
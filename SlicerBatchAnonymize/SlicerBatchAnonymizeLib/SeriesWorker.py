@@ -0,0 +1,289 @@
+import os
+import time
+import shutil
+import logging
+import threading
+import functools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from .BatchTimings import currentRSS
+from .ImageWriter import writeImage
+from .Pipeline import runPipeline
+
+__all__ = ["STATUS_DONE", "STATUS_SKIPPED", "STATUS_ERROR", "STATUS_CANCELED", "JobCanceled",
+           "initWorker", "checkpoint", "seriesStage", "readSeriesImage", "writeSeriesImage", "EXPORT_STAGES",
+           "exportSeries", "createWorkerPool", "runSeriesTasks", "runSeriesPipeline"]
+
+STATUS_DONE = "done"
+STATUS_SKIPPED = "skipped"
+STATUS_ERROR = "error"
+# Stopped by the user before completion, not recorded so a resumed run processes the series again
+STATUS_CANCELED = "canceled"
+
+#
+# Cancel and pause checks
+#
+
+class JobCanceled(Exception):
+  """
+  Raised by checkpoint() when the batch is canceled.
+  """
+  pass
+
+# Events of the JobController of the batch, set in each worker process by initWorker()
+_cancel_event = None
+_run_event = None
+_pump = None
+
+def initWorker(cancel_event=None, run_event=None, pump=None):
+  """
+  Make checkpoint() follow the events of a JobController, see JobController.workerArgs().
+  Used as the initializer of the worker processes, and called in the main process for tasks run there.
+  :param pump: f() called while paused, e.g. to process the GUI events in the main process
+  """
+  global _cancel_event, _run_event, _pump
+  _cancel_event = cancel_event
+  _run_event = run_event
+  _pump = pump
+
+def checkpoint():
+  """
+  Raise JobCanceled if the batch was canceled, and wait while it is paused.
+  Called between files and between the steps of a series, so it must stay cheap.
+  """
+  if _cancel_event is not None and _cancel_event.is_set():
+    raise JobCanceled("User stopped processing")
+  if _run_event is None:
+    return
+  while not _run_event.wait(0.1):
+    # The GUI events are only processed from the main thread, pipeline stages just wait
+    if _pump is not None and threading.current_thread() is threading.main_thread():
+      _pump()
+    if _cancel_event is not None and _cancel_event.is_set():
+      raise JobCanceled("User stopped processing")
+  # A cancel resumes the paused workers so that they stop
+  if _cancel_event is not None and _cancel_event.is_set():
+    raise JobCanceled("User stopped processing")
+
+#
+# Series export outside of the MRML scene
+#
+
+def _sortedSeriesFiles(files, seriesUID):
+  """
+  Return the files of the series in slice order.
+  GDCM sorts the files of the series found in the directory, files that are not part of
+  the requested list are dropped so that the result matches what the database returned.
+  """
+  import SimpleITK as sitk
+  if len(files) < 2:
+    return list(files)
+  directory = os.path.dirname(files[0])
+  requested = set(os.path.normpath(f) for f in files)
+  try:
+    ordered = [f for f in sitk.ImageSeriesReader.GetGDCMSeriesFileNames(directory, seriesUID or "")
+               if os.path.normpath(f) in requested]
+  except RuntimeError:
+    ordered = []
+  if len(ordered) != len(requested):
+    ordered = sorted(files)
+  return ordered
+
+def seriesStage(function):
+  """
+  Make a step of a series export a stage: the step takes the state of the series, a dict with
+  "task" and "result" (see exportSeries()) that it updates. It is not run once the series is
+  skipped, canceled or failed, and its exceptions are turned into the status of the result.
+  """
+  @functools.wraps(function)
+  def stage(state):
+    result = state["result"]
+    if result["status"] != STATUS_DONE:
+      return state
+    try:
+      function(state)
+    except JobCanceled as e:
+      result["status"] = STATUS_CANCELED
+      result["message"] = str(e)
+    except Exception as e:
+      result["status"] = STATUS_ERROR
+      result["message"] = str(e)
+    if result["status"] != STATUS_DONE:
+      # Nothing is left to do with the data read so far
+      state.pop("image", None)
+      state.pop("datasets", None)
+    return state
+  return stage
+
+def newState(task):
+  return {"task": task, "result": {"index": task["index"], "status": STATUS_DONE, "message": "", "stages": {}}}
+
+def _executeReader(reader):
+  """
+  Run a SimpleITK reader, calling checkpoint() on its progress events: the series reader reports
+  its progress after each file, so a large series can be paused or canceled while it is read.
+  """
+  import SimpleITK as sitk
+  canceled = []
+  def onProgress():
+    try:
+      checkpoint()
+    except JobCanceled as e:
+      canceled.append(e)
+      reader.Abort()
+  reader.AddCommand(sitk.sitkProgressEvent, onProgress)
+  try:
+    return reader.Execute()
+  except RuntimeError:
+    if canceled:
+      raise canceled[0]
+    raise
+  finally:
+    reader.RemoveAllCommands()
+
+@seriesStage
+def readSeriesImage(state):
+  """
+  Sort the files of the series and read them into state["image"].
+  """
+  import SimpleITK as sitk
+  task = state["task"]
+  stages = state["result"]["stages"]
+  checkpoint()
+  start = time.perf_counter()
+  files = _sortedSeriesFiles(task["files"], task.get("series"))
+  stages["sort"] = time.perf_counter() - start
+  checkpoint()
+  start = time.perf_counter()
+  if len(files) > 1:
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(files)
+  else:
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(files[0])
+  image = _executeReader(reader)
+  stages["read"] = time.perf_counter() - start
+  if image.GetDimension() < 3 or image.GetSize()[2] == 1:
+    state["result"]["status"] = STATUS_SKIPPED
+    state["result"]["message"] = "Image has only one slice, ignoring"
+    return
+  state["image"] = image
+
+@seriesStage
+def writeSeriesImage(state):
+  """
+  Write state["image"] to the output of the task.
+  """
+  task = state["task"]
+  checkpoint()
+  # Slicer compresses volumes by default, keep the same behavior for formats that support it
+  start = time.perf_counter()
+  writeImage(state["image"], task["output"], task.get("writer"))
+  state["result"]["stages"]["write"] = time.perf_counter() - start
+  # Measured while the image is still held
+  state["result"]["rss"] = currentRSS()
+  del state["image"]
+
+# Steps of exportSeries(), run one after the other or as a pipeline (see runSeriesPipeline())
+EXPORT_STAGES = [readSeriesImage, writeSeriesImage]
+
+def exportSeries(task):
+  """
+  Read one DICOM series and write it to a non-DICOM file.
+  Runs in a worker process, so it only relies on SimpleITK and never raises:
+  failures are returned in the result.
+  :param task: dict with "index" (position in the serial order), "files" (DICOM files of the series),
+    "series" (SeriesInstanceUID), "output" (path of the file to write) and optionally "writer"
+    (ImageWriter.WriterOptions)
+  :return: dict with "index", "status" (one of STATUS_*), "message", "stages" (stage name to seconds)
+    and "rss" (resident memory of the worker, if measured)
+  """
+  state = newState(task)
+  for stage in EXPORT_STAGES:
+    state = stage(state)
+  return state["result"]
+
+#
+# Worker pool
+#
+
+def createWorkerPool(num_workers, controller=None):
+  """
+  Create a process pool for exportSeries.
+  Worker processes are spawned with PythonSlicer when running inside Slicer, as the Slicer
+  application executable cannot be used as a plain Python interpreter.
+  :param controller: JobController the workers check between files, see checkpoint()
+  """
+  context = multiprocessing.get_context("spawn")
+  python_exe = shutil.which("PythonSlicer")
+  if python_exe:
+    context.set_executable(python_exe)
+  if controller is None:
+    return ProcessPoolExecutor(max_workers=num_workers, mp_context=context)
+  return ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                             initializer=initWorker, initargs=controller.workerArgs())
+
+def runSeriesTasks(tasks, num_workers, function=exportSeries, memory_limit=None, controller=None, wait=None):
+  """
+  Run function (exportSeries by default) on the tasks with num_workers processes.
+  function must be a module level function so it can be sent to the workers.
+  Results are yielded in the order of the tasks, regardless of the order they complete in,
+  so the caller produces the same outputs as a serial run. Closing the generator early
+  cancels the tasks that have not started yet.
+  At most two tasks per worker are submitted ahead, so finished results do not pile up.
+  :param memory_limit: when a result reports a worker resident memory ("rss") above this many
+    bytes, the pool is recycled: the submitted tasks are completed and new worker processes are started.
+  :param controller: JobController the workers check between files
+  :param wait: f() called every 0.1 s while waiting for a result, e.g. to process the GUI events
+  """
+  pool = createWorkerPool(num_workers, controller)
+  in_flight = deque()
+  remaining = iter(tasks)
+  task = next(remaining, None)
+  recycle = False
+  try:
+    while True:
+      while task is not None and not recycle and len(in_flight) < 2 * num_workers:
+        in_flight.append(pool.submit(function, task))
+        task = next(remaining, None)
+      if len(in_flight) == 0:
+        if task is None:
+          break
+        logging.info("Worker memory above {:.0f} MB, restarting the workers".format(memory_limit / (1024 * 1024)))
+        pool.shutdown(wait=True)
+        pool = createWorkerPool(num_workers, controller)
+        recycle = False
+        continue
+      future = in_flight.popleft()
+      while True:
+        try:
+          result = future.result(timeout=None if wait is None else 0.1)
+          break
+        except TimeoutError:
+          wait()
+      if memory_limit and (result.get("rss") or 0) > memory_limit:
+        recycle = True
+      yield result
+  finally:
+    for future in in_flight:
+      future.cancel()
+    pool.shutdown(wait=True)
+    logging.debug("Worker pool shut down")
+
+def runSeriesPipeline(tasks, stages=EXPORT_STAGES, queue_size=1, wait=None):
+  """
+  Run the tasks in this process with each stage (e.g. reading, writing) in its own thread, so the
+  next series is read while the current one is written, see Pipeline.runPipeline().
+  Results are yielded in the order of the tasks. At most queue_size series wait between two stages,
+  so the memory held is bounded by the number of stages and the queue size.
+  :param stages: seriesStage steps, EXPORT_STAGES or TagRewrite.REWRITE_STAGES
+  :param wait: f() called every 0.1 s while waiting for a result, e.g. to process the GUI events
+  """
+  states = runPipeline((newState(task) for task in tasks), stages, queue_size, wait)
+  try:
+    for state in states:
+      yield state["result"]
+  finally:
+    states.close()
@@ -0,0 +1,189 @@
+import os
+import csv
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+from .BatchJournal import BatchJournal
+
+__all__ = ["shardRange", "shardDirectoryName", "shardStateDir", "patientGroups", "shardRows", "selectShard", "writeShardInfo",
+           "checkPseudonyms", "mergeShards"]
+
+SHARD_INFO_NAME = "shard.json"
+
+def shardRange(num_items, num_shards, shard_index):
+  """
+  Contiguous range [start, stop) of the items assigned to a shard. Shard sizes differ by at most one.
+  """
+  if num_shards < 1 or not 0 <= shard_index < num_shards:
+    raise ValueError("Invalid shard {} of {}".format(shard_index, num_shards))
+  start = (num_items * shard_index) // num_shards
+  stop = (num_items * (shard_index + 1)) // num_shards
+  return start, stop
+
+def shardDirectoryName(num_shards, shard_index):
+  return "shard_%03d_of_%03d" % (shard_index + 1, num_shards)
+
+def shardStateDir(output_dir, state_dir, shard_name):
+  """
+  Directory of the journal of a shard: the shards of output_dir keep their journals in the state
+  directory of output_dir (BatchJournal.defaultStateDir() if state_dir is None), not in their output.
+  """
+  state_dir = Path(state_dir) if state_dir is not None else BatchJournal.defaultStateDir(output_dir)
+  return state_dir / shard_name
+
+def batchFingerprint(input_image_list, input_root):
+  """
+  Hash of the ordered directory list, relative to the input root as nodes may mount it at
+  different places. All the shards of a batch must see the same list, otherwise the partitions
+  would overlap or miss directories.
+  """
+  digest = hashlib.sha1()
+  for imgpath in input_image_list:
+    digest.update(os.path.relpath(str(imgpath), str(input_root)).encode("utf-8") + b"\n")
+  return digest.hexdigest()
+
+def patientGroups(input_image_list):
+  """
+  Rows of the directories grouped by the PatientID of their first file (see Crosswalk.patientID()),
+  in the order the patients are first found. Directories without a PatientID are grouped together,
+  as a single run gives them one pseudonym.
+  :return: list of lists of rows
+  """
+  groups = {}
+  for row in range(len(input_image_list)):
+    groups.setdefault(input_image_list.patientID(row), []).append(row)
+  return list(groups.values())
+
+def shardRows(input_image_list, num_shards, shard_index):
+  """
+  Rows of the directories assigned to a shard. All the directories of a patient go to the same
+  shard, so its studies and series get their pseudonyms from one run: a patient goes to the shard
+  whose range (see shardRange()) holds the number of directories of the patients before it.
+  :return: list of rows, in scan order
+  """
+  start, stop = shardRange(len(input_image_list), num_shards, shard_index)
+  rows = []
+  position = 0
+  for group in patientGroups(input_image_list):
+    if start <= position < stop:
+      rows.extend(group)
+    position += len(group)
+  return sorted(rows)
+
+def selectShard(input_image_list, num_shards, shard_index):
+  """
+  Keep the directories of one shard, see shardRows(). The input list must be the full list, in
+  scan order, with the output names already assigned: entries keep their name, so the names of
+  all shards are the names a single run would produce and never collide.
+  :return: Crosswalk of the directories of the shard
+  """
+  rows = shardRows(input_image_list, num_shards, shard_index)
+  return input_image_list.subset([input_image_list.entry(row).path for row in rows])
+
+def writeShardInfo(shard_dir, input_image_list, input_root, num_shards, shard_index):
+  """
+  Record which part of the batch a shard directory holds, used by mergeShards().
+  :param input_image_list: the full list of the batch, before selectShard()
+  """
+  rows = shardRows(input_image_list, num_shards, shard_index)
+  info = {"num_shards": num_shards, "shard_index": shard_index, "shard_directories": len(rows),
+          "num_directories": len(input_image_list), "fingerprint": batchFingerprint(input_image_list, input_root)}
+  with open(Path(shard_dir) / SHARD_INFO_NAME, "w", encoding="utf-8") as f:
+    json.dump(info, f, indent=2)
+
+def _readShardInfos(output_dir):
+  infos = []
+  for info_path in sorted(Path(output_dir).glob("shard_*/" + SHARD_INFO_NAME)):
+    with open(info_path, encoding="utf-8") as f:
+      info = json.load(f)
+    info["directory"] = info_path.parent
+    infos.append(info)
+  return infos
+
+def _readCsv(path):
+  if not path.exists():
+    return [], []
+  with open(path, encoding="utf-8", newline="") as f:
+    reader = csv.DictReader(f)
+    return list(reader.fieldnames or []), list(reader)
+
+def checkPseudonyms(records):
+  """
+  Check that every original PatientID and StudyInstanceUID has a single pseudonym, and that no
+  two of them share one, across the journal records of all the shards.
+  :param records: iterable of journal records, see BatchJournal.loadRecords()
+  :raise ValueError: listing the identifiers with several pseudonyms
+  """
+  conflicts = []
+  for kind in ("patient", "study"):
+    pseudonyms = {}
+    originals = {}
+    for record in records:
+      if kind not in record:
+        continue
+      pseudonyms.setdefault(record[kind], set()).add(record[kind + "_ded"])
+      originals.setdefault(record[kind + "_ded"], set()).add(record[kind])
+    conflicts.extend("{} {} has {} pseudonyms".format(kind, original, len(values))
+                     for original, values in pseudonyms.items() if len(values) > 1)
+    conflicts.extend("{} pseudonym {} is shared by {} identifiers".format(kind, pseudonym, len(values))
+                     for pseudonym, values in originals.items() if len(values) > 1)
+  if conflicts:
+    raise ValueError("The shards do not agree on the pseudonyms:\n" + "\n".join(conflicts))
+
+def mergeShards(output_dir, state_dir=None):
+  """
+  Combine the crosswalk, details and error files of the shards found in output_dir (written by
+  runs with the same number of shards) into output_dir, in shard order, i.e. the order of a single
+  run. Fails if the shards gave different pseudonyms to the same patient or study, see checkPseudonyms().
+  :param state_dir: state directory the shards were run with, see shardStateDir()
+  :return: number of crosswalk rows
+  """
+  output_dir = Path(output_dir)
+  infos = _readShardInfos(output_dir)
+  if len(infos) == 0:
+    raise ValueError("No shard found in {}".format(output_dir))
+  num_shards = infos[0]["num_shards"]
+  if any(info["num_shards"] != num_shards or info["fingerprint"] != infos[0]["fingerprint"] for info in infos):
+    raise ValueError("The shards in {} do not belong to the same batch".format(output_dir))
+  missing = set(range(num_shards)) - set(info["shard_index"] for info in infos)
+  if missing:
+    raise ValueError("Missing shards: {}".format(", ".join(str(i+1) for i in sorted(missing))))
+  infos.sort(key=lambda info: info["shard_index"])
+  checkPseudonyms([record for info in infos for record in BatchJournal.loadRecords(
+    info["directory"], shardStateDir(output_dir, state_dir, info["directory"].name)).values()])
+
+  crosswalk = []
+  details_fields = []
+  details = []
+  errors = []
+  for info in infos:
+    shard_dir = info["directory"]
+    crosswalk.extend(_readCsv(shard_dir / BatchJournal.CROSSWALK_NAME)[1])
+    fields, rows = _readCsv(shard_dir / BatchJournal.DETAILS_NAME)
+    details_fields.extend(f for f in fields if f not in details_fields)
+    details.extend(rows)
+    errors_path = shard_dir / BatchJournal.ERRORS_NAME
+    if errors_path.exists():
+      with open(errors_path, encoding="utf-8") as f:
+        errors.extend(line.rstrip("\n") for line in f if line.strip())
+
+  outputs = [row["output"] for row in crosswalk]
+  if len(set(outputs)) != len(outputs):
+    logging.warning("Some outputs appear in several shards")
+  with open(output_dir / BatchJournal.CROSSWALK_NAME, "w", encoding="utf-8", newline="") as f:
+    w = csv.DictWriter(f, ["input", "output"])
+    w.writeheader()
+    w.writerows(crosswalk)
+  if len(details) > 0:
+    with open(output_dir / BatchJournal.DETAILS_NAME, "w", encoding="utf-8", newline="") as f:
+      w = csv.DictWriter(f, details_fields)
+      w.writeheader()
+      w.writerows(details)
+  if len(errors) > 0:
+    with open(output_dir / BatchJournal.ERRORS_NAME, "w", encoding="utf-8") as f:
+      for e in errors:
+        f.write(e + "\n")
+  logging.info("Merged {} shards: {} series, {} errors".format(num_shards, len(crosswalk), len(errors)))
+  return len(crosswalk)
@@ -0,0 +1,147 @@
+import os
+import logging
+from pathlib import Path
+from collections import namedtuple
+
+__all__ = ["TRANSFER_SYNTAXES", "DatasetSpec", "PRESETS", "generateSeries", "generateDataset"]
+
+# Transfer syntaxes the generator can write with pydicom and numpy only
+TRANSFER_SYNTAXES = {
+  "explicit": "1.2.840.10008.1.2.1",
+  "implicit": "1.2.840.10008.1.2",
+  "deflated": "1.2.840.10008.1.2.1.99",
+  "rle": "1.2.840.10008.1.2.5",
+  }
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+# Shape of a synthetic batch. num_slices, matrix_sizes and transfer_syntaxes are cycled through
+# the series, so one dataset mixes them. single_slice_series are added to every study, the
+# anonymization skips them.
+DatasetSpec = namedtuple("DatasetSpec", ["name", "num_patients", "studies_per_patient", "series_per_study",
+                                         "num_slices", "matrix_sizes", "transfer_syntaxes", "single_slice_series"])
+
+PRESETS = {
+  "small": DatasetSpec("small", 2, 1, 3, (8, 12), (64,), ("explicit", "implicit", "deflated", "rle"), 1),
+  "medium": DatasetSpec("medium", 5, 2, 4, (64, 100), (256,), ("explicit", "implicit", "rle"), 1),
+  "large": DatasetSpec("large", 10, 2, 5, (200, 300), (512,), ("explicit", "rle"), 1),
+  }
+
+def _pixelArray(rng, num_slices, size):
+  """
+  Smooth volume with some noise, so the compressed formats behave as on real images.
+  """
+  import numpy as np
+  z, y, x = np.mgrid[0:num_slices, 0:size, 0:size]
+  center = size / 2.0
+  volume = 1000.0 - 2000.0 * ((x - center) ** 2 + (y - center) ** 2) / (center ** 2) + 5.0 * z
+  volume += rng.normal(0, 20, volume.shape)
+  return np.clip(volume, -1024, 3071).astype(np.int16)
+
+def _saveDataset(ds, path, transfer_syntax):
+  import pydicom
+  if int(pydicom.__version__.split(".")[0]) >= 3:
+    ds.save_as(path, enforce_file_format=True)
+  else:
+    ds.is_little_endian = True
+    ds.is_implicit_VR = transfer_syntax == TRANSFER_SYNTAXES["implicit"]
+    ds.save_as(path, write_like_original=False)
+
+def generateSeries(directory, patient, study, series_number, num_slices, size, transfer_syntax="explicit", rng=None):
+  """
+  Write a CT series, one file per slice, to directory.
+  :param patient: (PatientID, PatientName, PatientBirthDate, PatientSex)
+  :param study: (StudyInstanceUID, StudyDate)
+  :param transfer_syntax: key of TRANSFER_SYNTAXES
+  :return: list of the written files
+  """
+  import numpy as np
+  import pydicom
+  from pydicom.dataset import Dataset, FileMetaDataset
+  from pydicom.uid import generate_uid
+  rng = rng if rng is not None else np.random.default_rng(0)
+  transfer_syntax_uid = TRANSFER_SYNTAXES[transfer_syntax]
+  directory = Path(directory)
+  directory.mkdir(parents=True, exist_ok=True)
+  series_uid = generate_uid()
+  frame_of_reference = generate_uid()
+  pixels = _pixelArray(rng, num_slices, size)
+  files = []
+  for index in range(num_slices):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax_uid
+    ds.file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.PatientID, ds.PatientName, ds.PatientBirthDate, ds.PatientSex = patient
+    ds.StudyInstanceUID, ds.StudyDate = study
+    ds.StudyTime = "120000"
+    ds.StudyID = "1"
+    ds.AccessionNumber = "ACC" + ds.PatientID
+    ds.InstitutionName = "Synthetic Hospital"
+    ds.ReferringPhysicianName = "Doe^Jane"
+    ds.Modality = "CT"
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.FrameOfReferenceUID = frame_of_reference
+    ds.InstanceNumber = index + 1
+    ds.ImagePositionPatient = [-size / 2.0, -size / 2.0, float(index)]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [1.0, 1.0]
+    ds.SliceThickness = 1.0
+    ds.RescaleIntercept = 0
+    ds.RescaleSlope = 1
+    ds.Rows = size
+    ds.Columns = size
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    if transfer_syntax == "rle":
+      ds.compress(pydicom.uid.RLELossless, pixels[index])
+    else:
+      ds.PixelData = pixels[index].tobytes()
+    path = str(directory / "IMG{:04d}.dcm".format(index + 1))
+    _saveDataset(ds, path, transfer_syntax_uid)
+    files.append(path)
+  return files
+
+def generateDataset(root, spec, seed=0):
+  """
+  Write a synthetic batch to root: root/<patient>/<study>/<series>/IMG*.dcm
+  :param spec: DatasetSpec, or the name of one of the PRESETS
+  :return: dict with "num_series", "num_single_slice", "num_files" and "bytes"
+  """
+  import numpy as np
+  from pydicom.uid import generate_uid
+  if isinstance(spec, str):
+    spec = PRESETS[spec]
+  rng = np.random.default_rng(seed)
+  root = Path(root)
+  summary = {"num_series": 0, "num_single_slice": 0, "num_files": 0, "bytes": 0}
+  series_index = 0
+  for p in range(spec.num_patients):
+    patient = ("SYN{:04d}".format(p), "Synthetic^Patient{}".format(p), "19{:02d}0101".format(50 + p % 50), "MF"[p % 2])
+    for s in range(spec.studies_per_patient):
+      study = (generate_uid(), "2020{:02d}01".format(1 + s % 12))
+      study_dir = root / patient[0] / "study{:02d}".format(s)
+      num_series = spec.series_per_study + spec.single_slice_series
+      for k in range(num_series):
+        single_slice = k >= spec.series_per_study
+        num_slices = 1 if single_slice else spec.num_slices[series_index % len(spec.num_slices)]
+        size = spec.matrix_sizes[series_index % len(spec.matrix_sizes)]
+        transfer_syntax = spec.transfer_syntaxes[series_index % len(spec.transfer_syntaxes)]
+        files = generateSeries(study_dir / "series{:02d}".format(k), patient, study, k + 1, num_slices, size,
+                               transfer_syntax, rng)
+        series_index += 1
+        summary["num_series"] += 1
+        summary["num_single_slice"] += 1 if single_slice else 0
+        summary["num_files"] += len(files)
+        summary["bytes"] += sum(os.path.getsize(f) for f in files)
+  logging.info("Generated {} series ({} single slice), {} files, {:.1f} MB in {}".format(
+    summary["num_series"], summary["num_single_slice"], summary["num_files"], summary["bytes"] / 1e6, root))
+  return summary
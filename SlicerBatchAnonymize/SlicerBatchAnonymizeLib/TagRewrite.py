@@ -0,0 +1,226 @@
+import os
+import time
+import shutil
+import logging
+from pathlib import Path
+
+from .SeriesWorker import STATUS_DONE, STATUS_SKIPPED, STATUS_ERROR, STATUS_CANCELED, JobCanceled, checkpoint, seriesStage
+from .BatchTimings import currentRSS
+
+__all__ = ["IDENTIFYING_KEYWORDS", "BLANKED_VRS", "KEPT_UID_KEYWORDS", "rewriteSeries", "renameSeries",
+           "readSeriesFiles", "anonymizeSeriesFiles", "writeSeriesFiles", "REWRITE_STAGES"]
+
+# Elements that identify the patient, the site or the staff, or may hold free text about them.
+# They are emptied wherever they appear, in nested sequences too, unless the anonymization
+# explicitly sets them.
+IDENTIFYING_KEYWORDS = [
+  "PatientName", "PatientID", "OtherPatientIDs", "OtherPatientIDsSequence", "OtherPatientNames",
+  "IssuerOfPatientID", "PatientBirthName", "PatientBirthDate", "PatientBirthTime", "PatientSex",
+  "PatientAge", "PatientAddress", "PatientTelephoneNumbers", "PatientMotherBirthName", "MilitaryRank",
+  "EthnicGroup", "Occupation", "PatientReligiousPreference", "PatientComments", "AdditionalPatientHistory",
+  "MedicalRecordLocator", "ReferencedPatientSequence", "AdmissionID", "CurrentPatientLocation",
+  "StudyDate", "SeriesDate", "AcquisitionDate", "ContentDate", "InstanceCreationDate",
+  "StudyTime", "SeriesTime", "AcquisitionTime", "ContentTime", "InstanceCreationTime",
+  "AcquisitionDateTime", "AccessionNumber", "StudyID", "InstitutionName", "InstitutionAddress",
+  "InstitutionCodeSequence", "InstitutionalDepartmentName", "StationName", "DeviceSerialNumber",
+  "ReferringPhysicianName", "ReferringPhysicianAddress", "ReferringPhysicianTelephoneNumbers",
+  "PerformingPhysicianName", "NameOfPhysiciansReadingStudy", "PhysiciansOfRecord",
+  "OperatorsName", "RequestingPhysician", "RequestingService", "RequestAttributesSequence",
+  "StudyDescription", "SeriesDescription", "ProtocolName", "ImageComments", "StudyComments",
+  "DerivationDescription", "PerformedProcedureStepID", "PerformedProcedureStepDescription",
+  "PerformedStationName", "PerformedLocation", "RequestedProcedureID", "RequestedProcedureDescription",
+  "ScheduledProcedureStepID", "ScheduledProcedureStepDescription",
+  ]
+
+# Value representations emptied wherever they appear: dates, times, person names and free text
+BLANKED_VRS = ("DA", "DT", "TM", "PN", "LT", "ST", "UT")
+
+# UIDs naming a standard class or encoding rather than an instance, kept as they are. Every other
+# UID is replaced, consistently within a series, so that no reference leads back to the source data.
+KEPT_UID_KEYWORDS = ("SOPClassUID", "ReferencedSOPClassUID", "TransferSyntaxUID")
+
+_IDENTIFYING = frozenset(IDENTIFYING_KEYWORDS)
+
+def _setElement(ds, keyword, value):
+  if keyword in ds:
+    ds.data_element(keyword).value = value
+  elif value != "":
+    setattr(ds, keyword, value)
+
+def _seriesTags(task):
+  """
+  :return: (keyword to value of the anonymized elements, dict of original to new UID shared by the
+    files of the series)
+  """
+  tags = dict(task["tags"])
+  tags.setdefault("PatientName", task.get("name", ""))
+  return tags, {}
+
+def _newUID(uids, uid):
+  from pydicom.uid import generate_uid
+  if uid not in uids:
+    uids[uid] = generate_uid()
+  return uids[uid]
+
+def _anonymizeDataset(ds, tags, uids):
+  """
+  Anonymize a dataset in place, walking the nested sequences as well.
+  :param uids: dict of original to new UID, filled as the files of the series are anonymized
+  """
+  ds.remove_private_tags()
+  # References to the study and the series lead to their pseudonyms
+  for keyword in ("StudyInstanceUID", "SeriesInstanceUID"):
+    if keyword in tags and keyword in ds:
+      uids.setdefault(str(ds.data_element(keyword).value), tags[keyword])
+
+  def anonymizeElement(dataset, elem):
+    if elem.keyword in _IDENTIFYING:
+      elem.value = [] if elem.VR == "SQ" else ""
+    elif elem.VR in BLANKED_VRS:
+      elem.value = ""
+    elif elem.VR == "UI" and elem.keyword not in KEPT_UID_KEYWORDS and elem.value:
+      if elem.VM > 1:
+        elem.value = [_newUID(uids, str(uid)) for uid in elem.value]
+      else:
+        elem.value = _newUID(uids, str(elem.value))
+
+  ds.walk(anonymizeElement)
+  for keyword, value in tags.items():
+    _setElement(ds, keyword, value)
+  if "SOPInstanceUID" not in ds:
+    from pydicom.uid import generate_uid
+    ds.SOPInstanceUID = generate_uid()
+  if getattr(ds, "file_meta", None) is not None:
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+def _isSingleSlice(files):
+  import pydicom
+  if len(files) != 1:
+    return False
+  ds = pydicom.dcmread(files[0], stop_before_pixels=True, specific_tags=["NumberOfFrames"])
+  return int(ds.get("NumberOfFrames", 1) or 1) < 2
+
+def _outputPath(output_folder, file_idx):
+  return os.path.join(str(output_folder), "IMG%04d.dcm" % (file_idx+1))
+
+def rewriteSeries(task):
+  """
+  Anonymize a DICOM series by rewriting its header only.
+  The pixel data element is copied as stored in the source files, so compressed transfer
+  syntaxes are kept and never decoded. Runs in worker processes, so it never raises:
+  failures are returned in the result. Files are read and written one at a time, see
+  REWRITE_STAGES for the pipelined version.
+  :param task: dict with "index", "files" (DICOM files of the series), "output" (folder to write to),
+    "name" (output name, used as PatientName) and "tags" (keyword to value of the anonymized elements)
+  :return: dict with "index", "status" (one of STATUS_*), "message", "stages" (stage name to seconds)
+    and "rss" (resident memory of the worker, if measured)
+  """
+  import pydicom
+  stages = {"read": 0.0, "anonymize": 0.0, "write": 0.0}
+  result = {"index": task["index"], "status": STATUS_DONE, "message": "", "stages": stages}
+  try:
+    files = sorted(task["files"])
+    if _isSingleSlice(files):
+      result["status"] = STATUS_SKIPPED
+      result["message"] = "Image has only one slice, ignoring"
+      return result
+    output_folder = Path(task["output"])
+    output_folder.mkdir(parents=True, exist_ok=True)
+    tags, uids = _seriesTags(task)
+    for file_idx, path in enumerate(files):
+      checkpoint()
+      start = time.perf_counter()
+      ds = pydicom.dcmread(path)
+      stages["read"] += time.perf_counter() - start
+      start = time.perf_counter()
+      _anonymizeDataset(ds, tags, uids)
+      stages["anonymize"] += time.perf_counter() - start
+      # Written with the original transfer syntax, pixel data bytes are untouched
+      start = time.perf_counter()
+      ds.save_as(_outputPath(output_folder, file_idx))
+      stages["write"] += time.perf_counter() - start
+    result["rss"] = currentRSS()
+  except JobCanceled as e:
+    result["status"] = STATUS_CANCELED
+    result["message"] = str(e)
+  except Exception as e:
+    result["status"] = STATUS_ERROR
+    result["message"] = str(e)
+    logging.debug("Failed to rewrite {}: {}".format(task.get("output"), e))
+  return result
+
+def renameSeries(source, output, patient_name):
+  """
+  Copy the DICOM files of an anonymized series to the folder output, with another PatientName,
+  e.g. for a duplicate of the series. The other elements, UIDs included, are those of the source
+  and the pixel data is copied as stored.
+  """
+  import pydicom
+  output = Path(output)
+  if output.exists():
+    shutil.rmtree(str(output))
+  output.mkdir(parents=True)
+  for path in sorted(Path(source).iterdir()):
+    if path.is_file():
+      ds = pydicom.dcmread(str(path))
+      ds.PatientName = patient_name
+      ds.save_as(str(output / path.name))
+
+#
+# Pipeline stages, a whole series is held in memory between two stages
+#
+
+@seriesStage
+def readSeriesFiles(state):
+  """
+  Read the files of the series, pixel data included, into state["datasets"].
+  """
+  import pydicom
+  task = state["task"]
+  result = state["result"]
+  stages = result["stages"]
+  stages.update({"read": 0.0, "anonymize": 0.0, "write": 0.0})
+  files = sorted(task["files"])
+  if _isSingleSlice(files):
+    result["status"] = STATUS_SKIPPED
+    result["message"] = "Image has only one slice, ignoring"
+    return
+  datasets = []
+  for path in files:
+    checkpoint()
+    start = time.perf_counter()
+    datasets.append(pydicom.dcmread(path))
+    stages["read"] += time.perf_counter() - start
+  state["datasets"] = datasets
+
+@seriesStage
+def anonymizeSeriesFiles(state):
+  """
+  Rewrite the identifying elements of state["datasets"].
+  """
+  stages = state["result"]["stages"]
+  tags, uids = _seriesTags(state["task"])
+  for ds in state["datasets"]:
+    checkpoint()
+    start = time.perf_counter()
+    _anonymizeDataset(ds, tags, uids)
+    stages["anonymize"] += time.perf_counter() - start
+
+@seriesStage
+def writeSeriesFiles(state):
+  """
+  Write state["datasets"] to the output folder of the task.
+  """
+  stages = state["result"]["stages"]
+  output_folder = Path(state["task"]["output"])
+  output_folder.mkdir(parents=True, exist_ok=True)
+  for file_idx, ds in enumerate(state["datasets"]):
+    checkpoint()
+    start = time.perf_counter()
+    ds.save_as(_outputPath(output_folder, file_idx))
+    stages["write"] += time.perf_counter() - start
+  state["result"]["rss"] = currentRSS()
+  del state["datasets"]
+
+# Steps of rewriteSeries() for SeriesWorker.runSeriesPipeline()
+REWRITE_STAGES = [readSeriesFiles, anonymizeSeriesFiles, writeSeriesFiles]
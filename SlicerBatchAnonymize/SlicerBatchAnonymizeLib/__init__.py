@@ -0,0 +1,23 @@
+"""
+Helpers for SlicerBatchAnonymize that do not depend on the MRML scene.
+Everything in this package must stay importable from a plain Python
+interpreter (PythonSlicer worker processes, command line runs).
+"""
+from .SeriesWorker import *
+from .ArchiveWriter import *
+from .DirectoryScanner import *
+from .DicomHeaders import *
+from .TagRewrite import *
+from .BatchJournal import *
+from .BatchTimings import *
+from .DedupCache import *
+from .BatchRunner import *
+from .Crosswalk import *
+from .FolderWatcher import *
+from .ImageWriter import *
+from .PseudonymStore import *
+from .Pipeline import *
+from .ProgressChannel import *
+from .JobController import *
+from .SyntheticData import *
+from .Sharding import *
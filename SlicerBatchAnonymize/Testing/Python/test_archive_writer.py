@@ -0,0 +1,145 @@
+import os
+import sys
+import tarfile
+import zipfile
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.ArchiveWriter import ArchiveWriter, readArchiveIndex, readArchiveMember
+
+class ArchiveWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.output_dir = Path(self.temp_dir.name) / "output"
+    self.output_dir.mkdir()
+    self.staging_dir = Path(self.temp_dir.name) / "staging"
+    self.staging_dir.mkdir()
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def writeOutput(self, name, folder):
+    """
+    Write the output of a series: a folder of files of varied sizes, or a single file.
+    """
+    if not folder:
+      path = self.staging_dir / (name + ".nii.gz")
+      path.write_bytes(os.urandom(700) + name.encode("ascii"))
+      return path
+    path = self.staging_dir / name
+    (path / "sub").mkdir(parents=True)
+    for index, size in enumerate((0, 1, 511, 512, 513, 3000)):
+      (path / ("IMG%d.dcm" % index)).write_bytes(os.urandom(size))
+    (path / "sub" / "extra.dcm").write_bytes(b"extra" * 50)
+    return path
+
+  def readMembers(self, archive_path):
+    """
+    :return: dict of member name to content, read with zipfile or tarfile
+    """
+    if archive_path.suffix == ".zip":
+      with zipfile.ZipFile(str(archive_path)) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+    with tarfile.open(str(archive_path)) as archive:
+      return {member.name: archive.extractfile(member).read() for member in archive.getmembers() if member.isfile()}
+
+  def checkIndex(self):
+    members = {}
+    for rows in readArchiveIndex(self.output_dir).values():
+      for row in rows:
+        if row["offset"] == "":
+          continue
+        if row["archive"] not in members:
+          members[row["archive"]] = self.readMembers(self.output_dir / row["archive"])
+        self.assertEqual(readArchiveMember(self.output_dir, row), members[row["archive"]][row["member"]])
+    return members
+
+  def writeSeries(self, archive_format, names, max_series=0, resume=False):
+    writer = ArchiveWriter(self.output_dir, archive_format, max_series=max_series, resume=resume)
+    added = {}
+    for index, name in enumerate(names):
+      added[name] = writer.add(name, self.writeOutput(name, index % 2 == 0), "/in/" + name)
+    writer.close()
+    return added
+
+  def test_zipOffsets(self):
+    self.writeSeries(".zip", ["File_0001", "File_0002", "File_0003"])
+    members = self.checkIndex()
+    self.assertEqual(list(members), ["archive_0001.zip"])
+    self.assertEqual(len(members["archive_0001.zip"]), 7 + 1 + 7)
+
+  def test_tarOffsets(self):
+    self.writeSeries(".tar", ["File_0001", "File_0002", "File_0003"])
+    members = self.checkIndex()
+    self.assertEqual(list(members), ["archive_0001.tar"])
+    self.assertEqual(len(members["archive_0001.tar"]), 15)
+
+  def test_maxSeriesStartsNewArchives(self):
+    added = self.writeSeries(".zip", ["File_%04d" % (index + 1) for index in range(5)], max_series=2)
+    self.assertEqual([Path(archive).name for archive, member in added.values()],
+                     ["archive_0001.zip", "archive_0001.zip", "archive_0002.zip", "archive_0002.zip", "archive_0003.zip"])
+    self.assertEqual(added["File_0001"][1], "File_0001/")
+    self.assertEqual(added["File_0002"][1], "File_0002.nii.gz")
+    self.checkIndex()
+
+  def test_reference(self):
+    writer = ArchiveWriter(self.output_dir, ".tar")
+    archive, member = writer.add("File_0001", self.writeOutput("File_0001", True), "/in/S1")
+    writer.addReference("File_0002", archive, member, "/in/S2")
+    writer.close()
+    rows = readArchiveIndex(self.output_dir)
+    self.assertEqual(set(row["input"] for row in rows["File_0001"]), {"/in/S1"})
+    self.assertEqual(rows["File_0002"], [{"name": "File_0002", "input": "/in/S2", "archive": "archive_0001.tar",
+                                          "member": "File_0001/", "offset": "", "size": ""}])
+
+  def test_resumeDiscardsUnfinishedZip(self):
+    self.writeSeries(".zip", ["File_0001", "File_0002", "File_0003"], max_series=2)
+    # A crash before the second archive was closed: no central directory
+    unfinished = self.output_dir / "archive_0002.zip"
+    unfinished.write_bytes(unfinished.read_bytes()[:-200])
+    writer = ArchiveWriter(self.output_dir, ".zip", resume=True)
+    self.assertEqual(writer.discarded, {"archive_0002.zip"})
+    self.assertFalse(unfinished.exists())
+    archive, member = writer.add("File_0003", self.writeOutput("File_0003x", True))
+    writer.close()
+    self.assertEqual(Path(archive).name, "archive_0003.zip")
+    rows = readArchiveIndex(self.output_dir)
+    self.assertEqual(sorted(rows), ["File_0001", "File_0002", "File_0003"])
+    self.assertEqual(set(row["archive"] for row in rows["File_0003"]), {"archive_0003.zip"})
+    self.checkIndex()
+
+  def test_resumeKeepsTar(self):
+    self.writeSeries(".tar", ["File_0001", "File_0002"])
+    writer = ArchiveWriter(self.output_dir, ".tar", resume=True)
+    self.assertEqual(writer.discarded, set())
+    archive, member = writer.add("File_0003", self.writeOutput("File_0003", True))
+    writer.close()
+    self.assertEqual(Path(archive).name, "archive_0002.tar")
+    self.assertEqual(len(readArchiveIndex(self.output_dir)), 3)
+    self.checkIndex()
+
+  def test_resumeAddsInputColumn(self):
+    self.writeSeries(".tar", ["File_0001"])
+    # Index written by an earlier version, without the input column
+    index_path = self.output_dir / ArchiveWriter.INDEX_NAME
+    lines = index_path.read_text(encoding="utf-8").splitlines(True)
+    index_path.write_text("".join(",".join(v for i, v in enumerate(line.split(",")) if i != 1) for line in lines),
+                          encoding="utf-8")
+    writer = ArchiveWriter(self.output_dir, ".tar", resume=True)
+    writer.add("File_0002", self.writeOutput("File_0002", False), "/in/File_0002")
+    writer.close()
+    rows = readArchiveIndex(self.output_dir)
+    self.assertEqual(set(row["input"] for row in rows["File_0001"]), {""})
+    self.assertEqual([row["input"] for row in rows["File_0002"]], ["/in/File_0002"])
+    self.checkIndex()
+
+  def test_unknownFormat(self):
+    with self.assertRaises(ValueError):
+      ArchiveWriter(self.output_dir, ".7z")
+
+if __name__ == "__main__":
+  unittest.main()
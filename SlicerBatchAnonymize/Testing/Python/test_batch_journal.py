@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.BatchJournal import BatchJournal
+from SlicerBatchAnonymizeLib.SeriesWorker import STATUS_DONE, STATUS_SKIPPED, STATUS_ERROR
+
+class BatchJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.output_dir = Path(self.temp_dir.name) / "output"
+    self.output_dir.mkdir()
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def recordSeries(self, journal, index, status=STATUS_DONE):
+    key = BatchJournal.seriesKey("/in/S%d" % index, "1.2.%d" % index)
+    output = self.output_dir / ("File_%04d" % (index + 1)) if status == STATUS_DONE else None
+    journal.record(key, status, "/in/S%d" % index, output, details={"PatientID": "P%d" % index}, name="File_%04d" % (index + 1))
+    return key
+
+  def readLines(self, name):
+    directory = BatchJournal.defaultStateDir(self.output_dir) if name == BatchJournal.JOURNAL_NAME else self.output_dir
+    with open(str(directory / name), encoding="utf-8") as f:
+      return f.read().splitlines()
+
+  def test_recordWritesTheOutputs(self):
+    journal = BatchJournal(self.output_dir)
+    self.recordSeries(journal, 0)
+    self.recordSeries(journal, 1, STATUS_ERROR)
+    self.recordSeries(journal, 2, STATUS_SKIPPED)
+    journal.close()
+    self.assertEqual(len(self.readLines(BatchJournal.JOURNAL_NAME)), 3)
+    self.assertEqual(self.readLines(BatchJournal.CROSSWALK_NAME),
+                     ["input,output", "/in/S0,{}".format(self.output_dir / "File_0001")])
+    self.assertEqual(self.readLines(BatchJournal.DETAILS_NAME), ["PatientID", "P0"])
+    self.assertEqual(self.readLines(BatchJournal.ERRORS_NAME), ["/in/S1"])
+
+  def test_resumeSkipsCompletedAndRetriesFailed(self):
+    journal = BatchJournal(self.output_dir)
+    done = self.recordSeries(journal, 0)
+    failed = self.recordSeries(journal, 1, STATUS_ERROR)
+    skipped = self.recordSeries(journal, 2, STATUS_SKIPPED)
+    journal.close()
+    journal = BatchJournal(self.output_dir, resume=True)
+    self.assertTrue(journal.isCompleted(done))
+    self.assertTrue(journal.isCompleted(skipped))
+    self.assertFalse(journal.isCompleted(failed))
+    self.assertEqual(journal.numCompleted(), 2)
+    self.recordSeries(journal, 1)
+    journal.close()
+    self.assertEqual(len(self.readLines(BatchJournal.CROSSWALK_NAME)), 3)
+    self.assertFalse((self.output_dir / BatchJournal.ERRORS_NAME).exists())
+
+  def test_resumeAfterTruncatedLine(self):
+    journal = BatchJournal(self.output_dir)
+    keys = [self.recordSeries(journal, index) for index in range(3)]
+    journal.close()
+    # A crash while writing the last record
+    path = BatchJournal.defaultStateDir(self.output_dir) / BatchJournal.JOURNAL_NAME
+    content = path.read_text(encoding="utf-8")
+    path.write_text(content[:len(content) - 20], encoding="utf-8")
+
+    journal = BatchJournal(self.output_dir, resume=True)
+    self.assertTrue(journal.isCompleted(keys[0]))
+    self.assertTrue(journal.isCompleted(keys[1]))
+    self.assertFalse(journal.isCompleted(keys[2]))
+    self.recordSeries(journal, 2)
+    journal.close()
+
+    records = BatchJournal.loadRecords(self.output_dir)
+    self.assertEqual(list(records.keys()), keys)
+    self.assertTrue(all(record["status"] == STATUS_DONE for record in records.values()))
+    # The journal is appended to, the new record starts on its own line
+    lines = self.readLines(BatchJournal.JOURNAL_NAME)
+    self.assertEqual(len(lines), 4)
+    self.assertEqual(json.loads(lines[-1])["key"], keys[2])
+    self.assertEqual(len(self.readLines(BatchJournal.CROSSWALK_NAME)), 4)
+
+  def test_retryMarksCompletedSeriesAsFailed(self):
+    journal = BatchJournal(self.output_dir)
+    keys = [self.recordSeries(journal, index) for index in range(2)]
+    journal.close()
+    journal = BatchJournal(self.output_dir, resume=True, retry=lambda record: record["name"] == "File_0002")
+    self.assertTrue(journal.isCompleted(keys[0]))
+    self.assertFalse(journal.isCompleted(keys[1]))
+    journal.close()
+    # Still retried if the run stops before exporting it again
+    journal = BatchJournal(self.output_dir, resume=True)
+    self.assertFalse(journal.isCompleted(keys[1]))
+    journal.close()
+
+  def test_journalIsOutsideTheOutput(self):
+    journal = BatchJournal(self.output_dir)
+    self.recordSeries(journal, 0)
+    journal.close()
+    self.assertFalse((self.output_dir / BatchJournal.JOURNAL_NAME).exists())
+    self.assertTrue((Path(self.temp_dir.name) / "output.state" / BatchJournal.JOURNAL_NAME).exists())
+    state_dir = Path(self.temp_dir.name) / "state"
+    journal = BatchJournal(self.output_dir, state_dir=state_dir)
+    self.recordSeries(journal, 1)
+    journal.close()
+    self.assertEqual(len(BatchJournal.loadRecords(self.output_dir, state_dir)), 1)
+
+  def test_journalInTheOutputIsMoved(self):
+    journal = BatchJournal(self.output_dir)
+    key = self.recordSeries(journal, 0)
+    journal.close()
+    # Journal of an earlier version, written into the output directory
+    state_path = BatchJournal.defaultStateDir(self.output_dir) / BatchJournal.JOURNAL_NAME
+    state_path.replace(self.output_dir / BatchJournal.JOURNAL_NAME)
+    journal = BatchJournal(self.output_dir, resume=True)
+    self.assertTrue(journal.isCompleted(key))
+    journal.close()
+    self.assertFalse((self.output_dir / BatchJournal.JOURNAL_NAME).exists())
+    self.assertTrue(state_path.exists())
+
+  def test_noResumeStartsANewJournal(self):
+    journal = BatchJournal(self.output_dir)
+    self.recordSeries(journal, 0)
+    journal.close()
+    journal = BatchJournal(self.output_dir)
+    self.assertEqual(journal.numCompleted(), 0)
+    journal.close()
+    self.assertEqual(BatchJournal.loadRecords(self.output_dir), {})
+
+if __name__ == "__main__":
+  unittest.main()
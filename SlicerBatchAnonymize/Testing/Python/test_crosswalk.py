@@ -0,0 +1,76 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.BatchJournal import BatchJournal
+from SlicerBatchAnonymizeLib.Crosswalk import Crosswalk
+from SlicerBatchAnonymizeLib.SeriesWorker import STATUS_DONE
+
+class CrosswalkTest(unittest.TestCase):
+
+  def createCrosswalk(self, num_directories=4):
+    crosswalk = Crosswalk()
+    for index in range(num_directories):
+      crosswalk.add("/in/S%d" % index)
+    crosswalk.assignNames("File")
+    return crosswalk
+
+  def test_rowsAndNames(self):
+    crosswalk = self.createCrosswalk()
+    self.assertEqual(len(crosswalk), 4)
+    self.assertEqual(crosswalk.row("/in/S2"), 2)
+    self.assertIsNone(crosswalk.row("/in/missing"))
+    self.assertIn(Path("/in/S1"), crosswalk)
+    self.assertEqual(crosswalk.add("/in/S1"), 1)
+    self.assertEqual(list(crosswalk), [Path("/in/S%d" % index) for index in range(4)])
+    self.assertEqual(crosswalk.names()[Path("/in/S3")], "File_0004")
+
+  def test_manualNamesAreKept(self):
+    crosswalk = self.createCrosswalk()
+    crosswalk.rename(1, "Manual")
+    crosswalk.assignNames("Other")
+    self.assertEqual([entry.name for entry in crosswalk.entries()], ["Other_0001", "Manual", "Other_0003", "Other_0004"])
+
+  def test_uuidNamesAreGeneratedOnce(self):
+    crosswalk = self.createCrosswalk()
+    crosswalk.assignNames("File", use_uuid=True)
+    names = [entry.name for entry in crosswalk.entries()]
+    crosswalk.assignNames("File", use_uuid=True)
+    self.assertEqual([entry.name for entry in crosswalk.entries()], names)
+    self.assertEqual(len(set(names)), 4)
+
+  def test_subsetAndSliceShareTheEntries(self):
+    crosswalk = self.createCrosswalk()
+    subset = crosswalk.subset(["/in/S3", "/in/S0"])
+    self.assertEqual(subset.names(), {Path("/in/S3"): "File_0004", Path("/in/S0"): "File_0001"})
+    part = crosswalk.slice(1, 3)
+    self.assertEqual(part.paths(), [Path("/in/S1"), Path("/in/S2")])
+    part.rename(0, "Renamed")
+    self.assertEqual(crosswalk.entry(1).name, "Renamed")
+
+  def test_journalRoundTrip(self):
+    crosswalk = self.createCrosswalk()
+    crosswalk.rename(2, "Manual")
+    with tempfile.TemporaryDirectory() as temp_dir:
+      output_dir = Path(temp_dir) / "output"
+      output_dir.mkdir()
+      journal = BatchJournal(output_dir)
+      for entry in crosswalk.entries():
+        journal.record(BatchJournal.seriesKey(entry.path, "1.2.3"), STATUS_DONE, entry.path,
+                       Path(output_dir) / entry.name, name=entry.name)
+      journal.close()
+      restored = Crosswalk.fromJournal(output_dir)
+    self.assertEqual(restored.paths(), crosswalk.paths())
+    self.assertEqual(restored.names(), crosswalk.names())
+    # Restored names are kept, new directories are numbered after them
+    restored.assignNames("File")
+    self.assertEqual(restored.names(), crosswalk.names())
+    row = restored.addNamed("/in/S4", "File")
+    self.assertEqual(restored.entry(row).name, "File_0005")
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.DedupCache import DedupCache, contentHash, settingsFingerprint, linkOutput
+
+class FakeClock:
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class DedupCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.root = Path(self.temp_dir.name)
+    self.clock = FakeClock()
+    self.settings = settingsFingerprint(format=".nii.gz", keep_age=False)
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def openCache(self, settings=None, **kwargs):
+    return DedupCache(self.root / "cache" / "dedup.sqlite", settings or self.settings, clock=self.clock, **kwargs)
+
+  def writeOutput(self, name):
+    path = self.root / name
+    path.write_bytes(name.encode("ascii"))
+    return path
+
+  def test_contentHash(self):
+    first = self.root / "a"
+    first.mkdir()
+    second = self.root / "b"
+    second.mkdir()
+    for directory, names in ((first, ("1.dcm", "2.dcm")), (second, ("x.dcm", "y.dcm"))):
+      for name, content in zip(names, (b"one" * 100000, b"two")):
+        (directory / name).write_bytes(content)
+    self.assertEqual(contentHash(first.iterdir()), contentHash(reversed(list(second.iterdir()))))
+    (second / "y.dcm").write_bytes(b"tw0")
+    self.assertNotEqual(contentHash(first.iterdir()), contentHash(second.iterdir()))
+
+  def test_hitAndMiss(self):
+    cache = self.openCache()
+    output = self.writeOutput("File_0001")
+    cache.store("1.2.3", "hash", output, {"name": "File_0001"})
+    self.assertEqual(cache.lookup("1.2.3", "hash"), {"name": "File_0001"})
+    self.assertIsNone(cache.lookup("1.2.3", "other"))
+    self.assertIsNone(cache.lookup("1.2.4", "hash"))
+    cache.close()
+    # Kept across runs, dropped once the output is removed
+    cache = self.openCache()
+    self.assertEqual(cache.lookup("1.2.3", "hash"), {"name": "File_0001"})
+    output.unlink()
+    self.assertIsNone(cache.lookup("1.2.3", "hash"))
+    self.assertEqual(len(cache), 0)
+    cache.close()
+
+  def test_otherSettingsDropEntries(self):
+    cache = self.openCache()
+    cache.store("1.2.3", "hash", self.writeOutput("File_0001"), {})
+    cache.close()
+    cache = self.openCache(settingsFingerprint(format=".nrrd", keep_age=False))
+    self.assertEqual(len(cache), 0)
+    cache.close()
+
+  def test_leastRecentlyUsedEviction(self):
+    cache = self.openCache(max_entries=2)
+    for index in range(3):
+      self.clock.now += 1
+      cache.store("1.2.%d" % index, "hash", self.writeOutput("File_%d" % index), {"index": index})
+    self.clock.now += 1
+    self.assertIsNotNone(cache.lookup("1.2.0", "hash"))
+    self.assertEqual(cache.evict(), 1)
+    self.assertIsNone(cache.lookup("1.2.1", "hash"))
+    self.assertIsNotNone(cache.lookup("1.2.0", "hash"))
+    self.assertIsNotNone(cache.lookup("1.2.2", "hash"))
+    cache.close()
+
+  def test_maxAgeEviction(self):
+    cache = self.openCache(max_age_days=1)
+    cache.store("1.2.0", "hash", self.writeOutput("File_0"), {})
+    self.clock.now += 12 * 3600
+    cache.store("1.2.1", "hash", self.writeOutput("File_1"), {})
+    self.clock.now += 13 * 3600
+    # Entries expire from their creation, using them does not keep them
+    self.assertIsNotNone(cache.lookup("1.2.0", "hash"))
+    self.assertEqual(cache.evict(), 1)
+    self.assertIsNone(cache.lookup("1.2.0", "hash"))
+    self.assertIsNotNone(cache.lookup("1.2.1", "hash"))
+    cache.close()
+
+  def test_linkOutput(self):
+    source = self.root / "File_0001"
+    source.mkdir()
+    (source / "IMG1.dcm").write_bytes(b"data")
+    destination = self.root / "File_0002"
+    destination.mkdir()
+    (destination / "stale.dcm").write_bytes(b"old")
+    linkOutput(source, destination)
+    self.assertEqual(sorted(p.name for p in destination.iterdir()), ["IMG1.dcm"])
+    self.assertEqual((destination / "IMG1.dcm").read_bytes(), b"data")
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.DirectoryScanner import DirectoryIndex, DirectoryScanner, scanDirectories
+
+class DirectoryScannerTest(unittest.TestCase):
+
+  # Names sorting before "/" ("a b", "a-b", "a.b"): as strings "a b" < "a/b", as paths a/b comes first
+  DIRECTORIES = ["a", "a/b", "a/b/c", "a-b", "a b", "a.b/x", "A", "b/a", "b/a/deep/er", "b0", "c/empty", "d/other"]
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.root = Path(self.temp_dir.name)
+    for directory in self.DIRECTORIES:
+      path = self.root / directory
+      path.mkdir(parents=True, exist_ok=True)
+      if directory.endswith("empty"):
+        continue
+      if directory.endswith("other"):
+        (path / "notes.txt").write_text("")
+        continue
+      for name in ("IMG2.dcm", "IMG1.DCM", "readme.txt"):
+        (path / name).write_text("")
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def globOrder(self):
+    """
+    Directories in the order of the recursive globs the scanner replaced: sorted paths, compared
+    part by part.
+    """
+    files = list(self.root.glob("**/*.dcm")) + list(self.root.glob("**/*.DCM"))
+    return [str(p) for p in sorted(set(p.parent for p in files))]
+
+  def test_orderMatchesGlob(self):
+    results = list(scanDirectories(self.root, "*.dcm"))
+    self.assertEqual([result.path for result in results], self.globOrder())
+    self.assertLess(self.globOrder().index(str(self.root / "a" / "b")), self.globOrder().index(str(self.root / "a b")))
+    for result in results:
+      self.assertEqual(result.num_files, 2)
+      self.assertEqual(result.first_file, os.path.join(result.path, "IMG1.DCM"))
+
+  def test_patterns(self):
+    self.assertEqual(DirectoryScanner.normalizePatterns(" *.DCM, *.dcm,,*.Dicom "), ["*.dcm", "*.dicom"])
+    results = list(scanDirectories(self.root, "*.txt"))
+    self.assertIn(str(self.root / "d" / "other"), [result.path for result in results])
+
+  def test_symbolicLinkLoop(self):
+    try:
+      os.symlink(str(self.root), str(self.root / "a" / "loop"))
+    except (OSError, NotImplementedError):
+      self.skipTest("Symbolic links are not supported")
+    scanner = DirectoryScanner(self.root, "*.dcm")
+    paths = [result.path for result in scanner]
+    self.assertTrue(scanner.done)
+    self.assertEqual(len(paths), len(set(os.path.realpath(p) for p in paths)))
+    self.assertEqual(sorted(os.path.realpath(p) for p in paths), sorted(os.path.realpath(p) for p in self.globOrder()))
+
+  def test_stepsAndCancel(self):
+    scanner = DirectoryScanner(self.root, "*.dcm")
+    first = scanner.step(0)
+    scanner.cancel()
+    self.assertTrue(scanner.done)
+    self.assertEqual(scanner.step(), [])
+    self.assertLessEqual(len(first), 1)
+
+  def test_indexReusesListings(self):
+    index = DirectoryIndex()
+    scanner = DirectoryScanner(self.root, "*.dcm", index)
+    first = list(scanner)
+    self.assertEqual(scanner.num_listed, len(index))
+    scanner = DirectoryScanner(self.root, "*.dcm", index)
+    self.assertEqual(list(scanner), first)
+    self.assertEqual(scanner.num_listed, 0)
+    (self.root / "b0" / "IMG3.dcm").write_text("")
+    scanner = DirectoryScanner(self.root, "*.dcm", index)
+    results = list(scanner)
+    self.assertEqual(scanner.num_listed, 1)
+    self.assertEqual([result.num_files for result in results if result.path == str(self.root / "b0")], [3])
+
+if __name__ == "__main__":
+  unittest.main()
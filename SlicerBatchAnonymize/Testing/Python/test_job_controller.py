@@ -0,0 +1,111 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.JobController import JobController
+from SlicerBatchAnonymizeLib.SeriesWorker import JobCanceled, initWorker, checkpoint
+
+class FakeClock:
+
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+class JobControllerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.controller = JobController(self.clock)
+
+  def tearDown(self):
+    initWorker()
+
+  def runCheckpoint(self, function):
+    """
+    Run function in a thread, return the thread and a list set to the exception it raised, or None.
+    """
+    outcome = []
+    def run():
+      try:
+        function()
+        outcome.append(None)
+      except JobCanceled as e:
+        outcome.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+  def test_pauseHoldsCheckpointUntilResumed(self):
+    self.controller.pause()
+    self.assertTrue(self.controller.isPaused())
+    thread, outcome = self.runCheckpoint(self.controller.checkpoint)
+    thread.join(0.3)
+    self.assertTrue(thread.is_alive())
+    self.controller.resume()
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(outcome, [None])
+
+  def test_cancelRaises(self):
+    self.controller.checkpoint()
+    self.controller.cancel()
+    self.assertTrue(self.controller.isCanceled())
+    with self.assertRaises(JobCanceled):
+      self.controller.checkpoint()
+    # A canceled batch cannot be paused
+    self.controller.pause()
+    self.assertFalse(self.controller.isPaused())
+
+  def test_cancelWakesPausedCheckpoint(self):
+    self.controller.pause()
+    thread, outcome = self.runCheckpoint(self.controller.checkpoint)
+    thread.join(0.3)
+    self.assertTrue(thread.is_alive())
+    self.controller.cancel()
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    self.assertIsInstance(outcome[0], JobCanceled)
+
+  def test_workerCheckpointFollowsController(self):
+    self.controller.installInProcess()
+    checkpoint()
+    self.controller.pause()
+    thread, outcome = self.runCheckpoint(checkpoint)
+    thread.join(0.3)
+    self.assertTrue(thread.is_alive())
+    self.controller.cancel()
+    thread.join(5)
+    self.assertIsInstance(outcome[0], JobCanceled)
+
+  def test_resetClearsRequests(self):
+    self.controller.cancel()
+    self.controller.reset(10)
+    self.assertFalse(self.controller.isCanceled())
+    self.assertFalse(self.controller.isPaused())
+    self.controller.checkpoint()
+    self.assertEqual(self.controller.total, 10)
+
+  def test_etaExcludesPausedTime(self):
+    self.controller.start(4)
+    self.assertIsNone(self.controller.eta())
+    self.assertEqual(self.controller.etaText(), "")
+    self.clock.now = 10.0
+    self.controller.advance()
+    self.assertAlmostEqual(self.controller.eta(), 30.0)
+    self.controller.pause()
+    self.clock.now = 100.0
+    self.assertAlmostEqual(self.controller.activeSeconds(), 10.0)
+    self.assertEqual(self.controller.etaText(), "paused")
+    self.controller.resume()
+    self.clock.now = 110.0
+    self.controller.advance()
+    self.assertAlmostEqual(self.controller.activeSeconds(), 20.0)
+    self.assertAlmostEqual(self.controller.eta(), 20.0)
+
+if __name__ == "__main__":
+  unittest.main()
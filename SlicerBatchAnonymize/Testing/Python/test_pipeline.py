@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import random
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.Pipeline import runPipeline
+
+def _slowDouble(x):
+  time.sleep(random.uniform(0, 0.005))
+  return x * 2
+
+class PipelineTest(unittest.TestCase):
+
+  def test_resultsKeepTheOrderOfTheItems(self):
+    results = list(runPipeline(range(50), [_slowDouble, lambda x: x + 1, _slowDouble], queue_size=2))
+    self.assertEqual(results, [(x * 2 + 1) * 2 for x in range(50)])
+
+  def test_noStages(self):
+    self.assertEqual(list(runPipeline(range(5), [])), list(range(5)))
+
+  def test_stageFailureIsRaisedAfterThePreviousResults(self):
+    def failOnThree(x):
+      if x == 3:
+        raise ValueError("boom")
+      return x
+    results = []
+    with self.assertRaises(ValueError) as context:
+      for result in runPipeline(range(10), [failOnThree, _slowDouble]):
+        results.append(result)
+    self.assertEqual(str(context.exception), "boom")
+    self.assertEqual(results, [0, 2, 4])
+
+  def test_itemsFailureIsRaised(self):
+    def items():
+      yield 1
+      raise KeyError("items")
+    with self.assertRaises(KeyError):
+      list(runPipeline(items(), [_slowDouble]))
+
+  def test_closingStopsTheStages(self):
+    threads = threading.active_count()
+    results = runPipeline(range(1000), [_slowDouble, _slowDouble])
+    self.assertEqual(next(results), 0)
+    results.close()
+    self.assertEqual(threading.active_count(), threads)
+
+  def test_waitIsCalledWhileWaiting(self):
+    calls = []
+    def slow(x):
+      time.sleep(0.25)
+      return x
+    self.assertEqual(list(runPipeline([1], [slow], wait=lambda: calls.append(1))), [1])
+    self.assertGreater(len(calls), 0)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.PseudonymStore import PseudonymStore, DATE_OFFSETS
+
+class PseudonymStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.path = Path(self.temp_dir.name) / "store" / "pseudonyms.sqlite"
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def test_pseudonymsAreReusedAcrossRuns(self):
+    store = PseudonymStore(self.path, batch_size=2)
+    patient = store.patient("P1")
+    study = store.study("1.2.3")
+    series = store.series("1.2.3.4")
+    store.close()
+    store = PseudonymStore(self.path)
+    self.assertEqual(store.patient("P1"), patient)
+    self.assertEqual(store.study("1.2.3"), study)
+    self.assertEqual(store.series("1.2.3.4"), series)
+    self.assertEqual(len(store), 3)
+    store.close()
+
+  def test_values(self):
+    store = PseudonymStore(self.path)
+    pseudonym, date_offset = store.patient("P1")
+    self.assertTrue(pseudonym.startswith("2.25."))
+    self.assertLessEqual(len(pseudonym), 64)
+    self.assertIn(date_offset, DATE_OFFSETS)
+    self.assertEqual(store.patient("P1"), (pseudonym, date_offset))
+    self.assertNotEqual(store.patient("P2")[0], pseudonym)
+    # Kinds do not share pseudonyms
+    self.assertNotEqual(store.study("P1"), pseudonym)
+    store.close()
+
+  def test_otherStoreGivesOtherValues(self):
+    store = PseudonymStore(self.path)
+    other = PseudonymStore(self.path.with_name("other.sqlite"))
+    self.assertNotEqual(store.patient("P1")[0], other.patient("P1")[0])
+    store.close()
+    other.close()
+
+  def test_concurrentStoresAgree(self):
+    first = PseudonymStore(self.path)
+    second = PseudonymStore(self.path)
+    self.assertEqual(first.study("1.2.3"), second.study("1.2.3"))
+    first.close()
+    second.close()
+
+  def test_addKeepsExistingValues(self):
+    store = PseudonymStore(self.path)
+    patient = store.patient("P1")
+    store.close()
+    store = PseudonymStore(self.path)
+    with self.assertLogs(level="WARNING"):
+      self.assertEqual(store.add("patient", "P1", "9.9.9", 90), patient)
+    self.assertEqual(store.add("study", "1.2.3", "8.8.8"), ("8.8.8", None))
+    # The stored value is used from the start, not only once flushed
+    self.assertEqual(store.patient("P1"), patient)
+    store.flush()
+    self.assertEqual(store.patient("P1"), patient)
+    self.assertEqual(store.study("1.2.3"), "8.8.8")
+    store.close()
+    store = PseudonymStore(self.path)
+    self.assertEqual(store.study("1.2.3"), "8.8.8")
+    store.close()
+
+if __name__ == "__main__":
+  unittest.main()
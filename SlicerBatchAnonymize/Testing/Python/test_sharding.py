@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import importlib.util
+import logging
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib import BatchCLI
+from SlicerBatchAnonymizeLib.BatchJournal import BatchJournal
+from SlicerBatchAnonymizeLib.Crosswalk import Crosswalk
+from SlicerBatchAnonymizeLib.SyntheticData import DatasetSpec, generateDataset
+from SlicerBatchAnonymizeLib.Sharding import (shardRange, shardRows, shardDirectoryName, shardStateDir, checkPseudonyms,
+                                              mergeShards)
+
+class PatientList(Crosswalk):
+  """
+  Crosswalk whose PatientIDs are given instead of read from the files.
+  """
+
+  def __init__(self, patient_ids):
+    Crosswalk.__init__(self)
+    self._patient_ids = patient_ids
+    for row in range(len(patient_ids)):
+      self.add("/in/S%d" % row)
+
+  def patientID(self, row):
+    return self._patient_ids[row]
+
+class ShardingTest(unittest.TestCase):
+
+  def test_shardRangeCoversAllItems(self):
+    for num_items in range(12):
+      for num_shards in range(1, 6):
+        ranges = [shardRange(num_items, num_shards, index) for index in range(num_shards)]
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], num_items)
+        for (start, stop), (next_start, next_stop) in zip(ranges, ranges[1:]):
+          self.assertEqual(stop, next_start)
+        sizes = [stop - start for start, stop in ranges]
+        self.assertLessEqual(max(sizes) - min(sizes), 1)
+
+  def test_shardRangeRejectsInvalidShards(self):
+    with self.assertRaises(ValueError):
+      shardRange(10, 0, 0)
+    with self.assertRaises(ValueError):
+      shardRange(10, 3, 3)
+
+  def test_shardRowsKeepPatientsTogether(self):
+    patient_ids = ["A", "A", "B", "C", "C", "C", "B", "D", "", "E", ""]
+    input_image_list = PatientList(patient_ids)
+    for num_shards in range(1, 6):
+      shards = [shardRows(input_image_list, num_shards, index) for index in range(num_shards)]
+      self.assertEqual(sorted(row for rows in shards for row in rows), list(range(len(patient_ids))))
+      owners = {}
+      for index, rows in enumerate(shards):
+        self.assertEqual(rows, sorted(rows))
+        for row in rows:
+          self.assertEqual(owners.setdefault(patient_ids[row], index), index)
+
+  def test_checkPseudonyms(self):
+    records = [{"patient": "A", "patient_ded": "1", "study": "S1", "study_ded": "10"},
+               {"patient": "A", "patient_ded": "1", "study": "S2", "study_ded": "20"},
+               {"patient": "B", "patient_ded": "2", "study": "S3", "study_ded": "30"},
+               {"status": "error"}]
+    checkPseudonyms(records)
+    with self.assertRaises(ValueError):
+      checkPseudonyms(records + [{"patient": "A", "patient_ded": "3", "study": "S1", "study_ded": "10"}])
+    with self.assertRaises(ValueError):
+      checkPseudonyms(records + [{"patient": "C", "patient_ded": "2", "study": "S4", "study_ded": "40"}])
+
+class ShardedBatchTest(unittest.TestCase):
+
+  NUM_SHARDS = 3
+
+  @classmethod
+  def setUpClass(cls):
+    for module in ("numpy", "pydicom"):
+      if importlib.util.find_spec(module) is None:
+        raise unittest.SkipTest("Synthetic data needs {}".format(module))
+    logging.disable(logging.WARNING)
+    cls.temp_dir = tempfile.TemporaryDirectory()
+    root = Path(cls.temp_dir.name)
+    cls.input_dir = root / "input"
+    cls.output_dir = root / "output"
+    generateDataset(cls.input_dir, DatasetSpec("test", 5, 2, 2, (4,), (16,), ("explicit",), 0))
+    for index in range(cls.NUM_SHARDS):
+      result = BatchCLI.main(["--direct", "--header-only", "--format", ".dcm", "--input", str(cls.input_dir),
+                              "--output", str(cls.output_dir), "--num-shards", str(cls.NUM_SHARDS),
+                              "--shard-index", str(index)])
+      if result:
+        raise RuntimeError("Shard {} failed".format(index))
+
+  @classmethod
+  def tearDownClass(cls):
+    logging.disable(logging.NOTSET)
+    cls.temp_dir.cleanup()
+
+  def shardDirectory(self, index):
+    return self.output_dir / shardDirectoryName(self.NUM_SHARDS, index)
+
+  def stateDirectory(self, index):
+    return shardStateDir(self.output_dir, None, shardDirectoryName(self.NUM_SHARDS, index))
+
+  def test_patientsAreNotSplit(self):
+    owners = {}
+    for index in range(self.NUM_SHARDS):
+      for record in BatchJournal.loadRecords(self.shardDirectory(index), self.stateDirectory(index)).values():
+        patient = Path(record["input"]).relative_to(self.input_dir).parts[0]
+        self.assertEqual(owners.setdefault(patient, index), index)
+    self.assertEqual(len(owners), 5)
+
+  def test_journalsAreOutsideTheOutput(self):
+    self.assertEqual(list(self.output_dir.glob("**/" + BatchJournal.JOURNAL_NAME)), [])
+    for index in range(self.NUM_SHARDS):
+      self.assertTrue((self.stateDirectory(index) / BatchJournal.JOURNAL_NAME).exists())
+
+  def test_mergeCoversAllDirectories(self):
+    self.assertEqual(mergeShards(self.output_dir), 20)
+    with open(str(self.output_dir / BatchJournal.CROSSWALK_NAME), encoding="utf-8") as f:
+      lines = f.read().splitlines()[1:]
+    inputs = [line.split(",")[0] for line in lines]
+    expected = sorted(str(p.parent) for p in self.input_dir.glob("*/*/*/IMG0001.dcm"))
+    self.assertEqual(inputs, expected)
+    outputs = [Path(line.split(",")[1]).name for line in lines]
+    self.assertEqual(outputs, ["File_%04d" % (row + 1) for row in range(20)])
+
+  def test_mergeRejectsConflictingPseudonyms(self):
+    with tempfile.TemporaryDirectory() as copy_dir:
+      output_dir = Path(copy_dir) / "output"
+      state_dir = Path(copy_dir) / "state"
+      for index in range(self.NUM_SHARDS):
+        name = self.shardDirectory(index).name
+        (output_dir / name).mkdir(parents=True)
+        (state_dir / name).mkdir(parents=True)
+        (output_dir / name / "shard.json").write_bytes((self.shardDirectory(index) / "shard.json").read_bytes())
+        lines = (self.stateDirectory(index) / BatchJournal.JOURNAL_NAME).read_text(encoding="utf-8").splitlines(True)
+        if index == 0:
+          record = json.loads(lines[0])
+          record["patient_ded"] = "2.25.1"
+          lines[0] = json.dumps(record) + "\n"
+        (state_dir / name / BatchJournal.JOURNAL_NAME).write_text("".join(lines), encoding="utf-8")
+      with self.assertRaises(ValueError):
+        mergeShards(output_dir, state_dir)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,153 @@
+import os
+import sys
+import logging
+import tempfile
+import unittest
+import importlib.util
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from SlicerBatchAnonymizeLib.SeriesWorker import STATUS_DONE
+from SlicerBatchAnonymizeLib.SyntheticData import generateSeries
+from SlicerBatchAnonymizeLib.TagRewrite import rewriteSeries
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+@unittest.skipIf(importlib.util.find_spec("pydicom") is None or importlib.util.find_spec("numpy") is None,
+                 "Needs pydicom and numpy")
+class TagRewriteTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.disable(logging.WARNING)
+    self.temp_dir = tempfile.TemporaryDirectory()
+    root = Path(self.temp_dir.name)
+    self.output_dir = root / "output"
+    patient = ("PAT001", "Doe^John", "19700101", "M")
+    study = ("1.2.826.0.1.3680043.2.1125.1.1", "20200101")
+    self.files = generateSeries(root / "input", patient, study, 1, 3, 8)
+    self.addIdentifyingElements()
+
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    self.temp_dir.cleanup()
+
+  def addIdentifyingElements(self):
+    """
+    Add elements the rewrite must not let through: dates, names, free text and UIDs, at the
+    top level and in nested sequences, and a private element.
+    """
+    import pydicom
+    from pydicom.dataset import Dataset
+    first_sop_instance_uid = str(pydicom.dcmread(self.files[0], stop_before_pixels=True).SOPInstanceUID)
+    for path in self.files:
+      ds = pydicom.dcmread(path)
+      ds.PerformedProcedureStepStartDate = "20200102"
+      ds.PerformedProcedureStepStartTime = "101010"
+      ds.RequestedProcedureDescription = "Chest CT of John Doe"
+      ds.SeriesDescription = "John Doe follow-up"
+      ds.ProtocolName = "Doe protocol"
+      ds.ImageComments = "Patient called John"
+      ds.IrradiationEventUID = "1.2.826.0.1.3680043.2.1125.9.9"
+      ds.add_new(0x00091010, "LO", "Private identifier")
+      reference = Dataset()
+      reference.ReferencedSOPClassUID = CT_IMAGE_STORAGE
+      reference.ReferencedSOPInstanceUID = first_sop_instance_uid
+      ds.ReferencedImageSequence = [reference]
+      source = Dataset()
+      source.ReferencedSOPClassUID = CT_IMAGE_STORAGE
+      source.ReferencedSOPInstanceUID = "1.2.826.0.1.3680043.2.1125.9.8"
+      ds.SourceImageSequence = [source]
+      study = Dataset()
+      study.ReferencedSOPClassUID = "1.2.840.10008.3.1.2.3.1"
+      study.ReferencedSOPInstanceUID = str(ds.StudyInstanceUID)
+      ds.ReferencedStudySequence = [study]
+      step = Dataset()
+      step.ScheduledProcedureStepStartDate = "20200101"
+      step.ScheduledPerformingPhysicianName = "Smith^Anna"
+      step.ScheduledProcedureStepDescription = "Doe scan"
+      nested = Dataset()
+      nested.ContentDate = "20200101"
+      nested.UID = "1.2.826.0.1.3680043.2.1125.9.7"
+      step.ContentSequence = [nested]
+      ds.RequestAttributesSequence = [Dataset()]
+      ds.ScheduledProcedureStepSequence = [step]
+      ds.save_as(path)
+
+  def originalValues(self):
+    """
+    :return: set of the non empty string values of the source files, UIDs included
+    """
+    import pydicom
+    values = set()
+    def collect(dataset, elem):
+      if elem.VR in ("UI", "DA", "TM", "DT", "PN", "LO", "SH", "LT", "ST") and elem.value:
+        values.update(str(v) for v in (elem.value if elem.VM > 1 else [elem.value]))
+    for path in self.files:
+      ds = pydicom.dcmread(path, stop_before_pixels=True)
+      ds.walk(collect)
+      ds.file_meta.walk(collect)
+    return values
+
+  def rewrite(self, **tags):
+    task = {"index": 0, "files": list(self.files), "output": str(self.output_dir), "name": "File_0001",
+            "tags": dict({"PatientID": "2.25.1", "StudyInstanceUID": "2.25.2", "SeriesInstanceUID": "2.25.3"}, **tags)}
+    result = rewriteSeries(task)
+    self.assertEqual(result["status"], STATUS_DONE, result["message"])
+    import pydicom
+    return [pydicom.dcmread(str(path)) for path in sorted(self.output_dir.iterdir())]
+
+  def test_noIdentifyingValueSurvives(self):
+    original = self.originalValues()
+    kept = {CT_IMAGE_STORAGE, "1.2.840.10008.3.1.2.3.1", "CT", "MONOCHROME2"}
+    leaked = []
+    def check(dataset, elem):
+      if elem.VR in ("DA", "TM", "DT", "LT", "ST") and elem.value:
+        leaked.append(elem)
+      if elem.VR == "PN" and elem.keyword != "PatientName" and elem.value:
+        leaked.append(elem)
+      if elem.VR in ("UI", "DA", "TM", "DT", "PN", "LO", "SH", "LT", "ST") and elem.value:
+        for value in (elem.value if elem.VM > 1 else [elem.value]):
+          if str(value) in original and str(value) not in kept:
+            leaked.append(elem)
+      if elem.tag.is_private:
+        leaked.append(elem)
+    datasets = self.rewrite()
+    self.assertEqual(len(datasets), 3)
+    for ds in datasets:
+      ds.walk(check)
+      self.assertNotIn(ds.file_meta.MediaStorageSOPInstanceUID, original)
+      self.assertEqual(str(ds.PatientName), "File_0001")
+      self.assertEqual(ds.SeriesDescription, "")
+      self.assertEqual(ds.RequestAttributesSequence, [])
+    self.assertEqual(leaked, [])
+
+  def test_uidsAreRemappedConsistently(self):
+    import pydicom
+    sources = [pydicom.dcmread(path) for path in self.files]
+    datasets = self.rewrite()
+    self.assertEqual(len(set(ds.FrameOfReferenceUID for ds in datasets)), 1)
+    self.assertNotEqual(datasets[0].FrameOfReferenceUID, sources[0].FrameOfReferenceUID)
+    self.assertEqual(len(set(ds.SOPInstanceUID for ds in datasets)), 3)
+    for source, ds in zip(sources, datasets):
+      self.assertEqual(ds.SOPClassUID, CT_IMAGE_STORAGE)
+      self.assertEqual(ds.file_meta.TransferSyntaxUID, source.file_meta.TransferSyntaxUID)
+      self.assertEqual(ds.file_meta.MediaStorageSOPInstanceUID, ds.SOPInstanceUID)
+      self.assertEqual(ds.StudyInstanceUID, "2.25.2")
+      self.assertEqual(ds.SeriesInstanceUID, "2.25.3")
+      # References to the series and its study lead to the anonymized ones
+      self.assertEqual(ds.ReferencedImageSequence[0].ReferencedSOPInstanceUID, datasets[0].SOPInstanceUID)
+      self.assertEqual(ds.ReferencedImageSequence[0].ReferencedSOPClassUID, CT_IMAGE_STORAGE)
+      self.assertEqual(ds.ReferencedStudySequence[0].ReferencedSOPInstanceUID, "2.25.2")
+      self.assertEqual(ds.PixelData, source.PixelData)
+
+  def test_explicitTagsAreKept(self):
+    datasets = self.rewrite(StudyDate="20200101", PatientBirthDate="19700301", PatientSex="M")
+    for ds in datasets:
+      self.assertEqual(ds.StudyDate, "20200101")
+      self.assertEqual(ds.PatientBirthDate, "19700301")
+      self.assertEqual(ds.PatientSex, "M")
+      self.assertEqual(ds.StudyTime, "")
+
+if __name__ == "__main__":
+  unittest.main()